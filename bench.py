@@ -0,0 +1,695 @@
+import sys
+import os
+import time
+import struct
+import random
+import socket
+import signal
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
+import concurrent.futures
+import io
+import shutil
+import queue
+import threading
+
+import common
+from common import *
+from effteepeec import EffTeePeeClient
+
+def main():
+    if len(sys.argv) < 2:
+        print("error: need benchmark name. One of: {}".format(", ".join(benchmarks)))
+        return 1
+    name = sys.argv[1]
+    common.DEBUG = False
+    if name not in benchmarks:
+        print("error: unknown benchmark {}".format(name))
+        return 1
+    return benchmarks[name](sys.argv[2:])
+
+def timeit(fn, *args, repeat=5, **kwargs):
+    """
+    timeit will run fn(*args, **kwargs) repeat times 
+    and return the best wall time in seconds.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def mbps(nbytes, seconds):
+    return nbytes / seconds / (1024 * 1024)
+
+# The original per-byte loops, kept here as the
+# baseline to compare the table driven cipher against.
+def loop_encrypt(key, plaintext):
+    b = []
+    for i in range(len(plaintext)):
+        k = key[i % len(key)]
+        c = ((plaintext[i] + ord(k)) % 256)
+        b.append(c)
+    return bytes(b)
+
+def loop_decrypt(key, ciphertext):
+    b = []
+    for i in range(len(ciphertext)):
+        k = key[i % len(key)]
+        p = abs((ciphertext[i] - ord(k)) % 256)
+        b.append(p)
+    return bytes(b)
+
+def bench_cipher(args):
+    """
+    Compare the per-byte vigenere loops with the
+    VigenereCipher tables on DEFAULT_FILE_CHUNK_SIZE
+    chunks of random data.
+    """
+    total = 4 * 1024 * 1024
+    data = os.urandom(total)
+    chunks = [data[i:i+DEFAULT_FILE_CHUNK_SIZE] for i in range(0, total, DEFAULT_FILE_CHUNK_SIZE)]
+    key = ENCRYPTION_KEY
+
+    for chunk in chunks[:8]:
+        assert encrypt(key, chunk) == loop_encrypt(key, chunk)
+        assert decrypt(key, chunk) == loop_decrypt(key, chunk)
+
+    def run(fn):
+        for chunk in chunks:
+            fn(key, chunk)
+
+    print("{:<12} {:>12} {:>12}".format("cipher", "loop MB/s", "table MB/s"))
+    for label, loop_fn, table_fn in (("encrypt", loop_encrypt, encrypt), ("decrypt", loop_decrypt, decrypt)):
+        loop_time = timeit(run, loop_fn, repeat=1)
+        table_time = timeit(run, table_fn)
+        print("{:<12} {:>12.2f} {:>12.2f}".format(label, mbps(total, loop_time), mbps(total, table_time)))
+    return 0
+
+def text_corpus(size):
+    """
+    text_corpus builds size bytes of text out of the 
+    sources and docs in this repo.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    parts = list()
+    for name in ("common.py", "effteepeed.py", "effteepeec.py", join("docs", "design.txt")):
+        with open(join(here, name), "rb") as f:
+            parts.append(f.read())
+    text = b"".join(parts)
+    return (text * (size // len(text) + 1))[:size]
+
+def binary_corpus(size):
+    """
+    binary_corpus builds size bytes of structured binary
+    data: little records of counters and floats with some
+    random noise mixed in, half of it incompressible.
+    """
+    rnd = random.Random(1234)
+    frame = bytearray()
+    i = 0
+    while len(frame) < size // 2:
+        frame.extend(struct.pack("<IIdH", i, i * 7 % 1000, rnd.random(), rnd.randrange(16)))
+        i += 1
+    frame.extend(os.urandom(size - len(frame)))
+    return bytes(frame[:size])
+
+def corpora(size):
+    return (("text", text_corpus(size)), ("binary", binary_corpus(size)))
+
+def encode_chunks(data, **settings):
+    encoder = FileEncoder(True, False, ENCRYPTION_KEY, **settings)
+    out = list()
+    for i in range(0, len(data), DEFAULT_FILE_CHUNK_SIZE):
+        out.extend(encoder.encode(data[i:i+DEFAULT_FILE_CHUNK_SIZE]))
+    out.extend(encoder.flush())
+    return out
+
+def decode_chunks(chunks, **settings):
+    settings.pop("adaptive", None)
+    decoder = FileDecoder(True, False, ENCRYPTION_KEY, **settings)
+    out = list()
+    for chunk in chunks:
+        out.append(decoder.decode(chunk))
+    assert decoder.finish()
+    return b"".join(out)
+
+def encoded_size(chunks):
+    return sum(len(c.data) for c in chunks)
+
+def bench_lzma(args):
+    """
+    Compare compressing every chunk into its own XZ 
+    container with one streaming XZ context per file.
+    """
+    size = 2 * 1024 * 1024
+    modes = (("per-chunk", dict()), ("streaming", dict(streaming=True)))
+    print("{:<8} {:<10} {:>8} {:>12} {:>12}".format("corpus", "mode", "ratio", "enc MB/s", "dec MB/s"))
+    for corpus, data in corpora(size):
+        for mode, settings in modes:
+            chunks = encode_chunks(data, **settings)
+            assert decode_chunks(chunks, **settings) == data
+            encoded = encoded_size(chunks)
+            enc_time = timeit(encode_chunks, data, repeat=1, **settings)
+            dec_time = timeit(decode_chunks, chunks, repeat=1, **settings)
+            print("{:<8} {:<10} {:>8.2f} {:>12.2f} {:>12.2f}".format(
+                corpus, mode, size / encoded, mbps(size, enc_time), mbps(size, dec_time)))
+    return 0
+
+def bench_codecs(args):
+    """
+    Compare ratio and throughput of every registered
+    codec, one stream per file.
+    """
+    size = 2 * 1024 * 1024
+    print("{:<8} {:<10} {:>8} {:>12} {:>12}".format("corpus", "codec", "ratio", "enc MB/s", "dec MB/s"))
+    for corpus, data in corpora(size):
+        for codec in compression_codecs.values():
+            settings = dict(streaming=True, codec=codec.id)
+            chunks = encode_chunks(data, **settings)
+            assert decode_chunks(chunks, **settings) == data
+            encoded = encoded_size(chunks)
+            enc_time = timeit(encode_chunks, data, repeat=1, **settings)
+            dec_time = timeit(decode_chunks, chunks, repeat=1, **settings)
+            print("{:<8} {:<10} {:>8.2f} {:>12.2f} {:>12.2f}".format(
+                corpus, codec.name, size / encoded, mbps(size, enc_time), mbps(size, dec_time)))
+    return 0
+
+def bench_adaptive(args):
+    """
+    Compare plain and adaptive compression on text, 
+    binary and already compressed data.
+    """
+    size = 2 * 1024 * 1024
+    data = corpora(size) + (("packed", lzma.compress(os.urandom(size))),)
+    print("{:<8} {:<10} {:<9} {:>8} {:>12} {:>10}".format("corpus", "mode", "adaptive", "ratio", "enc MB/s", "raw chunks"))
+    for corpus, data in data:
+        for mode, streaming in (("per-chunk", False), ("streaming", True)):
+            for adaptive in (False, True):
+                settings = dict(streaming=streaming, adaptive=adaptive)
+                chunks = encode_chunks(data, **settings)
+                assert decode_chunks(chunks, **settings) == data
+                raw = sum(1 for c in chunks if c.id() == MsgType.RawFileChunk)
+                enc_time = timeit(encode_chunks, data, repeat=1, **settings)
+                print("{:<8} {:<10} {:<9} {:>8.2f} {:>12.2f} {:>10}".format(
+                    corpus, mode, str(adaptive), size / encoded_size(chunks), mbps(size, enc_time), raw))
+    return 0
+
+def bench_pipeline(args):
+    """
+    Compare encoding a file one chunk after the other with 
+    the pipelined encoder on thread and process pools, with
+    compression and encryption on. Worker counts can be 
+    given as arguments.
+    """
+    size = 32 * 1024 * 1024
+    chunk_size = 1024 * 1024
+    counts = [int(a) for a in args] or sorted({2, 4, os.cpu_count() or 1})
+    data = text_corpus(size)
+
+    def run(executor):
+        encoder = FileEncoder(True, True, ENCRYPTION_KEY, codec=CodecType.ZLIB6, chunk_size=chunk_size)
+        f = io.BytesIO(data)
+        if executor is None:
+            chunks = common.encode_chunks(f, encoder, chunk_size)
+        else:
+            chunks = encode_chunks_pipelined(f, encoder, chunk_size, executor)
+        for msg in chunks:
+            pass
+
+    print("{:<8} {:>8} {:>12}".format("pool", "workers", "enc MB/s"))
+    print("{:<8} {:>8} {:>12.2f}".format("none", 1, mbps(size, timeit(run, None, repeat=3))))
+    pools = (("thread", concurrent.futures.ThreadPoolExecutor), ("process", concurrent.futures.ProcessPoolExecutor))
+    for pool, cls in pools:
+        for count in counts:
+            with cls(count) as executor:
+                # start the workers before timing
+                list(executor.map(abs, range(count)))
+                print("{:<8} {:>8} {:>12.2f}".format(pool, count, mbps(size, timeit(run, executor, repeat=3))))
+    return 0
+
+BENCH_USER = "bench"
+BENCH_PASSWORD = "bench@example.com"
+
+def write_user_file(directory, root):
+    """
+    write_user_file writes a user file with the bench 
+    user rooted at root and returns its path.
+    """
+    user_file = join(directory, "users.txt")
+    pass_hash = hashlib.sha256(BENCH_PASSWORD.encode("utf-8")).hexdigest()
+    with open(user_file, "w") as f:
+        f.write("::".join((BENCH_USER, pass_hash, root)) + "\n")
+    return user_file
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(port, user_file, *flags):
+    """
+    start_server runs effteepeed.py in its own process
+    and waits until it accepts connections.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, join(here, "effteepeed.py"), "--host", "127.0.0.1",
+        "--port", str(port), "--user-file", user_file] + list(flags)
+    proc = subprocess.Popen(cmd, cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for i in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+def connect_client(port):
+    client = EffTeePeeClient()
+    client.connect("127.0.0.1", port)
+    if not client.handshake(BENCH_USER, BENCH_PASSWORD):
+        raise RuntimeError("could not authenticate")
+    return client
+
+def proc_status(pid):
+    """
+    proc_status returns the (threads, rss in MiB) of a 
+    process from /proc, or (None, None) if there is no /proc.
+    """
+    threads, rss = None, None
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+                elif line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return threads, rss
+
+def bench_connections(args):
+    """
+    Open more and more idle authenticated sessions against
+    the threaded and the asyncio server. Reports how long
+    the new handshakes took, the time for an ls round trip
+    on every open session and the server's threads and memory.
+    Session counts can be given as arguments.
+    """
+    counts = [int(a) for a in args] or [50, 200, 500]
+    engines = (("threaded", []), ("async", ["--async"]))
+    print("{:<9} {:>9} {:>14} {:>12} {:>8} {:>9}".format(
+        "engine", "sessions", "handshake ms", "ls ms/sess", "threads", "rss MiB"))
+    with tempfile.TemporaryDirectory() as root:
+        user_file = write_user_file(root, root)
+        for engine, flags in engines:
+            port = free_port()
+            proc = start_server(port, user_file, *flags)
+            clients = list()
+            try:
+                for count in counts:
+                    start = time.perf_counter()
+                    while len(clients) < count:
+                        clients.append(connect_client(port))
+                    handshake = (time.perf_counter() - start) * 1000
+                    start = time.perf_counter()
+                    for client in clients:
+                        client.ls(".")
+                    ls_time = (time.perf_counter() - start) * 1000 / len(clients)
+                    threads, rss = proc_status(proc.pid)
+                    print("{:<9} {:>9} {:>14.1f} {:>12.3f} {:>8} {:>9}".format(engine, count, handshake, ls_time,
+                        str(threads), "{:.1f}".format(rss) if rss else "n/a"))
+            finally:
+                for client in clients:
+                    client.socket.close()
+                proc.terminate()
+                proc.wait()
+    return 0
+
+def get_loop(port, filename, seconds):
+    """
+    get_loop gets filename over and over with compression 
+    and encryption on for seconds and returns the number
+    of file bytes received.
+    """
+    common.DEBUG = False
+    client = connect_client(port)
+    client.toggle_compression()
+    client.toggle_encryption()
+    client.set_codec(CodecType.ZLIB6)
+    size = os.path.getsize(filename)
+    got = 0
+    with tempfile.TemporaryDirectory() as cwd:
+        os.chdir(cwd)
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            if not client.get([os.path.basename(filename)]):
+                raise RuntimeError("get failed")
+            got += size
+    client.quit()
+    return got
+
+def bench_processes(args):
+    """
+    Run compressed and encrypted gets from as many client 
+    processes as there are cores against the server with
+    more and more worker processes and report the aggregate
+    throughput. Process counts can be given as arguments.
+    """
+    cores = os.cpu_count() or 1
+    counts = [int(a) for a in args] or sorted({1, 2, 4, cores})
+    seconds = 5
+    print("{} cores, {} clients".format(cores, cores))
+    print("{:<10} {:>10}".format("processes", "MB/s"))
+    with tempfile.TemporaryDirectory() as root:
+        user_file = write_user_file(root, root)
+        filename = join(root, "corpus.txt")
+        with open(filename, "wb") as f:
+            f.write(text_corpus(1024 * 1024))
+        for count in counts:
+            port = free_port()
+            proc = start_server(port, user_file, "--processes", str(count))
+            try:
+                with multiprocessing.Pool(cores) as pool:
+                    got = pool.starmap(get_loop, [(port, filename, seconds)] * cores)
+                print("{:<10} {:>10.2f}".format(count, mbps(sum(got), seconds)))
+            finally:
+                proc.send_signal(signal.SIGINT)
+                proc.wait()
+    return 0
+
+def bench_lanes(args):
+    """
+    Get and put a few thousand small files over more and
+    more parallel connections. Lane counts can be given
+    as arguments.
+    """
+    counts = [int(a) for a in args] or [1, 2, 4, 8]
+    num_files = 2000
+    print("{:<6} {:>10} {:>10}".format("lanes", "get s", "put s"))
+    with tempfile.TemporaryDirectory() as root:
+        user_file = write_user_file(root, root)
+        filenames = ["small{}.txt".format(i) for i in range(num_files)]
+        for filename in filenames:
+            with open(join(root, filename), "wb") as f:
+                f.write(os.urandom(random.randrange(512, 4096)))
+        port = free_port()
+        proc = start_server(port, user_file)
+        try:
+            client = connect_client(port)
+            for count in counts:
+                client.set_lanes(count)
+                with tempfile.TemporaryDirectory() as cwd:
+                    os.chdir(cwd)
+                    start = time.perf_counter()
+                    assert client.parallel_get(filenames)
+                    get_time = time.perf_counter() - start
+                    start = time.perf_counter()
+                    assert client.parallel_put(filenames)
+                    put_time = time.perf_counter() - start
+                    os.chdir(root)
+                print("{:<6} {:>10.2f} {:>10.2f}".format(count, get_time, put_time))
+            client.quit()
+        finally:
+            proc.terminate()
+            proc.wait()
+    return 0
+
+def bench_segments(args):
+    """
+    Get one large file with compression and encryption on,
+    in one piece and then in more and more segments over
+    parallel connections. Segment counts can be given as 
+    arguments.
+    """
+    counts = [int(a) for a in args] or [2, 4, 8]
+    size = 64 * 1024 * 1024
+    print("{:<9} {:>10}".format("segments", "MB/s"))
+    with tempfile.TemporaryDirectory() as root:
+        user_file = write_user_file(root, root)
+        with open(join(root, "big.txt"), "wb") as f:
+            f.write(text_corpus(size))
+        port = free_port()
+        proc = start_server(port, user_file, "--processes", str(max(counts)))
+        try:
+            client = connect_client(port)
+            client.toggle_compression()
+            client.toggle_encryption()
+            client.set_codec(CodecType.ZLIB6)
+            with tempfile.TemporaryDirectory() as cwd:
+                os.chdir(cwd)
+                start = time.perf_counter()
+                assert client.get(["big.txt"])
+                print("{:<9} {:>10.2f}".format(1, mbps(size, time.perf_counter() - start)))
+                for count in counts:
+                    start = time.perf_counter()
+                    assert client.segmented_get("big.txt", count)
+                    print("{:<9} {:>10.2f}".format(count, mbps(size, time.perf_counter() - start)))
+                os.chdir(root)
+            client.quit()
+        finally:
+            proc.send_signal(signal.SIGINT)
+            proc.wait()
+    return 0
+
+def bench_delta(args):
+    """
+    Put and get a large file that changed in a few places 
+    in full and as a delta, and report the time and how
+    big the delta is. The file size in MiB can be given
+    as an argument.
+    """
+    size = int(args[0]) * 1024 * 1024 if args else 64 * 1024 * 1024
+    old = os.urandom(size)
+    new = bytearray(old)
+    for i in range(1, 9):
+        at = i * size // 10
+        new[at:at+100] = os.urandom(100)
+    new[size // 2:size // 2] = b"inserted" * 512
+    new = bytes(new)
+    print("{:<7} {:>10} {:>12}".format("mode", "put s", "get s"))
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as cwd:
+        user_file = write_user_file(root, root)
+        port = free_port()
+        proc = start_server(port, user_file)
+        try:
+            client = connect_client(port)
+            os.chdir(cwd)
+            for mode in ("full", "delta"):
+                with open(join(root, "big.bin"), "wb") as f:
+                    f.write(old)
+                with open("big.bin", "wb") as f:
+                    f.write(new)
+                start = time.perf_counter()
+                assert client.delta_put("big.bin") if mode == "delta" else client.put(["big.bin"])
+                put_time = time.perf_counter() - start
+                with open("big.bin", "wb") as f:
+                    f.write(old)
+                start = time.perf_counter()
+                assert client.delta_get("big.bin") if mode == "delta" else client.get(["big.bin"])
+                get_time = time.perf_counter() - start
+                print("{:<7} {:>10.2f} {:>12.2f}".format(mode, put_time, get_time))
+            with open(join(root, "old.bin"), "wb") as f:
+                f.write(old)
+            signatures = signature_msgs(join(root, "old.bin"))
+            for msg in signatures[1:]:
+                signatures[0].sigs.extend(msg.sigs)
+            delta = open_delta(join(root, "big.bin"), signatures[0])
+            delta_size = 0
+            while True:
+                data = delta.read(DEFAULT_FILE_CHUNK_SIZE)
+                if not data:
+                    break
+                delta_size += len(data)
+            delta.close()
+            print("file {} bytes, delta {} bytes".format(len(new), delta_size))
+            os.chdir(root)
+            client.quit()
+        finally:
+            proc.terminate()
+            proc.wait()
+    return 0
+
+
+def bench_cache(args):
+    """
+    Get the same compressed and encrypted file a few times 
+    from a server without and with a chunk cache, and 
+    report the throughput of the first and the later gets.
+    The file size in MiB can be given as an argument.
+    """
+    size = int(args[0]) * 1024 * 1024 if args else 32 * 1024 * 1024
+    print("{:<9} {:>12} {:>12}".format("server", "first MB/s", "later MB/s"))
+    for name, flags in (("no cache", []), ("cache", ["--cache-memory", "512"])):
+        with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as cwd:
+            user_file = write_user_file(root, root)
+            with open(join(root, "big.txt"), "wb") as f:
+                f.write(text_corpus(size))
+            port = free_port()
+            proc = start_server(port, user_file, *flags)
+            try:
+                client = connect_client(port)
+                client.toggle_compression()
+                client.toggle_encryption()
+                os.chdir(cwd)
+                times = list()
+                for i in range(4):
+                    start = time.perf_counter()
+                    assert client.get(["big.txt"])
+                    times.append(time.perf_counter() - start)
+                later = sum(times[1:]) / len(times[1:])
+                print("{:<9} {:>12.2f} {:>12.2f}".format(name, mbps(size, times[0]), mbps(size, later)))
+                os.chdir(root)
+                client.quit()
+            finally:
+                proc.terminate()
+                proc.wait()
+    return 0
+
+def bench_smallfiles(args):
+    """
+    Mirror a tree of many tiny files to the server and back
+    with and without batching, with compression off and on,
+    and report the files per second. The number of files 
+    and their size in bytes can be given as arguments.
+    """
+    count = int(args[0]) if args else 10000
+    size = int(args[1]) if len(args) > 1 else 200
+    print("{:<9} {:<6} {:>10} {:>10}".format("compress", "batch", "put/s", "get/s"))
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as cwd:
+        user_file = write_user_file(root, root)
+        tree = join(cwd, "tree")
+        for i in range(count):
+            if i % 1000 == 0:
+                os.makedirs(join(tree, str(i // 1000)))
+            with open(join(tree, str(i // 1000), "{}.txt".format(i)), "wb") as f:
+                f.write(text_corpus(size))
+        port = free_port()
+        proc = start_server(port, user_file)
+        try:
+            client = connect_client(port)
+            os.chdir(cwd)
+            for compression in (False, True):
+                if compression != client.compression:
+                    client.toggle_compression()
+                for batch in (False, True):
+                    if batch != client.batch:
+                        client.toggle_batch()
+                    start = time.perf_counter()
+                    assert client.mirror_put("tree")
+                    put_time = time.perf_counter() - start
+                    shutil.rmtree(tree)
+                    start = time.perf_counter()
+                    assert client.mirror_get("tree")
+                    get_time = time.perf_counter() - start
+                    shutil.rmtree(join(root, "tree"))
+                    print("{:<9} {:<6} {:>10.0f} {:>10.0f}".format(str(compression), str(batch), count / put_time, count / get_time))
+            os.chdir(root)
+            client.quit()
+        finally:
+            proc.terminate()
+            proc.wait()
+    return 0
+
+def delay_proxy(port, delay):
+    """
+    delay_proxy forwards connections on a port of its own to
+    port, holding back the data delay seconds each way like
+    a long link would. Returns the port it listens on.
+    """
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def pump(src, dst):
+        # data is stamped as it comes in and sent once due,
+        # so what is in flight doesn't wait on what's ahead.
+        due = queue.Queue()
+
+        def send():
+            while True:
+                at, data = due.get()
+                time.sleep(max(0, at - time.monotonic()))
+                if not data:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                dst.sendall(data)
+        threading.Thread(target=send, daemon=True).start()
+        while True:
+            data = src.recv(65536)
+            due.put((time.monotonic() + delay, data))
+            if not data:
+                return
+
+    def accept():
+        while True:
+            conn, addr = listener.accept()
+            upstream = socket.create_connection(("127.0.0.1", port))
+            for sock in (conn, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=pump, args=(conn, upstream), daemon=True).start()
+            threading.Thread(target=pump, args=(upstream, conn), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+def bench_requests(args):
+    """
+    Send stat, ls and cd requests one at a time and through 
+    a RequestQueue, over a proxy that adds a round trip time
+    in ms, to the threaded and the asyncio server. Reports 
+    the requests per second. The round trip time and the
+    number of requests can be given as arguments.
+    """
+    rtt = float(args[0]) if args else 20
+    count = int(args[1]) if len(args) > 1 else 200
+    engines = (("threaded", []), ("async", ["--async"]))
+    print("{:<9} {:>12} {:>12}".format("engine", "serial/s", "queued/s"))
+    with tempfile.TemporaryDirectory() as root:
+        user_file = write_user_file(root, root)
+        with open(join(root, "a.txt"), "wb") as f:
+            f.write(text_corpus(1000))
+        for engine, flags in engines:
+            port = free_port()
+            proc = start_server(port, user_file, *flags)
+            try:
+                client = connect_client(delay_proxy(port, rtt / 2000))
+                requests = [(client.stat, ["a.txt"]), (client.ls, "."), (client.cd, root)]
+                start = time.perf_counter()
+                for i in range(count):
+                    method, arg = requests[i % len(requests)]
+                    method(arg)
+                serial = time.perf_counter() - start
+                start = time.perf_counter()
+                with client.request_queue() as q:
+                    for i in range(count):
+                        method, arg = requests[i % len(requests)]
+                        getattr(q, method.__name__)(arg)
+                queued = time.perf_counter() - start
+                print("{:<9} {:>12.0f} {:>12.0f}".format(engine, count / serial, count / queued))
+                client.quit()
+            finally:
+                proc.terminate()
+                proc.wait()
+    return 0
+
+benchmarks = dict()
+benchmarks["cipher"] = bench_cipher
+benchmarks["lzma"] = bench_lzma
+benchmarks["codecs"] = bench_codecs
+benchmarks["adaptive"] = bench_adaptive
+benchmarks["connections"] = bench_connections
+benchmarks["processes"] = bench_processes
+benchmarks["pipeline"] = bench_pipeline
+benchmarks["lanes"] = bench_lanes
+benchmarks["segments"] = bench_segments
+benchmarks["delta"] = bench_delta
+benchmarks["cache"] = bench_cache
+benchmarks["smallfiles"] = bench_smallfiles
+benchmarks["requests"] = bench_requests
+
+if __name__ == '__main__':
+    sys.exit(int(main() or 0))
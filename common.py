@@ -1,11 +1,89 @@
+import os
 import pathlib
 import enum
 import abc
 import lzma
-from os.path import join
+import zlib
+import bz2
+import functools
+import time
+import asyncio
+import collections
+import select
+import hashlib
+import math
+import mmap
+import shutil
+import threading
+import io
+from os.path import join, isfile
+from socket import IPPROTO_TCP, TCP_NODELAY
 
 DEFAULT_USER_FILE = str(pathlib.Path('.', 'data', 'userfile.txt'))
 DEFAULT_FILE_CHUNK_SIZE = 8192
+# Adaptive compression sends a chunk raw unless it shrinks
+# by this ratio, and gives up on a file once a window of 
+# ADAPTIVE_SAMPLE_CHUNKS chunks doesn't reach it.
+ADAPTIVE_MIN_RATIO = 1.05
+ADAPTIVE_SAMPLE_CHUNKS = 8
+# With the large framing the chunk size can be raised 
+# per session, in MiB, up to MAX_CHUNK_SIZE_MIB.
+MAX_CHUNK_SIZE_MIB = 16
+# Initial size of a Connection's receive buffer, it
+# grows to fit the largest message received.
+RECV_BUFFER_SIZE = 256 * 1024
+# Most buffers handed to one sendmsg call, kept well
+# below the usual IOV_MAX of 1024.
+SENDMSG_MAX_BUFFERS = 512
+# A pipelined transfer keeps at most PIPELINE_MAX_CHUNKS 
+# chunks and about PIPELINE_MAX_BYTES of file data in flight.
+PIPELINE_MAX_CHUNKS = 64
+PIPELINE_MAX_BYTES = 8 * 1024 * 1024
+# A resumed transfer hashes the part already there this
+# many bytes at a time.
+RESUME_FINGERPRINT_SIZE = 1024 * 1024
+# Delta transfers cut the receiver's copy into blocks of
+# about the square root of its size, within these bounds.
+DELTA_MIN_BLOCK_SIZE = 2048
+DELTA_MAX_BLOCK_SIZE = 128 * 1024
+# Most block signatures in one Signatures message.
+DELTA_SIGNATURES_PER_MSG = 2048
+# Longest run of literal data in one delta op.
+DELTA_MAX_LITERAL = 64 * 1024
+# After this many bytes without a matching block the delta
+# rolls its checksum over only one block in every 
+# DELTA_SKIP_BLOCKS and checks the others where they start.
+DELTA_ROLL_LIMIT = 256 * 1024
+DELTA_SKIP_BLOCKS = 16
+# Dedup puts cut files into content defined chunks: a chunk
+# ends after a CDC_ANCHOR byte when the crc32 of the 
+# CDC_WINDOW bytes before the cut has the CDC_MASK bits 
+# clear, but not before CDC_MIN_SIZE or after CDC_MAX_SIZE.
+CDC_MIN_SIZE = 16 * 1024
+CDC_MAX_SIZE = 256 * 1024
+CDC_WINDOW = 48
+CDC_MASK = 0x3f
+CDC_ANCHOR = b"\n"
+# Most chunk hashes in one ChunkHashes message.
+DEDUP_HASHES_PER_MSG = 1024
+# With batching on, files of up to BATCH_MAX_FILE_SIZE bytes
+# are sent together in a FileBatch of at most BATCH_MAX_FILES
+# files or about BATCH_MAX_SIZE bytes.
+BATCH_MAX_FILE_SIZE = 64 * 1024
+BATCH_MAX_FILES = 1024
+BATCH_MAX_SIZE = 1024 * 1024
+# Most bytes of entries in one Manifest message, so it 
+# fits a V1 frame.
+MANIFEST_MSG_SIZE = 48 * 1024
+# A FileIndex log is rewritten once it has this many times
+# more records than the index has entries.
+INDEX_COMPACT_RATIO = 4
+# Files changed this recently may change again without
+# their mtime moving, they are hashed again next time.
+INDEX_RACY_SECONDS = 1
+# Size of the BLAKE2b digest an EndOfFileChunks carries
+# with integrity on.
+INTEGRITY_DIGEST_SIZE = 32
 ENCRYPTION_KEY = "ABCDEFGHIJKLMNOPQRSTUVWXYZ" # or a random string
 
 DEBUG = True
@@ -21,22 +99,85 @@ class UnknownMsgTypeException(Exception):
     def __init__(self, code):
         self.code = code 
 
+class FrameTooLargeException(Exception):
+    def __init__(self, size):
+        self.size = size
+
 class ErrorCodes(enum.IntEnum):
     # Fatal Errors 10-19 (server will close connection)
     FailedAuthentication = 10
     UnknownRequest = 11
     ConnectionClosed = 12
+    ServerBusy = 13
 
     UnknownSetting = 20
     BadCDPath = 21
     NotExists = 23
     PutFilesFailed = 23
+    UnsupportedCodec = 24
+    BadChunkSize = 25
+    BadRange = 26
+    ResumeMismatch = 27
+    DeltaFailed = 28
+    NoChunkStore = 29
 
 def is_fatal_error(code):
     if code < 20:
         return True
     return False
 
+class FramingVersion(enum.IntEnum):
+    # 1 byte id, 2 byte msg len
+    V1 = 1
+    # 1 byte id, 4 byte msg len
+    V2 = 2
+    # 1 byte id, 2 byte stream id, 4 byte msg len
+    V3 = 3
+
+def negotiate_framing(offered, supported=max(FramingVersion)):
+    """
+    negotiate_framing returns the highest FramingVersion
+    up to supported that is not above what the peer offered.
+    """
+    for version in sorted(FramingVersion, reverse=True):
+        if version <= offered and version <= supported:
+            return version
+    return FramingVersion.V1
+
+# Size in bytes of the msg len field for each framing.
+framing_len_size = dict()
+framing_len_size[FramingVersion.V1] = 2
+framing_len_size[FramingVersion.V2] = 4
+framing_len_size[FramingVersion.V3] = 4
+
+# Size in bytes of the stream id field for each framing,
+# without one every message is on stream 0.
+framing_stream_size = dict()
+framing_stream_size[FramingVersion.V1] = 0
+framing_stream_size[FramingVersion.V2] = 0
+framing_stream_size[FramingVersion.V3] = 2
+
+class CodecType(enum.IntEnum):
+    # LZMA in an XZ container at the default preset
+    # is what every peer understands.
+    LZMA = 0
+    ZLIB1 = 1
+    ZLIB2 = 2
+    ZLIB3 = 3
+    ZLIB4 = 4
+    ZLIB5 = 5
+    ZLIB6 = 6
+    ZLIB7 = 7
+    ZLIB8 = 8
+    ZLIB9 = 9
+    BZ2 = 10
+    # Raw LZMA2 streams without the XZ container
+    # at the fast presets.
+    LZMA2_0 = 11
+    LZMA2_1 = 12
+    LZMA2_2 = 13
+    LZMA2_3 = 14
+
 class MsgType(enum.IntEnum):
     # Normal command message types
     ClientHello = 1
@@ -62,6 +203,40 @@ class MsgType(enum.IntEnum):
     FileChunk = 17
     EndOfFileChunks = 18
     EndOfFiles = 19
+    RawFileChunk = 20
+    SizedFile = 21
+
+    # File sizes, for balancing parallel transfers
+    StatRequest = 22
+    StatResponse = 23
+
+    # Part of a file
+    RangeGetRequest = 24
+
+    # Resumed transfers
+    ResumeGetRequest = 25
+    ResumePutRequest = 26
+
+    # Delta transfers
+    DeltaGetRequest = 27
+    DeltaPutRequest = 28
+    Signatures = 29
+
+    # Dedup puts
+    DedupPutRequest = 30
+    ChunkHashes = 31
+    MissingChunks = 32
+
+    # Mirrored directory trees
+    MirrorGetRequest = 33
+    MirrorPutRequest = 34
+
+    # Small files sent together
+    FileBatch = 35
+
+    # Incremental sync
+    SyncRequest = 36
+    Manifest = 37
 
 class Message(metaclass=abc.ABCMeta):
     """
@@ -69,7 +244,12 @@ class Message(metaclass=abc.ABCMeta):
     Each message should know how to encode itself
     to a byte array, and decode a byte array and
     update itself.
+
+    stream is the id of the stream the message is sent 
+    or was received on, only V3 framing carries it.
     """
+    stream = 0
+
     @abc.abstractmethod
     def id(self):
         """
@@ -92,27 +272,37 @@ class Message(metaclass=abc.ABCMeta):
         and set the appropriate member variables.
         Should not worry about decoding the MsgType id or 
         the msg len value from data, those will be stripped off.
+        data may be a memoryview into a Connection's receive
+        buffer that is only valid until the next recvmsg, so 
+        anything kept past that has to be copied.
         """
 
 class ClientHello(Message):
     """
-    ClientHello Message.
+    ClientHello Message. The highest framing version 
+    the client supports is appended after the password,
+    then whether it can check files against a digest.
+    Older clients don't send them and only speak V1.
     """
-    def __init__(self, username="",password=""):
+    def __init__(self, username="",password="", framing=FramingVersion.V1, integrity=False):
         self.username = username
         self.password = password
+        self.framing = framing
+        self.integrity = integrity
 
     def id(self):
         return MsgType.ClientHello
     
     def encode(self):
-        userlen = len(self.username)
-        passlen = len(self.password)
+        username = self.username.encode("utf-8")
+        password = self.password.encode("utf-8")
         frame = bytearray()
-        frame.extend(userlen.to_bytes(1, byteorder="big"))
-        frame.extend(passlen.to_bytes(1, byteorder="big"))
-        frame.extend(self.username.encode("utf-8"))
-        frame.extend(self.password.encode("utf-8"))
+        frame.extend(len(username).to_bytes(1, byteorder="big"))
+        frame.extend(len(password).to_bytes(1, byteorder="big"))
+        frame.extend(username)
+        frame.extend(password)
+        frame.extend(int(self.framing).to_bytes(1, byteorder="big"))
+        frame.extend(int(self.integrity).to_bytes(1, byteorder="big"))
         return bytes(frame)
     
     def decode(self, data):
@@ -120,18 +310,34 @@ class ClientHello(Message):
         passlen = data[1]
         useroff = 2
         passoff = useroff + userlen
-        self.username = data[useroff:passoff].decode("utf-8")
-        self.password = data[passoff:passoff+passlen].decode("utf-8")
+        self.username = str(data[useroff:passoff], "utf-8")
+        self.password = str(data[passoff:passoff+passlen], "utf-8")
+        self.framing = FramingVersion.V1
+        self.integrity = False
+        if len(data) > passoff + passlen:
+            self.framing = data[passoff+passlen]
+        if len(data) > passoff + passlen + 1:
+            self.integrity = bool(data[passoff+passlen+1])
 
 
 class ServerHello(Message):
     """
-    ServerHello Message.
+    ServerHello Message. The list of codecs the server 
+    supports, the framing version used for the rest of
+    the connection and whether files are checked against
+    a digest are appended after the settings. Servers that
+    predate them don't send them and only support LZMA, 
+    V1 framing and no digests.
     """
-    def __init__(self, binary=True, compression=False, encryption=False):
+    def __init__(self, binary=True, compression=False, encryption=False, codecs=None, framing=FramingVersion.V1, integrity=False):
         self.binary = binary 
         self.compression = compression 
         self.encryption = encryption
+        if codecs is None:
+            codecs = [CodecType.LZMA]
+        self.codecs = codecs
+        self.framing = framing
+        self.integrity = integrity
 
     def id(self):
         return MsgType.ServerHello
@@ -141,12 +347,27 @@ class ServerHello(Message):
         frame.extend(int(self.binary).to_bytes(1, byteorder="big"))
         frame.extend(int(self.compression).to_bytes(1, byteorder="big"))
         frame.extend(int(self.encryption).to_bytes(1, byteorder="big"))
+        frame.extend(len(self.codecs).to_bytes(1, byteorder="big"))
+        for codec in self.codecs:
+            frame.extend(int(codec).to_bytes(1, byteorder="big"))
+        frame.extend(int(self.framing).to_bytes(1, byteorder="big"))
+        frame.extend(int(self.integrity).to_bytes(1, byteorder="big"))
         return bytes(frame) 
     
     def decode(self, data):
         self.binary = bool(data[0])
         self.compression = bool(data[1])
         self.encryption = bool(data[2])
+        self.codecs = [CodecType.LZMA]
+        self.framing = FramingVersion.V1
+        self.integrity = False
+        if len(data) > 3:
+            num_codecs = data[3]
+            self.codecs = [CodecType(c) for c in data[4:4+num_codecs] if c in compression_codecs]
+            if len(data) > 4 + num_codecs:
+                self.framing = FramingVersion(data[4+num_codecs])
+            if len(data) > 5 + num_codecs:
+                self.integrity = bool(data[5+num_codecs])
 
 class QuitRequest(Message):
     """
@@ -208,7 +429,7 @@ class LSRequest(Message):
         return bytes(frame)
     
     def decode(self, data):
-        self.path = data.decode("utf-8")   
+        self.path = str(data, "utf-8")   
 
 class LSResponse(Message):
     """
@@ -237,8 +458,8 @@ class LSResponse(Message):
     def decode(self, data):
         folders_len = int.from_bytes(data[0:4], byteorder="big")
         files_len = int.from_bytes(data[4:8], byteorder="big")
-        folders_str = data[8:8+folders_len].decode("utf-8")
-        files_str = data[8+folders_len:8+folders_len+files_len].decode("utf-8")
+        folders_str = str(data[8:8+folders_len], "utf-8")
+        files_str = str(data[8+folders_len:8+folders_len+files_len], "utf-8")
         self.folders = folders_str.split(";")
         self.files = files_str.split(";")
 
@@ -258,7 +479,7 @@ class CDRequest(Message):
         return bytes(frame) 
     
     def decode(self, data):
-        self.path = data.decode("utf-8") 
+        self.path = str(data, "utf-8") 
 
 class CDResponse(Message):
     """
@@ -294,9 +515,358 @@ class GetRequest(Message):
     def decode(self, data):
         file_str_len = int.from_bytes(data[0:2], byteorder="big")
         file_str = data[2:2+file_str_len]
-        self.filenames = file_str.decode('utf-8').split(";")
+        self.filenames = str(file_str, "utf-8").split(";")
         return 
 
+class StatRequest(GetRequest):
+    """
+    StatRequest Message. Same as a GetRequest, asks 
+    for the sizes of the files instead.
+    """
+    def id(self):
+        return MsgType.StatRequest
+
+class StatResponse(Message):
+    """
+    StatResponse Message. The sizes of the files in
+    the StatRequest, in the same order.
+    """
+    def __init__(self, sizes=None):
+        self.sizes = sizes
+
+    def id(self):
+        return MsgType.StatResponse
+
+    def encode(self):
+        frame = bytearray()
+        frame.extend(len(self.sizes).to_bytes(2, byteorder="big"))
+        for size in self.sizes:
+            frame.extend(size.to_bytes(8, byteorder="big"))
+        return bytes(frame)
+
+    def decode(self, data):
+        count = int.from_bytes(data[0:2], byteorder="big")
+        self.sizes = list()
+        for i in range(count):
+            start = 2 + 8 * i
+            self.sizes.append(int.from_bytes(data[start:start+8], byteorder="big"))
+
+class RangeGetRequest(Message):
+    """
+    RangeGetRequest Message. Asks for length bytes of a
+    file from offset on, answered like a GetRequest for 
+    that one file with only those bytes in it.
+    """
+    def __init__(self, filename=None, offset=0, length=0):
+        self.filename = filename
+        self.offset = offset
+        self.length = length
+
+    def id(self):
+        return MsgType.RangeGetRequest
+
+    def encode(self):
+        frame = bytearray()
+        frame.extend(self.offset.to_bytes(8, byteorder="big"))
+        frame.extend(self.length.to_bytes(8, byteorder="big"))
+        frame.extend(self.filename.encode("utf-8"))
+        return bytes(frame)
+
+    def decode(self, data):
+        self.offset = int.from_bytes(data[0:8], byteorder="big")
+        self.length = int.from_bytes(data[8:16], byteorder="big")
+        self.filename = str(data[16:], "utf-8")
+
+class ResumeGetRequest(Message):
+    """
+    ResumeGetRequest Message. Asks for the rest of a file 
+    from offset on. fingerprint is the resume_fingerprint
+    of the part the client already has, the server only
+    sends the rest if its copy has the same one.
+    """
+    def __init__(self, filename=None, offset=0, fingerprint=bytes(32)):
+        self.filename = filename
+        self.offset = offset
+        self.fingerprint = fingerprint
+
+    def id(self):
+        return MsgType.ResumeGetRequest
+
+    def encode(self):
+        frame = bytearray()
+        frame.extend(self.offset.to_bytes(8, byteorder="big"))
+        frame.extend(self.fingerprint)
+        frame.extend(self.filename.encode("utf-8"))
+        return bytes(frame)
+
+    def decode(self, data):
+        self.offset = int.from_bytes(data[0:8], byteorder="big")
+        self.fingerprint = bytes(data[8:40])
+        self.filename = str(data[40:], "utf-8")
+
+class ResumePutRequest(ResumeGetRequest):
+    """
+    ResumePutRequest Message. Same as a ResumeGetRequest,
+    followed by the rest of the file like a PutRequest 
+    for that one file.
+    """
+    def id(self):
+        return MsgType.ResumePutRequest
+
+class DeltaGetRequest(Message):
+    """
+    DeltaGetRequest Message. Asks for a file as a delta 
+    against the client's copy, whose Signatures follow.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+
+    def id(self):
+        return MsgType.DeltaGetRequest
+
+    def encode(self):
+        return self.filename.encode("utf-8")
+
+    def decode(self, data):
+        self.filename = str(data, "utf-8")
+
+class DeltaPutRequest(DeltaGetRequest):
+    """
+    DeltaPutRequest Message. Same as a DeltaGetRequest, 
+    the server answers with the Signatures of its copy and
+    the client sends the delta like a PutRequest for that
+    one file.
+    """
+    def id(self):
+        return MsgType.DeltaPutRequest
+
+class Signatures(Message):
+    """
+    Signatures Message. The (adler32, blake2b) checksums of
+    some of the block_size blocks of a file of size bytes,
+    in order. As many follow each other as it takes to 
+    hold all the blocks.
+    """
+    def __init__(self, block_size=DELTA_MIN_BLOCK_SIZE, size=0, sigs=None):
+        self.block_size = block_size
+        self.size = size
+        self.sigs = sigs or list()
+
+    def id(self):
+        return MsgType.Signatures
+
+    def num_blocks(self):
+        return -(-self.size // self.block_size)
+
+    def encode(self):
+        frame = bytearray()
+        frame.extend(self.block_size.to_bytes(4, byteorder="big"))
+        frame.extend(self.size.to_bytes(8, byteorder="big"))
+        for weak, strong in self.sigs:
+            frame.extend(weak.to_bytes(4, byteorder="big"))
+            frame.extend(strong)
+        return bytes(frame)
+
+    def decode(self, data):
+        self.block_size = int.from_bytes(data[0:4], byteorder="big")
+        self.size = int.from_bytes(data[4:12], byteorder="big")
+        self.sigs = list()
+        for start in range(12, len(data), 20):
+            weak = int.from_bytes(data[start:start+4], byteorder="big")
+            self.sigs.append((weak, bytes(data[start+4:start+20])))
+
+class DedupPutRequest(DeltaGetRequest):
+    """
+    DedupPutRequest Message. Puts a file through the 
+    server's chunk store, the ChunkHashes of the file 
+    follow and the server answers with MissingChunks for 
+    each of them. Then the client sends the missing chunks
+    one after the other as the contents of the file, like
+    a PutRequest for that one file.
+    """
+    def id(self):
+        return MsgType.DedupPutRequest
+
+class MirrorGetRequest(DeltaGetRequest):
+    """
+    MirrorGetRequest Message. Asks for every file in the 
+    tree under a directory, answered with a GetResponse 
+    for 0 files and then the files with their paths in the
+    tree, as many as there are until EndOfFiles.
+    """
+    def id(self):
+        return MsgType.MirrorGetRequest
+
+class MirrorPutRequest(DeltaGetRequest):
+    """
+    MirrorPutRequest Message. Puts a tree of files under
+    a directory, the files follow with their paths in the
+    tree until EndOfFiles like for a MirrorGetRequest.
+    """
+    def id(self):
+        return MsgType.MirrorPutRequest
+
+class FileBatch(Message):
+    """
+    FileBatch Message. Takes the place of count File 
+    messages, its FileChunks carry the name and contents of
+    each of the files one after the other.
+    """
+    def __init__(self, count=0):
+        self.count = count
+
+    def id(self):
+        return MsgType.FileBatch
+
+    def encode(self):
+        return self.count.to_bytes(2, byteorder="big")
+
+    def decode(self, data):
+        self.count = int.from_bytes(data[0:2], byteorder="big")
+
+class SyncRequest(Message):
+    """
+    SyncRequest Message. Asks for the Manifest of the tree
+    under path, only what changed since generation if epoch
+    is the server's index and path leads to the tree root
+    of the Manifest that generation came with.
+    """
+    def __init__(self, path=None, epoch=0, generation=0, root=""):
+        self.path = path
+        self.epoch = epoch
+        self.generation = generation
+        self.root = root
+
+    def id(self):
+        return MsgType.SyncRequest
+
+    def encode(self):
+        frame = bytearray()
+        frame.extend(self.epoch.to_bytes(8, byteorder="big"))
+        frame.extend(self.generation.to_bytes(8, byteorder="big"))
+        root = self.root.encode("utf-8")
+        frame.extend(len(root).to_bytes(2, byteorder="big"))
+        frame.extend(root)
+        frame.extend(self.path.encode("utf-8"))
+        return bytes(frame)
+
+    def decode(self, data):
+        self.epoch = int.from_bytes(data[0:8], byteorder="big")
+        self.generation = int.from_bytes(data[8:16], byteorder="big")
+        end = 18 + int.from_bytes(data[16:18], byteorder="big")
+        self.root = str(data[18:end], "utf-8")
+        self.path = str(data[end:], "utf-8")
+
+class Manifest(Message):
+    """
+    Manifest Message. The (path, size, sha256) of some of 
+    count entries of the tree at root, its path from the 
+    user's root on the server, a size of None for a file 
+    that was removed. With full set they are all the files
+    in the tree, otherwise the changes since the generation
+    asked for. As many follow each other as it takes to 
+    hold all the entries.
+    """
+    REMOVED = 0xffffffffffffffff
+
+    def __init__(self, epoch=0, generation=0, full=True, count=0, entries=None, root=""):
+        self.epoch = epoch
+        self.generation = generation
+        self.full = full
+        self.count = count
+        self.entries = entries or list()
+        self.root = root
+
+    def id(self):
+        return MsgType.Manifest
+
+    def encode(self):
+        frame = bytearray()
+        frame.extend(self.epoch.to_bytes(8, byteorder="big"))
+        frame.extend(self.generation.to_bytes(8, byteorder="big"))
+        frame.extend(bytes([self.full]))
+        frame.extend(self.count.to_bytes(4, byteorder="big"))
+        root = self.root.encode("utf-8")
+        frame.extend(len(root).to_bytes(2, byteorder="big"))
+        frame.extend(root)
+        for path, size, digest in self.entries:
+            path = path.encode("utf-8")
+            frame.extend(len(path).to_bytes(2, byteorder="big"))
+            frame.extend(path)
+            frame.extend((self.REMOVED if size is None else size).to_bytes(8, byteorder="big"))
+            frame.extend(digest or bytes(32))
+        return bytes(frame)
+
+    def decode(self, data):
+        self.epoch = int.from_bytes(data[0:8], byteorder="big")
+        self.generation = int.from_bytes(data[8:16], byteorder="big")
+        self.full = bool(data[16])
+        self.count = int.from_bytes(data[17:21], byteorder="big")
+        start = 23 + int.from_bytes(data[21:23], byteorder="big")
+        self.root = str(data[23:start], "utf-8")
+        self.entries = list()
+        while start < len(data):
+            end = start + 2 + int.from_bytes(data[start:start+2], byteorder="big")
+            path = str(data[start+2:end], "utf-8")
+            size = int.from_bytes(data[end:end+8], byteorder="big")
+            digest = bytes(data[end+8:end+40])
+            if size == self.REMOVED:
+                size, digest = None, None
+            self.entries.append((path, size, digest))
+            start = end + 40
+
+class ChunkHashes(Message):
+    """
+    ChunkHashes Message. The (sha256, length) of some of 
+    the chunks of a file of size bytes, in order. As many
+    follow each other as it takes to hold all the chunks.
+    """
+    def __init__(self, size=0, chunks=None):
+        self.size = size
+        self.chunks = chunks or list()
+
+    def id(self):
+        return MsgType.ChunkHashes
+
+    def encode(self):
+        frame = bytearray()
+        frame.extend(self.size.to_bytes(8, byteorder="big"))
+        for digest, length in self.chunks:
+            frame.extend(digest)
+            frame.extend(length.to_bytes(4, byteorder="big"))
+        return bytes(frame)
+
+    def decode(self, data):
+        self.size = int.from_bytes(data[0:8], byteorder="big")
+        self.chunks = list()
+        for start in range(8, len(data), 36):
+            length = int.from_bytes(data[start+32:start+36], byteorder="big")
+            self.chunks.append((bytes(data[start:start+32]), length))
+
+class MissingChunks(Message):
+    """
+    MissingChunks Message. A bitmap with a bit set for
+    every chunk of a ChunkHashes message the server 
+    doesn't have.
+    """
+    def __init__(self, missing=()):
+        self.bitmap = bytearray((len(missing) + 7) // 8)
+        for i, bit in enumerate(missing):
+            if bit:
+                self.bitmap[i // 8] |= 0x80 >> (i % 8)
+
+    def id(self):
+        return MsgType.MissingChunks
+
+    def is_missing(self, i):
+        return i // 8 < len(self.bitmap) and bool(self.bitmap[i // 8] & (0x80 >> (i % 8)))
+
+    def encode(self):
+        return bytes(self.bitmap)
+
+    def decode(self, data):
+        self.bitmap = bytearray(data)
+
 class GetResponse(Message):
     """
     GetResponse Message.
@@ -350,7 +920,8 @@ class PutResponse(Message):
 
 class ChangeSettingsRequest(Message):
     """
-    ChangeSettingsRequest Message.
+    ChangeSettingsRequest Message. The value is a single 
+    byte, On/Off for the toggles or a CodecType for codec.
     """
     def __init__(self, setting="", value=False):
         self.setting = setting
@@ -370,8 +941,8 @@ class ChangeSettingsRequest(Message):
     
     def decode(self, data):
         settings_str_len = int(data[0])
-        self.setting = data[1:1+settings_str_len].decode("utf-8")
-        self.value = bool(data[-1])
+        self.setting = str(data[1:1+settings_str_len], "utf-8")
+        self.value = data[-1]
 
 
 class ChangeSettingsResponse(Message):
@@ -398,21 +969,46 @@ class File(Message):
         return MsgType.File
 
     def encode(self):
-        filename_len = len(self.filename)
+        filename = self.filename.encode("utf-8")
 
         frame = bytearray()
-        frame.extend(filename_len.to_bytes(1, byteorder="big"))
-        frame.extend(self.filename.encode("utf-8"))
+        frame.extend(len(filename).to_bytes(1, byteorder="big"))
+        frame.extend(filename)
         return bytes(frame)
     
     def decode(self, data):
         filename_len = int.from_bytes(data[0:1], byteorder="big")
-        self.filename = data[1:1+filename_len].decode("utf-8")
+        self.filename = str(data[1:1+filename_len], "utf-8")
         return
 
+class SizedFile(File):
+    """
+    SizedFile Message. Like File but carries the file 
+    size, and is followed by exactly size bytes of raw 
+    file data instead of FileChunk messages.
+    """
+    def __init__(self, filename=None, size=0):
+        self.filename = filename
+        self.size = size
+
+    def id(self):
+        return MsgType.SizedFile
+
+    def encode(self):
+        frame = bytearray()
+        frame.extend(super().encode())
+        frame.extend(self.size.to_bytes(8, byteorder="big"))
+        return bytes(frame)
+
+    def decode(self, data):
+        super().decode(data)
+        filename_len = data[0]
+        self.size = int.from_bytes(data[1+filename_len:9+filename_len], byteorder="big")
+
 class FileChunk(Message):
     """
-    FileChunk Message.
+    FileChunk Message. When received from a Connection
+    data is a memoryview into its receive buffer.
     """
     def __init__(self, data=None):
         self.data = data
@@ -421,25 +1017,37 @@ class FileChunk(Message):
         return MsgType.FileChunk
 
     def encode(self):
-        frame = bytearray()
-        frame.extend(self.data)
-        return bytes(frame)
+        # no copy, the Connection sends the header 
+        # and the data as separate buffers.
+        return self.data
     
     def decode(self, data):
         self.data = data
 
+class RawFileChunk(FileChunk):
+    """
+    RawFileChunk Message. Same as a FileChunk but its
+    data was not compressed, only sent by adaptive senders.
+    """
+    def id(self):
+        return MsgType.RawFileChunk
+
 class EndOfFileChunks(Message):
     """
-    EndOfFileChunks Message.
+    EndOfFileChunks Message. With integrity on digest is
+    the new_digest of the file's data, otherwise None.
     """
+    def __init__(self, digest=None):
+        self.digest = digest or None
+
     def id(self):
         return MsgType.EndOfFileChunks
 
     def encode(self):
-        return bytes() 
+        return self.digest or bytes() 
     
     def decode(self, data):
-        pass
+        self.digest = bytes(data) or None
 
 class EndOfFiles(Message):
     """
@@ -475,8 +1083,26 @@ messages[MsgType.File] = File
 messages[MsgType.FileChunk] = FileChunk
 messages[MsgType.EndOfFileChunks] = EndOfFileChunks
 messages[MsgType.EndOfFiles] = EndOfFiles
-
-def recvmsg(socket):
+messages[MsgType.RawFileChunk] = RawFileChunk
+messages[MsgType.SizedFile] = SizedFile
+messages[MsgType.StatRequest] = StatRequest
+messages[MsgType.StatResponse] = StatResponse
+messages[MsgType.RangeGetRequest] = RangeGetRequest
+messages[MsgType.ResumeGetRequest] = ResumeGetRequest
+messages[MsgType.ResumePutRequest] = ResumePutRequest
+messages[MsgType.DeltaGetRequest] = DeltaGetRequest
+messages[MsgType.DeltaPutRequest] = DeltaPutRequest
+messages[MsgType.Signatures] = Signatures
+messages[MsgType.DedupPutRequest] = DedupPutRequest
+messages[MsgType.ChunkHashes] = ChunkHashes
+messages[MsgType.MissingChunks] = MissingChunks
+messages[MsgType.MirrorGetRequest] = MirrorGetRequest
+messages[MsgType.MirrorPutRequest] = MirrorPutRequest
+messages[MsgType.FileBatch] = FileBatch
+messages[MsgType.SyncRequest] = SyncRequest
+messages[MsgType.Manifest] = Manifest
+
+def recvmsg(socket, framing=FramingVersion.V1):
     """
     recvmsg will read an effteepee protocol message
     from the socket. it will return a tuple 
@@ -484,28 +1110,55 @@ def recvmsg(socket):
     and msg is a structure matching the MsgType. 
     """
     # recv the id 
-    # recv the 2-byte msg len. 
+    # recv the 2 or 4-byte msg len depending on framing. 
     # read msg len bytes from the socket. 
     # pass data to parse method to return structure. 
     msgid = recvid(socket)
     if not msgid in messages:
         raise UnknownMsgTypeException(msgid)
-    msglen = int.from_bytes(recvall(socket, 2), byteorder="big")
+    stream = int.from_bytes(recvall(socket, framing_stream_size[framing]), byteorder="big")
+    msglen = int.from_bytes(recvall(socket, framing_len_size[framing]), byteorder="big")
     data = recvall(socket, msglen)
     msgtype = messages[msgid]
     msg = msgtype()
     msg.decode(data)
+    msg.stream = stream
     return (msgid, msg)
 
-def wrap_in_id_length(msgid, data):
-    msglen = len(data)
+def wrap_in_id_length(msgid, data, framing=FramingVersion.V1, stream=0):
     frame = bytearray()
-    frame.extend(int(msgid).to_bytes(1, byteorder="big"))
-    frame.extend((msglen).to_bytes(2, byteorder="big"))
+    frame.extend(frame_header(msgid, len(data), framing, stream))
     frame.extend(data)
     return bytes(frame)
 
-def sendmsg(socket, msg):
+def frame_header(msgid, msglen, framing=FramingVersion.V1, stream=0):
+    """
+    frame_header returns the id, stream id and msg len 
+    bytes that go in front of a message's data.
+    """
+    len_size = framing_len_size[framing]
+    if msglen >= 1 << (8 * len_size):
+        raise FrameTooLargeException(msglen)
+    header = int(msgid).to_bytes(1, byteorder="big")
+    header += stream.to_bytes(framing_stream_size[framing], byteorder="big")
+    return header + msglen.to_bytes(len_size, byteorder="big")
+
+def frame_header_size(framing):
+    return 1 + framing_stream_size[framing] + framing_len_size[framing]
+
+def parse_frame_header(header, framing):
+    """
+    parse_frame_header returns the (msgid, stream, msglen)
+    of a frame header made by frame_header.
+    """
+    if not header[0] in messages:
+        raise UnknownMsgTypeException(header[0])
+    stream_size = framing_stream_size[framing]
+    stream = int.from_bytes(header[1:1+stream_size], byteorder="big")
+    msglen = int.from_bytes(header[1+stream_size:], byteorder="big")
+    return (MsgType(header[0]), stream, msglen)
+
+def sendmsg(socket, msg, framing=FramingVersion.V1):
     """
     sendmsg will send an effteepee protocol message
     on the socket. 
@@ -513,9 +1166,304 @@ def sendmsg(socket, msg):
     if not msg.id() in messages:
         raise UnknownMsgTypeException(msg.id())
     data = msg.encode()
-    data = wrap_in_id_length(msg.id(), data)
+    data = wrap_in_id_length(msg.id(), data, framing, msg.stream)
     socket.sendall(data)
 
+class Connection():
+    """
+    Connection wraps a socket together with the framing
+    version agreed on in the handshake. The hellos are 
+    always sent with V1 framing, everything after the 
+    ServerHello uses the agreed version.
+
+    Received data goes through one reusable buffer that 
+    is filled with recv_into, as much as the socket has 
+    ready, so a burst of small messages costs one syscall.
+    Messages are decoded from memoryviews into the buffer 
+    which are only valid until the next recvmsg.
+
+    Messages are sent as a header and the encoded data 
+    with one scatter/gather sendmsg, so file data is never
+    copied to add the header. Small messages can be queued
+    to go out with the next send, they are flushed before
+    the connection blocks waiting to receive.
+    """
+    def __init__(self, socket, framing=FramingVersion.V1):
+        self.socket = socket
+        # a pipelining client has several small requests out 
+        # at once, and the server several replies, Nagle's 
+        # algorithm would hold each back until an ack.
+        try:
+            socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        except OSError:
+            pass
+        self.framing = framing
+        self.buffer = bytearray(RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.pending = list()
+
+    def sendmsg(self, msg):
+        """
+        sendmsg will send msg along with any queued messages.
+        """
+        self.queue(msg)
+        self.flush()
+
+    def queue(self, msg):
+        """
+        queue will hold on to msg until the next sendmsg,
+        flush or blocking recvmsg.
+        """
+        if not msg.id() in messages:
+            raise UnknownMsgTypeException(msg.id())
+        data = msg.encode()
+        self.pending.append(frame_header(msg.id(), len(data), self.framing, msg.stream))
+        if data:
+            self.pending.append(data)
+
+    def flush(self):
+        """
+        flush will send all queued messages, as few 
+        syscalls as the socket allows.
+        """
+        buffers = self.pending
+        self.pending = list()
+        if not hasattr(self.socket, "sendmsg"):
+            # no scatter/gather on this platform
+            self.socket.sendall(b"".join(buffers))
+            return
+        buffers = [memoryview(b) for b in buffers]
+        while buffers:
+            sent = self.socket.sendmsg(buffers[:SENDMSG_MAX_BUFFERS])
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if sent:
+                buffers[0] = buffers[0][sent:]
+
+    def recvmsg(self):
+        """
+        recvmsg will read the next message from the receive
+        buffer and return a (msgid, msg) tuple like recvmsg.
+        """
+        header = self.read(frame_header_size(self.framing))
+        msgid, stream, msglen = parse_frame_header(header, self.framing)
+        data = self.read(msglen)
+        msg = messages[msgid]()
+        msg.decode(data)
+        msg.stream = stream
+        return (msgid, msg)
+
+    def read(self, n):
+        """
+        read returns a memoryview of the next n bytes. It
+        is only valid until the next read.
+        """
+        if self.end - self.start < n:
+            self._fill(n)
+        data = self.view[self.start:self.start+n]
+        self.start += n
+        return data
+
+    def readable(self):
+        """
+        readable returns True if received data is waiting,
+        in the buffer or on the socket, without blocking.
+        """
+        if self.end > self.start:
+            return True
+        ready, _, _ = select.select([self.socket], [], [], 0)
+        return bool(ready)
+
+    def read_some(self, n):
+        """
+        read_some returns a memoryview of up to n bytes, 
+        only waiting on the socket if nothing is buffered.
+        """
+        if self.end == self.start:
+            self._fill(1)
+        n = min(n, self.end - self.start)
+        return self.read(n)
+
+    def sendfile(self, f, count):
+        """
+        sendfile will send count bytes of the file f 
+        straight from the kernel with socket.sendfile, 
+        after any queued messages.
+        """
+        self.flush()
+        if not count:
+            return
+        sent = self.socket.sendfile(f, f.tell(), count)
+        if sent != count:
+            # the file shrank under us and the other 
+            # side is still waiting on the bytes.
+            raise ConnectionClosedException()
+
+    def _fill(self, n):
+        pending = self.end - self.start
+        if len(self.buffer) < n:
+            # grow into a new buffer, views handed out
+            # earlier keep the old one alive.
+            buffer = bytearray(max(n, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+            self.start, self.end = 0, pending
+        elif len(self.buffer) - self.start < n:
+            # move the pending bytes to the front.
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        if self.pending:
+            # the other side may be waiting on these.
+            self.flush()
+        while self.end - self.start < n:
+            got = self.socket.recv_into(self.view[self.end:])
+            if not got:
+                raise ConnectionClosedException()
+            self.end += got
+
+    def close(self):
+        try:
+            self.flush()
+        except OSError:
+            pass
+        self.socket.close()
+
+class AsyncConnection():
+    """
+    AsyncConnection is the asyncio counterpart of Connection
+    for a StreamReader/StreamWriter pair. Messages are queued
+    the same way and written out by flush(), which waits for
+    the transport to drain. run() hands blocking disk and 
+    codec work to the executor so the event loop stays free.
+    """
+    def __init__(self, reader, writer, framing=FramingVersion.V1, executor=None):
+        self.reader = reader
+        self.writer = writer
+        self.framing = framing
+        self.executor = executor
+        self.pending = list()
+        # read ahead of the message being received, so what
+        # came in after it is known without going through
+        # the StreamReader's internals. reading is the read
+        # that buffered started and didn't wait for.
+        self.buffer = bytearray()
+        self.reading = None
+
+    def queue(self, msg):
+        if not msg.id() in messages:
+            raise UnknownMsgTypeException(msg.id())
+        data = msg.encode()
+        self.pending.append(frame_header(msg.id(), len(data), self.framing, msg.stream))
+        if data:
+            self.pending.append(data)
+
+    async def sendmsg(self, msg):
+        self.queue(msg)
+        await self.flush()
+
+    async def flush(self):
+        if self.pending:
+            self.writer.writelines(self.pending)
+            self.pending = list()
+        await self.writer.drain()
+
+    async def buffered(self):
+        """
+        buffered returns True if the whole next message was
+        already received, so recvmsg won't wait for it.
+        """
+        if not self._has_message():
+            # a read returns straight away with what has come
+            # in, give it one turn of the loop to do that.
+            if self.reading is None:
+                self.reading = asyncio.ensure_future(self.reader.read(RECV_BUFFER_SIZE))
+            await asyncio.sleep(0)
+            if self.reading.done() and not self.reading.exception():
+                data = self.reading.result()
+                if data:
+                    self.reading = None
+                    self.buffer += data
+        return self._has_message()
+
+    def _has_message(self):
+        size = frame_header_size(self.framing)
+        if len(self.buffer) < size:
+            return False
+        msgid, stream, msglen = parse_frame_header(bytes(self.buffer[:size]), self.framing)
+        return len(self.buffer) >= size + msglen
+
+    async def recvmsg(self):
+        header = await self._readexactly(frame_header_size(self.framing))
+        msgid, stream, msglen = parse_frame_header(header, self.framing)
+        data = await self._readexactly(msglen)
+        msg = messages[msgid]()
+        msg.decode(data)
+        msg.stream = stream
+        return (msgid, msg)
+
+    async def read_some(self, n):
+        if not self.buffer:
+            await self._read(n)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def sendfile(self, f, count):
+        await self.flush()
+        if not count:
+            return
+        loop = asyncio.get_running_loop()
+        sent = await loop.sendfile(self.writer.transport, f, f.tell(), count)
+        if sent != count:
+            raise ConnectionClosedException()
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def _readexactly(self, n):
+        while len(self.buffer) < n:
+            await self._read(n - len(self.buffer))
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def _read(self, n):
+        # adds whatever has come in, waiting for some if
+        # nothing has, and at most what n or a buffer holds.
+        reading, self.reading = self.reading, None
+        if reading is None:
+            reading = self.reader.read(max(n, RECV_BUFFER_SIZE))
+        try:
+            data = await reading
+        except ConnectionError:
+            raise ConnectionClosedException()
+        if not data:
+            raise ConnectionClosedException()
+        self.buffer += data
+
+    def close(self):
+        if self.pending:
+            self.writer.writelines(self.pending)
+            self.pending = list()
+        if self.reading is not None:
+            self.reading.cancel()
+            self.reading = None
+        self.writer.close()
+
+def chunk_size_for(mib):
+    """
+    chunk_size_for returns the file chunk size in bytes 
+    for a chunksize setting value. 0 is the default size.
+    """
+    if mib == 0:
+        return DEFAULT_FILE_CHUNK_SIZE
+    return mib * 1024 * 1024
+
 def recvid(socket):
     """
     recvid will receive a message's id 
@@ -539,137 +1487,2279 @@ def recvall(socket, n):
         frame.extend(packet)
     return bytes(frame)
 
-def encode_file_data(data, compression, encryption, key):
+def encode_file_data(data, compression, encryption, key, codec=CodecType.LZMA):
     """
     encode will do the job of 1st encrypting data 
     with key if encryption flag is True. Then will 
-    compress the resulting data if compression is True.
-    Will return the resulting data. If neither is True 
-    then encode is a NOP.
+    compress the resulting data with codec if compression
+    is True. Will return the resulting data. If neither 
+    is True then encode is a NOP.
     """
     if encryption:
         data = encrypt(key, data)
     if compression:
-        data = compress(data)
+        data = compress(data, codec)
     return data
 
-def decode_file_data(data, compression, encryption, key):
+def decode_file_data(data, compression, encryption, key, codec=CodecType.LZMA):
     """
     decode will undo what encode has done. It will
-    first decompress data if compression flag is True.
-    Then will decrypt data with key if encryption flag 
-    is True. Will return the resulting data. If neither
+    first decompress data with codec if compression flag
+    is True. Then will decrypt data with key if encryption
+    flag is True. Will return the resulting data. If neither
     is True then decode is a NOP.
     """
     if compression:
-        data = decompress(data)
+        data = decompress(data, codec)
+    if encryption:
+        data = decrypt(key, data)
+    return data
+
+class Codec():
+    """
+    A Codec bundles the one-shot compress/decompress
+    functions for an algorithm with factories for its
+    streaming compressor and decompressor objects.
+    """
+    def __init__(self, codec_id, name, compress, decompress, compressobj, decompressobj):
+        self.id = codec_id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.compressobj = compressobj
+        self.decompressobj = decompressobj
+
+def xz_codec():
+    return Codec(CodecType.LZMA, "lzma",
+        lambda data: lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32),
+        lambda data: lzma.decompress(data, format=lzma.FORMAT_XZ),
+        lambda: lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32),
+        lambda: lzma.LZMADecompressor(format=lzma.FORMAT_XZ))
+
+def zlib_codec(codec_id, level):
+    return Codec(codec_id, "zlib-{}".format(level),
+        lambda data: zlib.compress(data, level),
+        zlib.decompress,
+        lambda: zlib.compressobj(level),
+        zlib.decompressobj)
+
+def bz2_codec():
+    return Codec(CodecType.BZ2, "bz2",
+        bz2.compress,
+        bz2.decompress,
+        bz2.BZ2Compressor,
+        bz2.BZ2Decompressor)
+
+def lzma2_codec(codec_id, preset):
+    filters = [{"id": lzma.FILTER_LZMA2, "preset": preset}]
+    return Codec(codec_id, "lzma2-{}".format(preset),
+        lambda data: lzma.compress(data, format=lzma.FORMAT_RAW, filters=filters),
+        lambda data: lzma.decompress(data, format=lzma.FORMAT_RAW, filters=filters),
+        lambda: lzma.LZMACompressor(format=lzma.FORMAT_RAW, filters=filters),
+        lambda: lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=filters))
+
+compression_codecs = dict()
+compression_codecs[CodecType.LZMA] = xz_codec()
+for level in range(1, 10):
+    codec_id = CodecType(CodecType.ZLIB1 + level - 1)
+    compression_codecs[codec_id] = zlib_codec(codec_id, level)
+compression_codecs[CodecType.BZ2] = bz2_codec()
+for preset in range(4):
+    codec_id = CodecType(CodecType.LZMA2_0 + preset)
+    compression_codecs[codec_id] = lzma2_codec(codec_id, preset)
+
+def codec_by_name(name):
+    """
+    codec_by_name returns the CodecType for a codec 
+    name like "zlib-1" or None if there isn't one.
+    """
+    for codec in compression_codecs.values():
+        if codec.name == name:
+            return codec.id
+    return None
+
+class FileStats():
+    """
+    FileStats records what sending a single file cost
+    and what compression saved along the way.
+    """
+    def __init__(self):
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.compressed_chunks = 0
+        self.raw_chunks = 0
+        self.cpu_time = 0.0
+
+    def chunks(self):
+        return self.compressed_chunks + self.raw_chunks
+
+    def bytes_saved(self):
+        return self.raw_bytes - self.sent_bytes
+
+    def __str__(self):
+        return "Chunks: {} ({} raw), Size: {}, Saved: {}, CPU: {:.3f}s".format(
+            self.chunks(), self.raw_chunks, self.sent_bytes, self.bytes_saved(), self.cpu_time)
+
+class FileEncoder():
+    """
+    FileEncoder encodes the chunks of a single file into
+    FileChunk messages. In the default mode each chunk is 
+    encrypted and compressed on its own. In streaming mode
+    one compressor for the codec is kept for the whole file
+    and the key stream carries on across chunks, so a single
+    stream is ended by flush().
+
+    In adaptive mode chunks that don't compress by at least
+    ADAPTIVE_MIN_RATIO are sent as RawFileChunk messages, and
+    once a window of ADAPTIVE_SAMPLE_CHUNKS chunks falls below
+    the ratio compression is turned off for the rest of the file.
+    """
+    def __init__(self, compression, encryption, key, streaming=False, codec=CodecType.LZMA, adaptive=False, chunk_size=DEFAULT_FILE_CHUNK_SIZE):
+        self.compression = compression
+        self.encryption = encryption
+        self.key = key
+        self.streaming = streaming
+        self.codec = codec
+        self.adaptive = adaptive
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.compressor = None
+        self.compressing = compression
+        self.window_in = 0
+        self.window_out = 0
+        self.window_chunks = 0
+        self.stats = FileStats()
+
+    def parallel(self):
+        """
+        Returns True if chunks can be encoded out of order
+        with encode_chunk and handed to emit in file order.
+        """
+        return not self.streaming and (self.compression or self.encryption)
+
+    def chunk_args(self, data):
+        """
+        Returns the encode_chunk arguments for the next chunk.
+        """
+        return (data, self.compressing, self.encryption, self.key, self.codec, self.adaptive)
+
+    def encode(self, data):
+        """
+        Returns the list of messages to send for a chunk. 
+        In streaming mode the list may be empty while the 
+        compressor is buffering.
+        """
+        if not self.streaming:
+            return self.emit(*encode_chunk(*self.chunk_args(data)))
+        start = time.thread_time()
+        self.stats.raw_bytes += len(data)
+        if self.encryption:
+            data = encrypt(self.key, data, self.offset)
+        self.offset += len(data)
+        if not self.compressing:
+            msgs = [self._raw_chunk(data)]
+        else:
+            msgs = self._compress_stream(data)
+        self._account(msgs, start)
+        return msgs
+
+    def emit(self, raw_len, data, packed, cpu_time):
+        """
+        Returns the messages for a chunk encode_chunk has
+        done, chunks have to be emitted in file order.
+        """
+        start = time.thread_time()
+        self.stats.raw_bytes += raw_len
+        self.stats.cpu_time += cpu_time
+        if packed is None or not self.compressing:
+            # adaptive mode may have given up on compression
+            # after this chunk was compressed.
+            msgs = [self._raw_chunk(data)]
+        else:
+            msgs = self._pick_chunk(raw_len, data, packed)
+        self._account(msgs, start)
+        return msgs
+
+    def flush(self):
+        """
+        Returns the messages for whatever is still buffered
+        at the end of the file.
+        """
+        start = time.thread_time()
+        msgs = list()
+        if self.compressor and self.compressing:
+            msgs = file_chunks(self.compressor.flush(), FileChunk, self.chunk_size)
+        self._account(msgs, start)
+        return msgs
+
+    def _raw_chunk(self, data):
+        if self.compression:
+            return RawFileChunk(data)
+        return FileChunk(data)
+
+    def _pick_chunk(self, raw_len, data, packed):
+        if not self.adaptive:
+            return [FileChunk(packed)]
+        self._sample(raw_len, len(packed))
+        if len(packed) * ADAPTIVE_MIN_RATIO > raw_len:
+            return [RawFileChunk(data)]
+        return [FileChunk(packed)]
+
+    def _compress_stream(self, data):
+        if self.compressor is None:
+            if self.adaptive:
+                # trial compress the first chunk before
+                # committing to a stream for this file.
+                packed = compress(data, self.codec)
+                if len(packed) * ADAPTIVE_MIN_RATIO > len(data):
+                    self.compressing = False
+                    return [RawFileChunk(data)]
+            self.compressor = compression_codecs[self.codec].compressobj()
+        packed = self.compressor.compress(data)
+        msgs = file_chunks(packed, FileChunk, self.chunk_size)
+        if self.adaptive:
+            self._sample_stream(data)
+            if not self.compressing:
+                # end the stream, everything after this is raw.
+                msgs.extend(file_chunks(self.compressor.flush(), FileChunk, self.chunk_size))
+        return msgs
+
+    def _sample_stream(self, data):
+        # what the stream puts out for a chunk lags behind it,
+        # often by more than a window, so the last chunk of 
+        # each window is trial compressed on its own instead.
+        self.window_chunks += 1
+        if self.window_chunks < ADAPTIVE_SAMPLE_CHUNKS:
+            return
+        self.window_chunks = 0
+        if len(compress(data, self.codec)) * ADAPTIVE_MIN_RATIO > len(data):
+            debug_print("Compression ratio too low, sending the rest of the file raw")
+            self.compressing = False
+
+    def _sample(self, raw_len, packed_len):
+        self.window_in += raw_len
+        self.window_out += packed_len
+        self.window_chunks += 1
+        if self.window_chunks < ADAPTIVE_SAMPLE_CHUNKS:
+            return
+        if self.window_out * ADAPTIVE_MIN_RATIO > self.window_in:
+            debug_print("Compression ratio too low, sending the rest of the file raw")
+            self.compressing = False
+        self.window_in = 0
+        self.window_out = 0
+        self.window_chunks = 0
+
+    def _account(self, msgs, start):
+        for msg in msgs:
+            self.stats.sent_bytes += len(msg.data)
+            if msg.id() == MsgType.RawFileChunk or not self.compression:
+                self.stats.raw_chunks += 1
+            else:
+                self.stats.compressed_chunks += 1
+        self.stats.cpu_time += time.thread_time() - start
+
+class FileDecoder():
+    """
+    FileDecoder undoes what FileEncoder has done for a 
+    single file, message by message.
+    """
+    def __init__(self, compression, encryption, key, streaming=False, codec=CodecType.LZMA):
+        self.compression = compression
+        self.encryption = encryption
+        self.key = key
+        self.streaming = streaming
+        self.codec = codec
+        self.offset = 0
+        self.decompressor = None
+
+    def parallel(self):
+        """
+        Returns True if chunks can be decoded out of order
+        with decode_chunk.
+        """
+        return not self.streaming and (self.compression or self.encryption)
+
+    def chunk_args(self, msg):
+        """
+        Returns the decode_chunk arguments for msg. The data 
+        is copied out of the receive buffer, which is reused
+        before another thread gets to it.
+        """
+        compressed = self.compression and msg.id() == MsgType.FileChunk
+        return (bytes(msg.data), compressed, self.encryption, self.key, self.codec)
+
+    def decode(self, msg):
+        """
+        Returns the file data carried by a FileChunk or
+        RawFileChunk message.
+        """
+        compressed = self.compression and msg.id() == MsgType.FileChunk
+        if not self.streaming:
+            return decode_chunk(msg.data, compressed, self.encryption, self.key, self.codec)
+        data = msg.data
+        if compressed:
+            if self.decompressor is None:
+                self.decompressor = compression_codecs[self.codec].decompressobj()
+            data = self.decompressor.decompress(data)
+        if self.encryption:
+            data = decrypt(self.key, data, self.offset)
+        self.offset += len(data)
+        return data
+
+    def finish(self):
+        """
+        Returns False if the file ended in the middle of
+        a compressed stream.
+        """
+        if self.decompressor:
+            return self.decompressor.eof
+        return True
+
+def encode_chunk(data, compression, encryption, key, codec=CodecType.LZMA, adaptive=False):
+    """
+    encode_chunk encrypts and compresses a chunk in the per
+    chunk mode, where chunks don't depend on each other. 
+    Returns a (raw_len, data, packed, cpu_time) tuple, data
+    is the encrypted chunk and packed the compressed one or
+    None with compression off. Unless adaptive mode may need
+    to fall back on it, data is None when packed isn't.
+    """
+    start = time.thread_time()
+    raw_len = len(data)
+    if encryption:
+        data = encrypt(key, data)
+    packed = None
+    if compression:
+        packed = compress(data, codec)
+        if not adaptive:
+            data = None
+    return (raw_len, data, packed, time.thread_time() - start)
+
+def decode_chunk(data, compressed, encryption, key, codec=CodecType.LZMA):
+    """
+    decode_chunk undoes encode_chunk, compressed is False 
+    for a RawFileChunk.
+    """
+    if compressed:
+        data = decompress(data, codec)
     if encryption:
         data = decrypt(key, data)
     return data
 
+class Pipeline():
+    """
+    Pipeline runs calls on an executor while the caller gets
+    on with sending or receiving, and hands the results back
+    in the order the calls were submitted. At most depth 
+    calls are in flight, submit waits for the oldest call 
+    when there are more.
+    """
+    def __init__(self, executor, depth):
+        self.executor = executor
+        self.depth = max(1, depth)
+        self.futures = collections.deque()
+
+    def submit(self, fn, *args):
+        """
+        Starts fn(*args) and returns the list of results,
+        oldest first, that are done and due next.
+        """
+        self.futures.append(self.executor.submit(fn, *args))
+        results = list()
+        while self.futures and (len(self.futures) > self.depth or self.futures[0].done()):
+            results.append(self.futures.popleft().result())
+        return results
+
+    def drain(self):
+        """
+        Waits for and returns the results of all calls still
+        in flight.
+        """
+        results = [future.result() for future in self.futures]
+        self.futures.clear()
+        return results
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+        self.futures.clear()
+
+def pipeline_depth(chunk_size):
+    return max(2, min(PIPELINE_MAX_CHUNKS, PIPELINE_MAX_BYTES // chunk_size))
+
+def file_chunks(data, msgtype, chunk_size=DEFAULT_FILE_CHUNK_SIZE):
+    """
+    file_chunks will split streamed data into msgtype
+    messages of at most chunk_size bytes.
+    """
+    msgs = list()
+    for i in range(0, len(data), chunk_size):
+        msgs.append(msgtype(data[i:i+chunk_size]))
+    return msgs
+
 # Credit to https://gist.github.com/ilogik/6f9431e4588015ecb194 
 # for the vigenere cipher. Both functions take the plaintext
 # and ciphertext as bytearrays instead of strings. The key is a 
-# string of characters.
-def encrypt(key, plaintext):
-    b = []
-    for i in range(len(plaintext)):
-        k = key[i % len(key)]
-        c = ((plaintext[i] + ord(k)) % 256)
-        b.append(c)
-    return bytes(b)
-
-def decrypt(key, ciphertext):
-    b = []
-    for i in range(len(ciphertext)):
-        k = key[i % len(key)]
-        p = abs((ciphertext[i] - ord(k)) % 256)
-        b.append(p)
-    return bytes(b)
-
-# Compress with LZMA with a 
+# string of characters. The offset is the position in the key
+# stream that the first byte of data lines up with.
+def encrypt(key, plaintext, offset=0):
+    return get_cipher(key).encrypt(plaintext, offset)
+
+def decrypt(key, ciphertext, offset=0):
+    return get_cipher(key).decrypt(ciphertext, offset)
+
+@functools.lru_cache(maxsize=16)
+def get_cipher(key):
+    """
+    get_cipher returns a VigenereCipher for key. Ciphers
+    are cached so the key tables are only built once 
+    per key instead of on every chunk.
+    """
+    return VigenereCipher(key)
+
+class VigenereCipher():
+    """
+    VigenereCipher precomputes a byte translation table 
+    for every character in the key. A chunk is split into
+    len(key) strided slices that all share the same key
+    byte, so each slice can go through bytes.translate 
+    in one call instead of a Python loop per byte.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.keylen = len(key)
+        self.enc_tables = list()
+        self.dec_tables = list()
+        identity = bytes(range(256))
+        for k in key:
+            shift = ord(k) % 256
+            # enc_table[b] == (b + shift) % 256
+            self.enc_tables.append(identity[shift:] + identity[:shift])
+            # dec_table[b] == (b - shift) % 256
+            self.dec_tables.append(identity[256-shift:] + identity[:256-shift])
+
+    def encrypt(self, plaintext, offset=0):
+        return self._translate(plaintext, offset, self.enc_tables)
+
+    def decrypt(self, ciphertext, offset=0):
+        return self._translate(ciphertext, offset, self.dec_tables)
+
+    def _translate(self, data, offset, tables):
+        n = len(data)
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        out = bytearray(n)
+        keylen = self.keylen
+        for i in range(min(keylen, n)):
+            table = tables[(offset + i) % keylen]
+            out[i::keylen] = data[i::keylen].translate(table)
+        return bytes(out)
+
+# Compress with codec, by default LZMA with a 
 # CRC32 checksum to ensure file data 
 # is not corrupted during transfer.
-def compress(data):
-    return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32)
+def compress(data, codec=CodecType.LZMA):
+    return compression_codecs[codec].compress(data)
 
-# Decompress with LZMA with a 
+# Decompress with codec, by default LZMA with a 
 # CRC32 checksum to ensure file data 
 # is not corrupted during transfer.
-def decompress(data):
-    return lzma.decompress(data, format=lzma.FORMAT_XZ)
+def decompress(data, codec=CodecType.LZMA):
+    return compression_codecs[codec].decompress(data)
 
 
-def get_files(socket, cwd, num_files, compression, encryption):
-    # Will read File messages from the socket. 
-    # Reads num_files in the following order:
+def get_files(conn, cwd, num_files, compression, encryption, streaming=False, codec=CodecType.LZMA, chunk_size=DEFAULT_FILE_CHUNK_SIZE, executor=None, progress=None, open_file=None, integrity=False):
+    # Will read File messages from the connection. 
+    # Reads num_files, or as many as come if it is None,
+    # in the following order:
     # File -> FileChunk -> EndOfFileChunks 
     # Will lastly read an EndOfFiles msg to 
     # signal that there are no more files.
-    for i in range(num_files):
-        (rid, msg) = recvmsg(socket)
-        if rid != MsgType.File:
-            return False 
-        filename = join(cwd, msg.filename)
-        f = open(filename, 'wb')
-        while True:
-            (rid, msg) = recvmsg(socket)
-            if rid == MsgType.ErrorResponse:
-                # we got an error from the the other 
-                # side.
-                f.close()
+    # With an executor, chunks that don't depend on 
+    # each other are decoded on it while the next ones
+    # are received. progress is called with the name of 
+    # every file received. open_file and integrity are 
+    # passed on to FilesReceiver.
+    receiver = FilesReceiver(conn, cwd, num_files, compression, encryption, streaming, codec, chunk_size, executor, progress, open_file, integrity)
+    while True:
+        (rid, msg) = conn.recvmsg()
+        done = receiver.receive(rid, msg)
+        if done is not None:
+            return done
+
+class FilesReceiver():
+    """
+    FilesReceiver does the work of get_files one message at
+    a time, so a multiplexed connection can hand it the 
+    messages of its stream as they come in between those
+    of other streams. Files are written to what open_file
+    returns for their path, by default the file opened for
+    writing, unbuffered. With integrity on every file is 
+    checked against the digest in its EndOfFileChunks, one
+    that doesn't match fails the transfer once it is over.
+    """
+    def __init__(self, conn, cwd, num_files, compression, encryption, streaming=False, codec=CodecType.LZMA, chunk_size=DEFAULT_FILE_CHUNK_SIZE, executor=None, progress=None, open_file=None, integrity=False):
+        self.conn = conn
+        self.open_file = open_file or open_for_write
+        self.cwd = cwd
+        self.remaining = num_files
+        self.compression = compression
+        self.encryption = encryption
+        self.streaming = streaming
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.progress = progress
+        self.integrity = integrity
+        self.mismatched = False
+        self.name = None
+        self.f = None
+        self.decoder = None
+        self.pipeline = None
+        self.batch = None
+
+    def receive(self, rid, msg):
+        """
+        Handles the next message of the transfer. Returns 
+        None while more messages are expected, then True if
+        all the files arrived or False if the transfer failed.
+        """
+        try:
+            done = self._receive(rid, msg)
+        except BaseException:
+            self.close()
+            raise
+        if done is not None:
+            self.close()
+        return done
+
+    def close(self):
+        if self.pipeline:
+            self.pipeline.cancel()
+            self.pipeline = None
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def _receive(self, rid, msg):
+        if self.f is None:
+            return self._next_file(rid, msg)
+        if rid == MsgType.ErrorResponse:
+            # we got an error from the the other 
+            # side.
+            return False
+        if rid == MsgType.EndOfFileChunks:
+            # we've read all the file chunks
+            if self.pipeline:
+                for data in self.pipeline.drain():
+                    write_all(self.f, data)
+            f = self.f
+            self.close()
+            if not self.decoder.finish():
+                print("File {} ended in the middle of a compressed stream".format(join(self.cwd, self.name)))
+                return False
+            if self.integrity and not f.check(msg.digest):
+                # the rest of the files still come in.
+                print("File {} doesn't match its digest".format(join(self.cwd, self.name)))
+                remove_written(f)
+                self.mismatched = True
+                self.batch = None
+                return None
+            names = [self.name]
+            if self.batch:
+                if not self.batch.done():
+                    print("Batch of {} files in {} came up short".format(self.batch.count, self.cwd))
+                    return False
+                names = self.batch.names
+                self.batch = None
+            if self.progress:
+                for name in names:
+                    self.progress(name)
+            return None
+        if rid != MsgType.FileChunk and rid != MsgType.RawFileChunk:
+            print("Expected a FileChunk, got {}".format(msg))
+            return False
+        # write chunk data to file
+        if self.pipeline:
+            for data in self.pipeline.submit(decode_chunk, *self.decoder.chunk_args(msg)):
+                write_all(self.f, data)
+        else:
+            decode_chunk_to_file(self.f, self.decoder, msg)
+        return None
+
+    def _next_file(self, rid, msg):
+        if self.remaining is None:
+            # as many files as the sender has.
+            if rid == MsgType.EndOfFiles:
+                return not self.mismatched
+        elif not self.remaining:
+            return rid == MsgType.EndOfFiles and not self.mismatched
+        else:
+            self.remaining -= 1
+        if rid == MsgType.SizedFile:
+            if self.integrity:
+                print("SizedFile {} has no digest".format(join(self.cwd, msg.filename)))
                 return False
-            if rid == MsgType.EndOfFileChunks:
-                # we've read all the file chunks
+            f = self.open_file(join(self.cwd, msg.filename))
+            try:
+                get_sized_file(self.conn, f, msg.size)
+            finally:
                 f.close()
-                break 
-            if rid != MsgType.FileChunk:
-                print("Expected a FileChunk, got {}".format(msg))
+            if self.progress:
+                self.progress(msg.filename)
+            return None
+        if rid == MsgType.FileBatch:
+            if self.remaining is not None:
+                if msg.count - 1 > self.remaining:
+                    return False
+                self.remaining -= msg.count - 1
+            self.name = "batch"
+            self.decoder = FileDecoder(self.compression, self.encryption, ENCRYPTION_KEY, self.streaming, self.codec)
+            self.batch = BatchWriter(self.cwd, msg.count, self.open_file)
+            self.f = DigestWriter(self.batch) if self.integrity else self.batch
+            return None
+        if rid != MsgType.File:
+            return False
+        self.name = msg.filename
+        self.decoder = FileDecoder(self.compression, self.encryption, ENCRYPTION_KEY, self.streaming, self.codec)
+        if self.executor and self.decoder.parallel():
+            self.pipeline = Pipeline(self.executor, pipeline_depth(self.chunk_size))
+        self.f = self.open_file(join(self.cwd, msg.filename))
+        if self.integrity:
+            self.f = DigestWriter(self.f)
+        return None
+
+class BatchWriter():
+    """
+    BatchWriter is written the decoded contents of a 
+    FileBatch in place of a file, and writes out each of 
+    the count files in it once all of its bytes are in, 
+    with a single write. Files are opened with open_file,
+    new ones straight with os.open.
+    """
+    def __init__(self, cwd, count, open_file=None):
+        self.cwd = cwd
+        self.count = count
+        self.open_file = open_file or open_for_write
+        self.buffer = bytearray()
+        self.names = list()
+        # of the files written on disk.
+        self.paths = list()
+
+    def write(self, data):
+        self.buffer += data
+        start = 0
+        while len(self.buffer) - start >= 2:
+            name_end = start + 2 + int.from_bytes(self.buffer[start:start+2], byteorder="big")
+            if len(self.buffer) < name_end + 4:
+                break
+            end = name_end + 4 + int.from_bytes(self.buffer[name_end:name_end+4], byteorder="big")
+            if len(self.buffer) < end:
+                break
+            name = str(self.buffer[start+2:name_end], "utf-8")
+            self._write_file(name, memoryview(self.buffer)[name_end+4:end])
+            start = end
+        del self.buffer[:start]
+        return len(data)
+
+    def _write_file(self, name, data):
+        filename = join(self.cwd, name)
+        if self.open_file is open_for_write:
+            write_small_file(filename, data)
+            self.paths.append(filename)
+        else:
+            f = self.open_file(filename)
+            try:
+                write_all(f, data)
+            finally:
                 f.close()
-                return False
-            # write chunk data to file
-            data = msg.data
-            data = decode_file_data(data, compression, encryption, ENCRYPTION_KEY)
-            f.write(data)
-    (rid, msg) = recvmsg(socket)
-    if rid != MsgType.EndOfFiles:
-        return False 
-    return True
+            self.paths.extend(written_paths(f))
+        self.names.append(name)
+
+    def done(self):
+        return not self.buffer and len(self.names) == self.count
+
+    def close(self):
+        pass
+
+def skip_file(filename, error, skipped):
+    """
+    skip_file leaves filename out of a transfer and adds it
+    to skipped for the error it couldn't be read with, or 
+    raises error if skipped is None.
+    """
+    if skipped is None:
+        raise error
+    print("Skipping {}, {}".format(filename, error.strerror or error))
+    skipped.append(filename)
+
+def write_small_file(filename, data):
+    # most files of a batch are new, those take an open,
+    # a write and a close.
+    try:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        f = open_for_write(filename)
+        try:
+            write_all(f, data)
+        finally:
+            f.close()
+        return
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+def read_small_file(filename):
+    """
+    read_small_file returns the contents of filename if it
+    is small enough for a FileBatch, None if it isn't.
+    """
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        data = os.read(fd, BATCH_MAX_FILE_SIZE + 1)
+    finally:
+        os.close(fd)
+    if len(data) > BATCH_MAX_FILE_SIZE:
+        return None
+    return data
+
+def pack_batch(files):
+    """
+    pack_batch returns the contents of a FileBatch for the
+    (name, data) of files.
+    """
+    frame = bytearray()
+    for name, data in files:
+        name = name.encode("utf-8")
+        frame.extend(len(name).to_bytes(2, byteorder="big"))
+        frame.extend(name)
+        frame.extend(len(data).to_bytes(4, byteorder="big"))
+        frame.extend(data)
+    return frame
+
+def batch_small_files(cwd, filenames, skipped=None):
+    """
+    batch_small_files yields the names in filenames of the
+    files too big for a FileBatch, and lists of the (name,
+    data) of the others, a FileBatch worth at a time, in 
+    the order of filenames. Files that can't be read go to
+    skip_file with skipped.
+    """
+    batch = list()
+    size = 0
+    for filename in filenames:
+        try:
+            data = read_small_file(join(cwd, filename))
+        except OSError as e:
+            skip_file(filename, e, skipped)
+            continue
+        if data is not None:
+            batch.append((filename, data))
+            size += len(data)
+        if batch and (data is None or len(batch) >= BATCH_MAX_FILES or size >= BATCH_MAX_SIZE):
+            yield batch
+            batch = list()
+            size = 0
+        if data is None:
+            yield filename
+    if batch:
+        yield batch
+
+def batch_msgs(files, encoder, chunk_size, integrity=False):
+    """
+    batch_msgs returns the FileBatch of files followed by
+    its chunks and EndOfFileChunks, which with integrity
+    on has the digest of the whole batch.
+    """
+    data = pack_batch(files)
+    msgs = [FileBatch(len(files))]
+    msgs.extend(encode_chunks(io.BytesIO(data), encoder, chunk_size))
+    msgs.append(EndOfFileChunks(new_digest(data).digest() if integrity else None))
+    return msgs
+
+def open_for_write(filename):
+    # a file linked from the server's chunk store is 
+    # replaced rather than overwritten in place.
+    if is_linked(filename):
+        os.unlink(filename)
+    # unbuffered, chunk data goes straight from the
+    # receive buffer to the file.
+    return open(filename, 'wb', buffering=0)
+
+def is_linked(filename):
+    # files of the chunk store are read only, a user's own
+    # hard links are left as they are.
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return False
+    return st.st_nlink > 1 and not st.st_mode & 0o222
+
+def temp_path(filename):
+    """
+    temp_path returns a new hidden name in the directory 
+    of filename, to write a file under that is renamed to
+    filename once it is complete.
+    """
+    head, tail = os.path.split(filename)
+    return join(head, ".{}.{}.tmp".format(tail, os.urandom(4).hex()))
+
+def open_for_resume(filename, offset):
+    # keeps the first offset bytes and writes on from 
+    # there, whatever came after them is cut off. A file 
+    # linked from the chunk store gets a copy of its own.
+    if is_linked(filename):
+        temp = temp_path(filename)
+        shutil.copyfile(filename, temp)
+        os.replace(temp, filename)
+    f = open(filename, 'r+b', buffering=0)
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+def open_for_discard(filename):
+    return open(os.devnull, 'wb', buffering=0)
+
+def resume_fingerprint(f, offset):
+    """
+    resume_fingerprint returns the sha256 digest of offset
+    and the first offset bytes of the file f. Both sides of
+    a resumed transfer compare it to tell that the part 
+    already there belongs to the same file.
+    """
+    f.seek(0)
+    digest = hashlib.sha256(offset.to_bytes(8, byteorder="big"))
+    left = offset
+    while left > 0:
+        data = f.read(min(left, RESUME_FINGERPRINT_SIZE))
+        if not data:
+            break
+        digest.update(data)
+        left -= len(data)
+    return digest.digest()
+
+def walk_files(root, skipped=None):
+    """
+    walk_files yields the paths of the files in the tree
+    under root, relative to it with / between the parts,
+    one directory at a time as os.scandir reads them. 
+    Symlinks to directories aren't followed, and paths too
+    long for a File message are skipped, so are directories
+    that can't be read or are gone by the time they are,
+    those are added to skipped if given.
+    """
+    dirs = [""]
+    while dirs:
+        path = dirs.pop()
+        try:
+            names = list(scan_dir(root, path))
+        except OSError as e:
+            print("Skipping {}, {}".format(path or root, e.strerror))
+            if skipped is not None:
+                skipped.append(path)
+            continue
+        for name in names:
+            if name.endswith("/"):
+                dirs.append(name)
+            elif len(name.encode("utf-8")) > 255:
+                print("Skipping {}, the path is too long".format(name))
+            else:
+                yield name
+
+def scan_dir(root, path):
+    # the files and, ending in /, the directories in path.
+    with os.scandir(join(root, path)) as it:
+        for entry in it:
+            name = path + entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield name + "/"
+                elif entry.is_file():
+                    yield name
+            except OSError:
+                # gone since it was listed.
+                continue
+
+class FileIndex():
+    """
+    FileIndex keeps the size, mtime and sha256 of every file
+    in the tree under root by its path in the tree. refresh
+    stats the files and only hashes the ones whose size or
+    mtime changed, update does the same for files known to
+    have been written. refresh_once only walks a part of the
+    tree the first time, update keeps it current from there 
+    on. Every change gets the next generation
+    so a manifest of the changes since one can be sent. With
+    a path the index is kept there as a log of its changes,
+    loaded on start and rewritten once it is 
+    INDEX_COMPACT_RATIO times bigger than the index. The 
+    epoch is new for every index without a log, generations
+    of different epochs can't be compared. Safe to share 
+    between threads, not between processes with one path.
+    """
+    MAGIC = b"EFTIDX1\n"
 
-def put_files(socket, cwd, filenames, compression, encryption):
-    # Will put File messages on the socket.
+    def __init__(self, root, path=None):
+        self.root = os.path.realpath(root)
+        self.path = path
+        self.epoch = int.from_bytes(os.urandom(8), byteorder="big")
+        # changes up to base were dropped from the log, only
+        # a full manifest is up to date for them.
+        self.base = 0
+        self.generation = 0
+        # path -> (size, mtime_ns, digest, generation), size
+        # None for a removed file.
+        self.entries = dict()
+        self.records = 0
+        self.log = None
+        # prefixes walked by refresh_once.
+        self.refreshed = set()
+        self.lock = threading.Lock()
+        if path:
+            self._load()
+
+    def refresh(self, prefix=""):
+        """
+        Brings the entries of the files under prefix, a path
+        in the tree ending in / or empty for all of it, up to
+        date with the disk.
+        """
+        seen = set()
+        top = join(self.root, prefix)
+        if os.path.isdir(top):
+            for name in walk_files(top):
+                seen.add(prefix + name)
+                self._check(prefix + name)
+        with self.lock:
+            gone = [name for name, entry in self.entries.items() 
+                if name.startswith(prefix) and entry[0] is not None and name not in seen]
+        for name in gone:
+            self._check(name)
+
+    def refresh_once(self, prefix=""):
+        """
+        Refreshes the files under prefix unless they or a 
+        directory above them already were. Changes made to 
+        the tree some other way than through update after 
+        that aren't seen.
+        """
+        with self.lock:
+            if any(prefix.startswith(done) for done in self.refreshed):
+                return
+        self.refresh(prefix)
+        with self.lock:
+            self.refreshed.add(prefix)
+
+    def update(self, filenames):
+        """
+        Brings the entries of filenames up to date, those 
+        outside the tree are left out.
+        """
+        for filename in filenames:
+            name = os.path.relpath(os.path.realpath(filename), self.root)
+            if name == ".." or name.startswith(".." + os.sep):
+                continue
+            self._check(name.replace(os.sep, "/"))
+
+    def files(self, prefix=""):
+        """
+        Returns the (size, digest) of every file under prefix
+        by its path from there.
+        """
+        with self.lock:
+            return {name[len(prefix):]: (entry[0], entry[2]) for name, entry in self.entries.items()
+                if name.startswith(prefix) and entry[0] is not None}
+
+    def changes(self, prefix, epoch, generation):
+        """
+        Returns (full, entries) for the files under prefix, 
+        the (path from there, size, digest) of the changes
+        since generation, or of all the files with full set
+        if the changes aren't known for that epoch and 
+        generation.
+        """
+        with self.lock:
+            full = epoch != self.epoch or generation < self.base or generation > self.generation
+            entries = list()
+            for name, (size, mtime, digest, changed) in self.entries.items():
+                if not name.startswith(prefix):
+                    continue
+                if (full and size is not None) or (not full and changed > generation):
+                    entries.append((name[len(prefix):], size, digest))
+            return full, entries
+
+    def _check(self, name):
+        filename = join(self.root, name)
+        entry = self.entries.get(name)
+        try:
+            st = os.stat(filename)
+            if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                return
+            digest = file_digest(filename)
+        except FileNotFoundError:
+            if entry and entry[0] is not None:
+                self._record(name, None, 0, None)
+            return
+        except OSError:
+            # can't be read, left as it was.
+            return
+        # a racy mtime is left out so the file is hashed 
+        # again next time.
+        mtime = st.st_mtime_ns
+        if time.time_ns() - mtime < INDEX_RACY_SECONDS * 1000000000:
+            mtime = 0
+        self._record(name, st.st_size, mtime, digest, entry and entry[0] == st.st_size and entry[2] == digest)
+
+    def _record(self, name, size, mtime, digest, same=False):
+        with self.lock:
+            if same:
+                # only the mtime moved, not a change.
+                generation = self.entries[name][3]
+            else:
+                self.generation += 1
+                generation = self.generation
+            self.entries[name] = (size, mtime, digest, generation)
+            if self.log:
+                self.log.write(index_record(name, size, mtime, digest, generation))
+                self.log.flush()
+                self.records += 1
+                if self.records > INDEX_COMPACT_RATIO * max(len(self.entries), 1024):
+                    self._compact()
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        if data[:len(self.MAGIC)] != self.MAGIC or len(data) < len(self.MAGIC) + 16:
+            self._compact()
+            return
+        start = len(self.MAGIC)
+        self.epoch = int.from_bytes(data[start:start+8], byteorder="big")
+        self.base = self.generation = int.from_bytes(data[start+8:start+16], byteorder="big")
+        start += 16
+        while start + 2 <= len(data):
+            end = start + 2 + int.from_bytes(data[start:start+2], byteorder="big")
+            if end + 56 > len(data):
+                # cut off in the middle of a record.
+                break
+            name = str(data[start+2:end], "utf-8")
+            size = int.from_bytes(data[end:end+8], byteorder="big")
+            mtime = int.from_bytes(data[end+8:end+16], byteorder="big")
+            generation = int.from_bytes(data[end+48:end+56], byteorder="big")
+            if size == Manifest.REMOVED:
+                self.entries[name] = (None, 0, None, generation)
+            else:
+                self.entries[name] = (size, mtime, data[end+16:end+48], generation)
+            self.generation = max(self.generation, generation)
+            self.records += 1
+            start = end + 56
+        self.log = open(self.path, "r+b")
+        self.log.truncate(start)
+        self.log.seek(start)
+
+    def _compact(self):
+        """
+        Rewrites the log with one record for every file, the
+        removed ones are forgotten.
+        """
+        self.entries = {name: entry for name, entry in self.entries.items() if entry[0] is not None}
+        self.base = self.generation
+        temp = temp_path(self.path)
+        with open(temp, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(self.epoch.to_bytes(8, byteorder="big"))
+            f.write(self.base.to_bytes(8, byteorder="big"))
+            for name, (size, mtime, digest, generation) in self.entries.items():
+                f.write(index_record(name, size, mtime, digest, generation))
+        os.replace(temp, self.path)
+        if self.log:
+            self.log.close()
+        self.log = open(self.path, "ab")
+        self.records = len(self.entries)
+
+def index_record(name, size, mtime, digest, generation):
+    name = name.encode("utf-8")
+    frame = bytearray()
+    frame.extend(len(name).to_bytes(2, byteorder="big"))
+    frame.extend(name)
+    frame.extend((Manifest.REMOVED if size is None else size).to_bytes(8, byteorder="big"))
+    frame.extend(mtime.to_bytes(8, byteorder="big"))
+    frame.extend(digest or bytes(32))
+    frame.extend(generation.to_bytes(8, byteorder="big"))
+    return bytes(frame)
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                return digest.digest()
+            digest.update(data)
+
+def manifest_msgs(index, prefix, epoch, generation):
+    """
+    manifest_msgs returns the Manifest messages that answer
+    a SyncRequest for the tree under prefix of index.
+    """
+    full, entries = index.changes(prefix, epoch, generation)
+    root = prefix.rstrip("/")
+    msgs = list()
+    group = list()
+    size = 0
+    for entry in entries:
+        group.append(entry)
+        size += len(entry[0].encode("utf-8")) + 42
+        if size >= MANIFEST_MSG_SIZE:
+            msgs.append(Manifest(index.epoch, index.generation, full, len(entries), group, root))
+            group = list()
+            size = 0
+    if group or not msgs:
+        msgs.append(Manifest(index.epoch, index.generation, full, len(entries), group, root))
+    return msgs
+
+class TreeWriter():
+    """
+    TreeWriter opens the files of a mirrored tree under 
+    root for writing, making the directories on the way. 
+    It is handed to get_files as open_file. A file that 
+    would end up outside root, or can't be created, is 
+    written nowhere and its path kept in rejected.
+    """
+    def __init__(self, root):
+        # paths are checked against root as given, the files 
+        # they lead to against where root really is.
+        self.root = os.path.abspath(root)
+        self.real_root = os.path.realpath(root)
+        self.rejected = list()
+
+    def open(self, filename):
+        path = os.path.abspath(filename)
+        try:
+            if not path.startswith(self.root + os.sep):
+                raise ValueError(path)
+            self._make_dirs(os.path.dirname(path))
+            # nor may the file be a symlink out of the tree.
+            self._check(path)
+            return open_for_write(path)
+        except (OSError, ValueError):
+            print("Can't write {} in {}".format(filename, self.root))
+            self.rejected.append(filename)
+            return open_for_discard(filename)
+
+    def _make_dirs(self, directory):
+        # one level at a time, each checked before it is 
+        # made, so a symlink in the tree can't get any made
+        # outside of it.
+        os.makedirs(self.root, exist_ok=True)
+        current = self.root
+        for part in os.path.relpath(directory, self.root).split(os.sep):
+            if part == ".":
+                continue
+            current = join(current, part)
+            self._check(current)
+            try:
+                os.mkdir(current)
+            except FileExistsError:
+                pass
+
+    def _check(self, path):
+        if not (os.path.realpath(path) + os.sep).startswith(self.real_root + os.sep):
+            raise ValueError(path)
+
+class PositionalWriter():
+    """
+    PositionalWriter writes to the file descriptor fd from
+    offset on with os.pwrite, so several of them can fill
+    in different parts of one file at the same time. It can
+    be returned by a FilesReceiver's open_file, the fd is 
+    left open by close.
+    """
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+        self.written = 0
+
+    def write(self, data):
+        written = os.pwrite(self.fd, data, self.offset + self.written)
+        self.written += written
+        return written
+
+    def close(self):
+        pass
+
+def get_sized_file(conn, f, size):
+    """
+    get_sized_file will copy the size raw bytes that 
+    follow a SizedFile message from conn into the 
+    unbuffered file f.
+    """
+    while size:
+        data = conn.read_some(size)
+        write_all(f, data)
+        size -= len(data)
+
+def decode_chunk_to_file(f, decoder, msg):
+    data = decoder.decode(msg)
+    write_all(f, data)
+
+def write_all(f, data):
+    """
+    write_all will write all of data to the unbuffered
+    file f, raw writes are allowed to come up short.
+    """
+    data = memoryview(data)
+    while data:
+        written = f.write(data)
+        data = data[written:]
+
+def new_digest(data=b""):
+    """
+    new_digest returns the streaming hash a file's data 
+    is checked with end to end when integrity is on.
+    """
+    return hashlib.blake2b(data, digest_size=INTEGRITY_DIGEST_SIZE)
+
+class DigestReader():
+    """
+    DigestReader reads from f and hashes the data as it 
+    goes, so the sender has the digest of a file once it
+    read all of it without reading it twice.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.hash = new_digest()
+
+    def read(self, n):
+        data = self.f.read(n)
+        self.hash.update(data)
+        return data
+
+    def digest(self):
+        return self.hash.digest()
+
+    def close(self):
+        self.f.close()
+
+class DigestWriter():
+    """
+    DigestWriter writes to f and hashes what got written,
+    so the receiver can check a file against the digest
+    that came with it without reading it back.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.hash = new_digest()
+
+    def write(self, data):
+        written = self.f.write(data)
+        self.hash.update(memoryview(data)[:written])
+        return written
+
+    def check(self, digest):
+        return digest == self.hash.digest()
+
+    def close(self):
+        self.f.close()
+
+def written_paths(f):
+    """
+    written_paths returns the paths of the files on disk
+    the writer f has written to. Writers like StoreWriter
+    and DeltaPatcher that check what they are written on 
+    their own have none.
+    """
+    if isinstance(f, DigestWriter):
+        return written_paths(f.f)
+    if isinstance(f, BatchWriter):
+        return f.paths
+    name = getattr(f, "name", None)
+    if isinstance(name, str) and name != os.devnull:
+        return [name]
+    return []
+
+def remove_written(f):
+    # a file that doesn't match its digest isn't left 
+    # behind looking like a good copy.
+    for path in written_paths(f):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def end_file_chunks(chunks, f):
+    """
+    end_file_chunks yields the messages of chunks followed
+    by the EndOfFileChunks for f, with its digest if it is
+    a DigestReader.
+    """
+    yield from chunks
+    yield EndOfFileChunks(f.digest() if isinstance(f, DigestReader) else None)
+
+def put_files(conn, cwd, filenames, compression, encryption, streaming=False, codec=CodecType.LZMA, adaptive=False, chunk_size=DEFAULT_FILE_CHUNK_SIZE, sendfile=False, executor=None, progress=None, file_range=None, open_file=None, cache=None, batch=False, integrity=False, skipped=None):
+    # Will put File messages on the connection.
     # Writes file data for each file in filenames:
     # File -> FileChunk -> EndOfFileChunks
     # Ending with an EndOfFiles message to finish
-    # up.
+    # up. File and EndOfFileChunks are queued so they 
+    # share a syscall with the chunk data next to them.
+    # With sendfile on and nothing to encode, files go
+    # out as SizedFile -> raw bytes straight from the kernel.
+    # With an executor, chunks that don't depend on each
+    # other are read ahead and encoded on it while the
+    # ones before them are sent. progress is called with
+    # the name of every file sent. With a file_range of
+    # (offset, length) only those bytes are sent. open_file
+    # cache, batch, integrity and skipped are passed on to 
+    # put_files_steps.
+    for sent in put_files_steps(conn, cwd, filenames, compression, encryption, streaming, codec, adaptive, chunk_size, sendfile, 
+            executor, progress, file_range=file_range, open_file=open_file, cache=cache, batch=batch, integrity=integrity, 
+            skipped=skipped):
+        pass
+    return True
+
+def put_files_steps(conn, cwd, filenames, compression, encryption, streaming=False, codec=CodecType.LZMA, adaptive=False, chunk_size=DEFAULT_FILE_CHUNK_SIZE, sendfile=False, executor=None, progress=None, stream=0, file_range=None, open_file=None, cache=None, batch=False, integrity=False, skipped=None):
+    """
+    put_files_steps does the work of put_files one step 
+    at a time, every message goes out on stream. It yields
+    the number of file data bytes sent after every chunk
+    or sized file, so transfers on different streams of
+    a multiplexed connection can take turns. With a 
+    file_range of (offset, length) only those bytes of 
+    the files are sent. With open_file the file data is 
+    read from what it returns for the path of each file
+    instead, never with sendfile. With a ChunkCache the
+    messages of whole files are replayed from and added
+    to cache. With batch on small files go out together in
+    FileBatch messages. With integrity on every 
+    EndOfFileChunks carries the digest of the data sent,
+    SizedFile has no room for one so sendfile is off. With
+    a skipped list, for transfers that don't say how many
+    files there are, files that are gone or can't be 
+    opened are left out and added to it instead of ending
+    the transfer.
+    """
+    offset, length = file_range or (0, None)
+    sendfile = sendfile and not compression and not encryption and not integrity and open_file is None
+    use_cache = cache is not None and file_range is None and open_file is None and not sendfile
+    settings = (compression, encryption, streaming, codec, adaptive, chunk_size, integrity)
+    if batch and file_range is None and open_file is None:
+        filenames = batch_small_files(cwd, filenames, skipped)
+    open_file = open_file or functools.partial(open_file_range, offset=offset, length=length)
     first = True
     for filename in filenames:
-        chunk_num = 0
-        total_size = 0
+        if isinstance(filename, list):
+            # the whole batch goes out in one go.
+            encoder = FileEncoder(compression, encryption, ENCRYPTION_KEY, streaming, codec, adaptive, chunk_size)
+            for msg in batch_msgs(filename, encoder, chunk_size, integrity):
+                msg.stream = stream
+                conn.queue(msg)
+            conn.flush()
+            if progress:
+                for name, data in filename:
+                    progress(name)
+            yield sum(len(data) for name, data in filename)
+            continue
+        if sendfile:
+            try:
+                f = open(join(cwd, filename), "rb")
+            except OSError as e:
+                skip_file(filename, e, skipped)
+                continue
+            with f:
+                size = put_sized_file(conn, f, filename, stream, offset, length)
+            if progress:
+                progress(filename)
+            yield size
+            continue
+        encoder = FileEncoder(compression, encryption, ENCRYPTION_KEY, streaming, codec, adaptive, chunk_size)
+        chunks = None
+        f = None
+        # opened before its File goes out, so one that 
+        # can't be can still be left out.
+        try:
+            if use_cache:
+                key = cache.key(join(cwd, filename), settings)
+                chunks = cache.lookup(key)
+            if chunks is None:
+                f = open_file(join(cwd, filename))
+        except OSError as e:
+            skip_file(filename, e, skipped)
+            continue
         msg = File(filename)
-        sendmsg(socket, msg)
-        f = open(join(cwd, filename), "rb")
+        msg.stream = stream
+        conn.queue(msg)
+        try:
+            if chunks is None:
+                if integrity:
+                    f = DigestReader(f)
+                if executor and encoder.parallel():
+                    chunks = encode_chunks_pipelined(f, encoder, chunk_size, executor)
+                else:
+                    chunks = encode_chunks(f, encoder, chunk_size)
+                # cached along with the chunks, so a replay
+                # has the digest without reading the file.
+                chunks = end_file_chunks(chunks, f)
+                if use_cache:
+                    chunks = record_chunks(chunks, cache.recorder(key))
+            # write data chunks, at the end of the file
+            # this is whatever the encoder was holding on to.
+            for msg in chunks:
+                msg.stream = stream
+                if msg.id() == MsgType.EndOfFileChunks:
+                    # write end of file chunk, it is the last
+                    # message of the file.
+                    conn.queue(msg)
+                    continue
+                if first:
+                    debug_print(msg.data[:100])
+                    first = False
+                conn.sendmsg(msg)
+                yield len(msg.data)
+        finally:
+            if f is not None:
+                f.close()
+        debug_print("File: {}, {}".format(filename, encoder.stats))
+        if progress:
+            progress(filename)
+    # small frames still queued go out with EndOfFiles.
+    msg = EndOfFiles()
+    msg.stream = stream
+    conn.sendmsg(msg)
+
+class FileRange():
+    """
+    FileRange reads at most length bytes of the file f from
+    offset on, or up to the end of f if length is None. It
+    can be read from in place of f.
+    """
+    def __init__(self, f, offset=0, length=None):
+        self.f = f
+        self.remaining = file_range_size(f, offset, length)
+        f.seek(offset)
+
+    def read(self, n):
+        data = self.f.read(min(n, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+def open_file_range(filename, offset=0, length=None):
+    return FileRange(open(filename, "rb"), offset, length)
+
+def file_range_size(f, offset, length):
+    """
+    file_range_size returns how many bytes of f there 
+    are in the range of length bytes from offset.
+    """
+    size = max(0, os.fstat(f.fileno()).st_size - offset)
+    if length is None:
+        return size
+    return min(size, length)
+
+def delta_block_size(size):
+    return min(DELTA_MAX_BLOCK_SIZE, max(DELTA_MIN_BLOCK_SIZE, math.isqrt(size)))
+
+def block_checksums(data):
+    return (zlib.adler32(data), hashlib.blake2b(data, digest_size=16).digest())
+
+def signature_msgs(filename):
+    """
+    signature_msgs returns the Signatures messages for the 
+    blocks of filename, a single empty one if there is no
+    such file.
+    """
+    if not isfile(filename):
+        return [Signatures()]
+    msgs = list()
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        msg = Signatures(delta_block_size(size), size)
+        for i in range(msg.num_blocks()):
+            if len(msg.sigs) == DELTA_SIGNATURES_PER_MSG:
+                msgs.append(msg)
+                msg = Signatures(msg.block_size, size)
+            msg.sigs.append(block_checksums(f.read(msg.block_size)))
+        msgs.append(msg)
+    return msgs
+
+def recv_signatures(conn):
+    """
+    recv_signatures reads Signatures messages from conn 
+    until it has those of all the blocks and returns them
+    as one message, or None if something else came.
+    """
+    signatures = None
+    while True:
+        (rid, msg) = conn.recvmsg()
+        if rid != MsgType.Signatures:
+            return None
+        if signatures is None:
+            signatures = msg
+        else:
+            signatures.sigs.extend(msg.sigs)
+        if len(signatures.sigs) >= signatures.num_blocks():
+            return signatures
+
+# A delta is a stream of ops, read and written like the 
+# contents of a file:
+#   L <4 byte length> <data> - literal data
+#   C <8 byte block> <4 byte count> - count blocks of the
+#       receiver's copy, starting at block
+#   E <32 byte sha256> - the end, sha256 of the whole file
+def literal_ops(data):
+    for start in range(0, len(data), DELTA_MAX_LITERAL):
+        piece = data[start:start+DELTA_MAX_LITERAL]
+        yield b"L" + len(piece).to_bytes(4, byteorder="big") + piece
+
+def copy_op(block, count):
+    return b"C" + block.to_bytes(8, byteorder="big") + count.to_bytes(4, byteorder="big")
+
+def delta_ops(f, signatures):
+    """
+    delta_ops yields the ops of the delta from the blocks 
+    in signatures to the file f. Blocks are looked for at
+    every offset with a rolling adler32 and confirmed by 
+    their blake2b digest, runs of blocks become one op.
+    Rolling is slow in Python, so in long stretches of new
+    data it only covers one block in DELTA_SKIP_BLOCKS: 
+    enough to find where the blocks line up again.
+    """
+    blocks = dict()
+    for block, (weak, strong) in enumerate(signatures.sigs):
+        blocks.setdefault(weak, dict()).setdefault(strong, block)
+    block_size = signatures.block_size
+    size = os.fstat(f.fileno()).st_size
+    data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else b""
+    try:
+        # [first block, count] of the copy op being built
+        run = None
+        # start of the data not sent yet
+        literal = 0
+        pos = 0
+        # end of the last matching block
+        matched = 0
+        weak = None
+        while blocks and pos + block_size <= size:
+            end = pos + block_size
+            if weak is None:
+                weak = zlib.adler32(data[pos:end])
+            candidates = blocks.get(weak)
+            block = None
+            if candidates is not None:
+                block = candidates.get(block_checksums(data[pos:end])[1])
+            if block is not None:
+                if literal < pos:
+                    if run:
+                        yield copy_op(*run)
+                        run = None
+                    yield from literal_ops(data[literal:pos])
+                if run and run[0] + run[1] == block:
+                    run[1] += 1
+                else:
+                    if run:
+                        yield copy_op(*run)
+                    run = [block, 1]
+                pos = literal = matched = end
+                weak = None
+                continue
+            if end == size:
+                break
+            if pos - literal >= DELTA_MAX_LITERAL:
+                if run:
+                    yield copy_op(*run)
+                    run = None
+                yield from literal_ops(data[literal:pos])
+                literal = pos
+            missed = pos - matched - DELTA_ROLL_LIMIT
+            if missed >= 0 and missed % (DELTA_SKIP_BLOCKS * block_size) >= block_size:
+                pos = end
+                weak = None
+                continue
+            # roll the adler32 one byte on
+            out = data[pos]
+            a = ((weak & 0xffff) - out + data[end]) % 65521
+            b = ((weak >> 16) - block_size * out + a - 1) % 65521
+            weak = (b << 16) | a
+            pos += 1
+        # a short last block of the receiver's copy can only
+        # match the end of the file.
+        tail = signatures.size % block_size
+        if tail and literal <= size - tail and block_checksums(data[size-tail:size]) == signatures.sigs[-1]:
+            if run:
+                yield copy_op(*run)
+            yield from literal_ops(data[literal:size-tail])
+            run = [len(signatures.sigs) - 1, 1]
+            literal = size
+        if run:
+            yield copy_op(*run)
+        yield from literal_ops(data[literal:size])
+        yield b"E" + hashlib.sha256(data).digest()
+    finally:
+        if size:
+            data.close()
+
+class DeltaReader():
+    """
+    DeltaReader reads the delta from the blocks in 
+    signatures to the file f. It can be read from in place
+    of f.
+    """
+    def __init__(self, f, signatures):
+        self.f = f
+        self.ops = delta_ops(f, signatures)
+        self.buffer = bytearray()
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            op = next(self.ops, None)
+            if op is None:
+                break
+            self.buffer.extend(op)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def close(self):
+        self.ops.close()
+        self.f.close()
+
+def open_delta(filename, signatures):
+    return DeltaReader(open(filename, "rb"), signatures)
+
+class DeltaPatcher():
+    """
+    DeltaPatcher applies a delta written to it like a file.
+    The new file is built from the literal data and the 
+    block_size blocks of filename in a temporary file next
+    to it, which replaces filename on close if the delta 
+    ended and the sha256 matched. done tells if it did.
+    """
+    def __init__(self, filename, block_size):
+        self.filename = filename
+        self.block_size = block_size
+        self.basis = None
+        self.out = None
+        self.temp = None
+        self.digest = hashlib.sha256()
+        self.buffer = bytearray()
+        self.ended = False
+        self.failed = False
+        self.done = False
+
+    def write(self, data):
+        if self.out is None:
+            self._open()
+        if not self.failed:
+            self.buffer.extend(data)
+            self._apply()
+        return len(data)
+
+    def close(self):
+        if self.out is None:
+            return
+        self.out.close()
+        self.out = None
+        if self.basis:
+            self.basis.close()
+        if self.ended and not self.failed and not self.buffer:
+            os.replace(self.temp, self.filename)
+            self.done = True
+        else:
+            os.remove(self.temp)
+
+    def _open(self):
+        self.temp = temp_path(self.filename)
+        self.out = open(self.temp, "xb", buffering=0)
+        if isfile(self.filename):
+            self.basis = open(self.filename, "rb")
+            os.chmod(self.temp, os.fstat(self.basis.fileno()).st_mode & 0o7777)
+
+    def _emit(self, data):
+        self.digest.update(data)
+        write_all(self.out, data)
+
+    def _apply(self):
+        buffer = self.buffer
+        pos = 0
+        while pos < len(buffer) and not self.failed:
+            op = buffer[pos]
+            if self.ended:
+                # nothing may follow the end
+                self.failed = True
+            elif op == ord("L"):
+                if len(buffer) - pos < 5:
+                    break
+                length = int.from_bytes(buffer[pos+1:pos+5], byteorder="big")
+                if len(buffer) - pos < 5 + length:
+                    break
+                self._emit(bytes(buffer[pos+5:pos+5+length]))
+                pos += 5 + length
+            elif op == ord("C"):
+                if len(buffer) - pos < 13:
+                    break
+                block = int.from_bytes(buffer[pos+1:pos+9], byteorder="big")
+                count = int.from_bytes(buffer[pos+9:pos+13], byteorder="big")
+                self._copy(block, count)
+                pos += 13
+            elif op == ord("E"):
+                if len(buffer) - pos < 33:
+                    break
+                self.ended = True
+                self.failed = self.digest.digest() != bytes(buffer[pos+1:pos+33])
+                pos += 33
+            else:
+                self.failed = True
+        del buffer[:pos]
+
+    def _copy(self, block, count):
+        if self.basis is None:
+            self.failed = True
+            return
+        self.basis.seek(block * self.block_size)
+        remaining = count * self.block_size
+        while remaining:
+            # short reads at the end of the basis are caught
+            # by the sha256.
+            data = self.basis.read(min(remaining, PIPELINE_MAX_BYTES))
+            if not data:
+                return
+            self._emit(data)
+            remaining -= len(data)
+
+def delta_error(patcher):
+    # the error for a delta transfer that has been read,
+    # if the patcher didn't end up with the file.
+    if patcher.done:
+        return None
+    return ErrorCodes.DeltaFailed
+
+def cdc_cuts(data):
+    """
+    cdc_cuts yields the (start, end) of the content defined
+    chunks of data. Cut points only depend on the bytes 
+    right before them, so the same content is cut the same
+    way wherever it is in a file. Candidates are found with
+    find, which keeps the Python work to one step per 
+    anchor byte.
+    """
+    start = 0
+    size = len(data)
+    while start < size:
+        limit = min(start + CDC_MAX_SIZE, size)
+        end = limit
+        pos = start + CDC_MIN_SIZE
+        while pos < limit:
+            pos = data.find(CDC_ANCHOR, pos, limit) + 1
+            if not pos:
+                break
+            if zlib.crc32(data[pos-CDC_WINDOW:pos]) & CDC_MASK == 0:
+                end = pos
+                break
+        yield (start, end)
+        start = end
+
+def content_chunks(f):
+    """
+    content_chunks returns the (sha256, offset, length) of
+    the content defined chunks of the file f.
+    """
+    size = os.fstat(f.fileno()).st_size
+    if not size:
+        return []
+    chunks = list()
+    with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+        for start, end in cdc_cuts(data):
+            chunks.append((hashlib.sha256(data[start:end]).digest(), start, end - start))
+    return chunks
+
+def chunk_hash_msgs(chunks, size):
+    """
+    chunk_hash_msgs returns the ChunkHashes messages for 
+    the content_chunks of a file of size bytes.
+    """
+    msgs = list()
+    for start in range(0, len(chunks), DEDUP_HASHES_PER_MSG):
+        group = chunks[start:start+DEDUP_HASHES_PER_MSG]
+        msgs.append(ChunkHashes(size, [(digest, length) for digest, offset, length in group]))
+    return msgs or [ChunkHashes(size)]
+
+def recv_chunk_hashes(conn):
+    """
+    recv_chunk_hashes reads ChunkHashes messages from conn
+    until they add up to the size of the file and returns
+    them, or None if something else came.
+    """
+    msgs = list()
+    total = 0
+    while True:
+        (rid, msg) = conn.recvmsg()
+        if rid != MsgType.ChunkHashes:
+            return None
+        msgs.append(msg)
+        total += sum(length for digest, length in msg.chunks)
+        if total >= msg.size:
+            return msgs
+
+class ChunksReader():
+    """
+    ChunksReader reads the (offset, length) chunks of the 
+    file f one after the other. It can be read from in 
+    place of f.
+    """
+    def __init__(self, f, chunks):
+        self.f = f
+        self.chunks = collections.deque(chunks)
+        self.remaining = 0
+
+    def read(self, n):
+        while not self.remaining and self.chunks:
+            offset, self.remaining = self.chunks.popleft()
+            self.f.seek(offset)
+        data = self.f.read(min(n, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+class ChunkCache():
+    """
+    ChunkCache keeps the encoded chunk messages of files 
+    that were sent, so the next get of the same file with
+    the same settings replays them instead of encoding it
+    again. Entries are keyed by path, mtime, size and the
+    settings. They are kept in memory up to max_memory 
+    bytes and, with a directory, on disk up to max_disk 
+    bytes, the least recently used going first. Every 
+    entry that fits goes to both, memory keeps the hot 
+    ones. Safe to share between threads, every process 
+    has entries of its own.
+    """
+    def __init__(self, max_memory, directory=None, max_disk=0):
+        self.max_memory = max_memory
+        self.directory = directory
+        self.max_disk = max_disk if directory else 0
+        # key -> [(msg id, data)]
+        self.memory = collections.OrderedDict()
+        # key -> (path, size)
+        self.disk = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            # left over from an earlier run, nothing knows
+            # what they hold any more.
+            for name in os.listdir(directory):
+                if name.endswith(".chunks"):
+                    os.remove(join(directory, name))
+
+    def key(self, filename, settings):
+        st = os.stat(filename)
+        return (os.path.realpath(filename), st.st_mtime_ns, st.st_size, settings)
+
+    def lookup(self, key):
+        """
+        Returns an iterator over the cached messages for 
+        key, or None if they aren't cached.
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return replay_chunks(self.memory[key])
+            if key in self.disk:
+                path, size = self.disk[key]
+                self.disk.move_to_end(key)
+                self.hits += 1
+                # an entry evicted while it is replayed stays
+                # readable through the open file.
+                return replay_chunks_file(open(path, "rb"))
+            self.misses += 1
+            return None
+
+    def recorder(self, key):
+        return CacheRecorder(self, key)
+
+    def insert(self, key, entry, size, temp):
+        with self.lock:
+            if entry is not None:
+                if key in self.memory:
+                    self.memory_bytes -= sum(len(data) for msgid, data in self.memory[key])
+                self.memory[key] = entry
+                self.memory.move_to_end(key)
+                self.memory_bytes += size
+            if temp is not None:
+                path = join(self.directory, "{}-{}.chunks".format(os.getpid(), hashlib.sha256(repr(key).encode("utf-8")).hexdigest()))
+                os.replace(temp, path)
+                if key in self.disk:
+                    self.disk_bytes -= self.disk[key][1]
+                self.disk[key] = (path, os.path.getsize(path))
+                self.disk.move_to_end(key)
+                self.disk_bytes += self.disk[key][1]
+            self._evict()
+
+    def _evict(self):
+        while self.memory_bytes > self.max_memory:
+            key, entry = self.memory.popitem(last=False)
+            self.memory_bytes -= sum(len(data) for msgid, data in entry)
+            self.evictions += 1
+        while self.disk_bytes > self.max_disk:
+            key, (path, size) = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            self.evictions += 1
+            os.remove(path)
+
+    def __str__(self):
+        return "Cache hits: {}, misses: {}, evictions: {}, memory: {} entries {} bytes, disk: {} entries {} bytes".format(
+            self.hits, self.misses, self.evictions, len(self.memory), self.memory_bytes, len(self.disk), self.disk_bytes)
+
+class CacheRecorder():
+    """
+    CacheRecorder collects the messages of one file as 
+    they are sent and adds them to the cache on finish,
+    if the file didn't change in the meantime. It stops
+    keeping them in memory or on disk once they don't fit.
+    """
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        self.entry = list() if cache.max_memory else None
+        self.temp = None
+        self.f = None
+        if cache.max_disk:
+            self.temp = temp_path(join(cache.directory, "entry.chunks"))
+            self.f = open(self.temp, "xb")
+
+    def add(self, msg):
+        data = bytes(msg.encode())
+        self.size += len(data)
+        if self.entry is not None:
+            if self.size <= self.cache.max_memory:
+                self.entry.append((msg.id(), data))
+            else:
+                self.entry = None
+        if self.f is not None:
+            if self.size <= self.cache.max_disk:
+                self.f.write(bytes([msg.id()]) + len(data).to_bytes(4, byteorder="big"))
+                self.f.write(data)
+            else:
+                self.abort()
+
+    def finish(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        try:
+            changed = self.cache.key(self.key[0], self.key[3]) != self.key
+        except OSError:
+            changed = True
+        if changed or (self.entry is None and self.temp is None):
+            self.abort()
+            return
+        self.cache.insert(self.key, self.entry, self.size, self.temp)
+        self.entry = None
+        self.temp = None
+
+    def abort(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if self.temp is not None:
+            os.remove(self.temp)
+            self.temp = None
+
+def record_chunks(chunks, recorder):
+    """
+    record_chunks yields the messages of chunks and hands 
+    them to recorder, which gets them into the cache once
+    the last one went out.
+    """
+    try:
+        for msg in chunks:
+            recorder.add(msg)
+            yield msg
+    except BaseException:
+        recorder.abort()
+        raise
+    recorder.finish()
+
+def replay_chunks(entry):
+    for msgid, data in entry:
+        yield messages[msgid](data)
+
+def replay_chunks_file(f):
+    with f:
         while True:
-            data = f.read(DEFAULT_FILE_CHUNK_SIZE)
+            header = f.read(5)
+            if len(header) < 5:
+                return
+            length = int.from_bytes(header[1:5], byteorder="big")
+            yield messages[header[0]](f.read(length))
+
+def encode_next_chunk(f, encoder, chunk_size):
+    """
+    encode_next_chunk will read and encode the next chunk 
+    of f. Returns a (msgs, done) tuple, done is True once 
+    the end of the file was reached and msgs is then what
+    the encoder flushed.
+    """
+    data = f.read(chunk_size)
+    if not data:
+        return (encoder.flush(), True)
+    return (encoder.encode(data), False)
+
+def encode_chunks(f, encoder, chunk_size):
+    """
+    encode_chunks yields the messages for the rest of f.
+    """
+    done = False
+    while not done:
+        msgs, done = encode_next_chunk(f, encoder, chunk_size)
+        yield from msgs
+
+def encode_chunks_pipelined(f, encoder, chunk_size, executor):
+    """
+    encode_chunks_pipelined yields the same messages as
+    encode_chunks, but reads ahead and encodes chunks on 
+    executor while the caller sends the ones before them.
+    """
+    pipeline = Pipeline(executor, pipeline_depth(chunk_size))
+    try:
+        while True:
+            data = f.read(chunk_size)
             if not data:
-                # Reached end of file.
-                # Write end of file chunk.
-                # And move on to next file.
-                msg = EndOfFileChunks()
-                sendmsg(socket, msg)
                 break
-            # write data chunks
-            data = encode_file_data(data, compression, encryption, ENCRYPTION_KEY)
-            if first:
-                debug_print(data[:100])
-                first = False
-            chunk_num += 1
-            total_size += len(data)
-            msg = FileChunk(data)
-            sendmsg(socket, msg)
-        debug_print("File: {}, Chunks: {}, Size: {}".format(filename, chunk_num, total_size))
-        f.close()
-    msg = EndOfFiles()
-    sendmsg(socket, msg)
+            for result in pipeline.submit(encode_chunk, *encoder.chunk_args(data)):
+                yield from encoder.emit(*result)
+        for result in pipeline.drain():
+            yield from encoder.emit(*result)
+        yield from encoder.flush()
+    finally:
+        pipeline.cancel()
+
+def put_sized_file(conn, f, filename, stream=0, offset=0, length=None):
+    size = file_range_size(f, offset, length)
+    f.seek(offset)
+    msg = SizedFile(filename, size)
+    msg.stream = stream
+    conn.queue(msg)
+    conn.sendfile(f, size)
+    debug_print("File: {}, sendfile Size: {}".format(filename, size))
+    return size
+
+
+# The asyncio versions of get_files and put_files for an
+# AsyncConnection. Messages are the same, the file I/O and
+# codec work for each chunk runs on the connection's executor.
+
+async def get_files_async(conn, cwd, num_files, compression, encryption, streaming=False, codec=CodecType.LZMA, open_file=None, progress=None, integrity=False):
+    open_file = open_file or open_for_write
+    mismatched = False
+    while True:
+        (rid, msg) = await conn.recvmsg()
+        # with num_files None, as many as the sender has.
+        if num_files == 0 or num_files is None and rid == MsgType.EndOfFiles:
+            return rid == MsgType.EndOfFiles and not mismatched
+        if num_files:
+            num_files -= 1
+        if rid == MsgType.SizedFile:
+            if integrity:
+                print("SizedFile {} has no digest".format(join(cwd, msg.filename)))
+                return False
+            f = await conn.run(open_file, join(cwd, msg.filename))
+            try:
+                await get_sized_file_async(conn, f, msg.size)
+            finally:
+                await conn.run(f.close)
+            if progress:
+                progress(msg.filename)
+            continue
+        if rid == MsgType.FileBatch:
+            if num_files is not None:
+                if msg.count - 1 > num_files:
+                    return False
+                num_files -= msg.count - 1
+            filename = cwd
+            names = None
+            batch = f = BatchWriter(cwd, msg.count, open_file)
+        elif rid == MsgType.File:
+            filename = join(cwd, msg.filename)
+            names = [msg.filename]
+            batch = None
+            f = await conn.run(open_file, filename)
+        else:
+            return False
+        if integrity:
+            f = DigestWriter(f)
+        decoder = FileDecoder(compression, encryption, ENCRYPTION_KEY, streaming, codec)
+        try:
+            while True:
+                (rid, msg) = await conn.recvmsg()
+                if rid == MsgType.ErrorResponse:
+                    return False
+                if rid == MsgType.EndOfFileChunks:
+                    if not decoder.finish():
+                        print("File {} ended in the middle of a compressed stream".format(filename))
+                        return False
+                    digest = msg.digest
+                    break
+                if rid != MsgType.FileChunk and rid != MsgType.RawFileChunk:
+                    print("Expected a FileChunk, got {}".format(msg))
+                    return False
+                await conn.run(decode_chunk_to_file, f, decoder, msg)
+        finally:
+            await conn.run(f.close)
+        if integrity and not f.check(digest):
+            # the rest of the files still come in.
+            print("File {} doesn't match its digest".format(filename))
+            await conn.run(remove_written, f)
+            mismatched = True
+            continue
+        if batch is not None:
+            if not batch.done():
+                print("Batch of {} files in {} came up short".format(batch.count, cwd))
+                return False
+            names = batch.names
+        if progress:
+            for name in names:
+                progress(name)
+
+async def get_sized_file_async(conn, f, size):
+    while size:
+        data = await conn.read_some(min(size, DEFAULT_FILE_CHUNK_SIZE * 8))
+        await conn.run(write_all, f, data)
+        size -= len(data)
+
+async def put_files_async(conn, cwd, filenames, compression, encryption, streaming=False, codec=CodecType.LZMA, adaptive=False, chunk_size=DEFAULT_FILE_CHUNK_SIZE, sendfile=False, file_range=None, open_file=None, cache=None, batch=False, integrity=False, skipped=None):
+    offset, length = file_range or (0, None)
+    sendfile = sendfile and not compression and not encryption and not integrity and open_file is None
+    use_cache = cache is not None and file_range is None and open_file is None and not sendfile
+    settings = (compression, encryption, streaming, codec, adaptive, chunk_size, integrity)
+    filenames = iter(filenames)
+    if batch and file_range is None and open_file is None:
+        filenames = batch_small_files(cwd, filenames, skipped)
+    open_file = open_file or functools.partial(open_file_range, offset=offset, length=length)
+    while True:
+        # filenames may walk a tree or read small files.
+        filename = await conn.run(next, filenames, None)
+        if filename is None:
+            break
+        if isinstance(filename, list):
+            encoder = FileEncoder(compression, encryption, ENCRYPTION_KEY, streaming, codec, adaptive, chunk_size)
+            for msg in await conn.run(batch_msgs, filename, encoder, chunk_size, integrity):
+                conn.queue(msg)
+            await conn.flush()
+            continue
+        if sendfile:
+            try:
+                f = await conn.run(open, join(cwd, filename), "rb")
+            except OSError as e:
+                skip_file(filename, e, skipped)
+                continue
+            try:
+                await put_sized_file_async(conn, f, filename, offset, length)
+            finally:
+                await conn.run(f.close)
+            continue
+        encoder = FileEncoder(compression, encryption, ENCRYPTION_KEY, streaming, codec, adaptive, chunk_size)
+        chunks = None
+        f = None
+        # opened before its File goes out, like put_files_steps.
+        try:
+            if use_cache:
+                key = await conn.run(cache.key, join(cwd, filename), settings)
+                chunks = await conn.run(cache.lookup, key)
+            if chunks is None:
+                f = await conn.run(open_file, join(cwd, filename))
+        except OSError as e:
+            skip_file(filename, e, skipped)
+            continue
+        conn.queue(File(filename))
+        if chunks is not None:
+            # the EndOfFileChunks is cached too.
+            await put_cached_chunks_async(conn, chunks)
+            continue
+        recorder = None
+        if integrity:
+            f = DigestReader(f)
+        try:
+            if use_cache:
+                recorder = await conn.run(cache.recorder, key)
+            done = False
+            while not done:
+                msgs, done = await conn.run(encode_next_chunk, f, encoder, chunk_size)
+                for msg in msgs:
+                    if recorder:
+                        await conn.run(recorder.add, msg)
+                    conn.queue(msg)
+                # waits for the transport to drain, so a slow
+                # client holds back the reads.
+                await conn.flush()
+            msg = EndOfFileChunks(f.digest() if integrity else None)
+            if recorder:
+                await conn.run(recorder.add, msg)
+                await conn.run(recorder.finish)
+                recorder = None
+        finally:
+            await conn.run(f.close)
+            if recorder:
+                await conn.run(recorder.abort)
+        conn.queue(msg)
+        debug_print("File: {}, {}".format(filename, encoder.stats))
+    await conn.sendmsg(EndOfFiles())
     return True
 
+async def put_cached_chunks_async(conn, chunks):
+    try:
+        while True:
+            msg = await conn.run(next, chunks, None)
+            if msg is None:
+                return
+            conn.queue(msg)
+            await conn.flush()
+    finally:
+        chunks.close()
+
+async def put_sized_file_async(conn, f, filename, offset=0, length=None):
+    size = file_range_size(f, offset, length)
+    f.seek(offset)
+    conn.queue(SizedFile(filename, size))
+    await conn.sendfile(f, size)
+    debug_print("File: {}, sendfile Size: {}".format(filename, size))
+
+async def recv_signatures_async(conn):
+    signatures = None
+    while True:
+        (rid, msg) = await conn.recvmsg()
+        if rid != MsgType.Signatures:
+            return None
+        if signatures is None:
+            signatures = msg
+        else:
+            signatures.sigs.extend(msg.sigs)
+        if len(signatures.sigs) >= signatures.num_blocks():
+            return signatures
+
+async def recv_chunk_hashes_async(conn):
+    msgs = list()
+    total = 0
+    while True:
+        (rid, msg) = await conn.recvmsg()
+        if rid != MsgType.ChunkHashes:
+            return None
+        msgs.append(msg)
+        total += sum(length for digest, length in msg.chunks)
+        if total >= msg.size:
+            return msgs
@@ -5,10 +5,21 @@ import sys
 import getpass
 import re
 import os
-from os.path import isfile, join
+import time
+import heapq
+import functools
+import threading
+import collections
+import concurrent.futures
+from os.path import isfile, isdir, join
 
 from common import *
 
+# Segmented gets don't split files into ranges smaller than this.
+MIN_SEGMENT_SIZE = 1024 * 1024
+# Most requests a RequestQueue has sent without their reply.
+REQUEST_WINDOW = 32
+
 
 class EffTeePeeClient():
     def __init__(self):
@@ -17,10 +28,35 @@ class EffTeePeeClient():
         """
         # declare instance variables
         self.username = None 
+        self.password = None
+        self.address = None
+        self.cd_history = list()
+        self.lanes = 1
+        # gets running on streams of their own, by stream id,
+        # and the ones that finished since pop_finished.
+        self.streams = dict()
+        self.finished = dict()
+        self.next_stream = 1
         self.binary = False 
         self.compression = False 
         self.encryption = False 
+        self.streaming = False
+        self.codec = CodecType.LZMA
+        self.server_codecs = [CodecType.LZMA]
+        self.adaptive = False
+        self.chunk_size = DEFAULT_FILE_CHUNK_SIZE
+        self.sendfile = False
+        self.batch = False
+        self.integrity = False
+        self.pipeline_workers = 0
+        self.codec_executor = None
+        # FileIndex of every local tree synced, and the last 
+        # (root, epoch, generation, files) the server sent for
+        # it, root being the tree's path on the server.
+        self.indexes = dict()
+        self.manifests = dict()
         self.socket = None
+        self.conn = None
         self.error = None
         self.closed = False
         return
@@ -43,6 +79,9 @@ class EffTeePeeClient():
         Close the connection and set closed to True.
         """
         self.closed = True
+        for get in self.streams.values():
+            get.close()
+        self.streams.clear()
         self.socket.close()
         return
     
@@ -54,6 +93,8 @@ class EffTeePeeClient():
         # create socket
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((host, port))
+        self.address = (host, port)
+        self.conn = Connection(self.socket)
         return
 
     def handshake(self, username, password):
@@ -61,18 +102,23 @@ class EffTeePeeClient():
         Will try and authenticate with the server. Return True if successful 
         or False otherwise and the server will close the connection.
         """
-        msg = ClientHello(username,password)
-        sendmsg(self.socket, msg)
-        (rid, msg) = recvmsg(self.socket)
+        msg = ClientHello(username, password, max(FramingVersion), True)
+        self.conn.sendmsg(msg)
+        (rid, msg) = self._recvmsg()
         if rid == MsgType.ErrorResponse:
             self.error = msg.error_code
             self._close()
             return False
         if rid == MsgType.ServerHello:
             self.username = username 
+            # kept to authenticate the lanes of parallel transfers
+            self.password = password
             self.binary = msg.binary
             self.compression = msg.compression
             self.encryption = msg.encryption
+            self.server_codecs = msg.codecs
+            self.conn.framing = msg.framing
+            self.integrity = msg.integrity
             return True
         return False
     
@@ -81,53 +127,105 @@ class EffTeePeeClient():
         Change directory on the server. Return True if everything 
         went ok. 
         """
-        msg = CDRequest(directory)
-        sendmsg(self.socket, msg)
-        (rid, msg) = recvmsg(self.socket)
-        if rid != MsgType.CDResponse:
-            return False
-        return True
+        return self._request(*self._cd(directory))
     
+    def _cd(self, directory):
+        def reply():
+            (rid, msg) = self._recvmsg()
+            if rid != MsgType.CDResponse:
+                return False
+            self.cd_history.append(directory)
+            return True
+        return CDRequest(directory), reply
+
     def ls(self, path):
         """
         Retuns a listing of the files and folders in the 
         path on the remote server. Returns a LSResponse object.
         """
-        msg = LSRequest(path)
-        sendmsg(self.socket, msg)
-        (rid, msg) = recvmsg(self.socket)
-        if rid == MsgType.ErrorResponse:
-            print("TODO: Got an error")
-            return None
-        elif rid == MsgType.LSResponse:
-            return msg
-        print("Got an unknown response")
-        return None 
+        return self._request(*self._ls(path))
     
-    def get(self, filenames):
+    def _ls(self, path):
+        def reply():
+            (rid, msg) = self._recvmsg()
+            if rid == MsgType.ErrorResponse:
+                print("TODO: Got an error")
+                return None
+            elif rid == MsgType.LSResponse:
+                return msg
+            print("Got an unknown response")
+            return None 
+        return LSRequest(path), reply
+
+    def stat(self, filenames):
+        """
+        Returns the sizes of filenames on the server as a 
+        dict, or None if one of them doesn't exist.
+        """
+        return self._request(*self._stat(filenames))
+
+    def _stat(self, filenames):
+        def reply():
+            (rid, msg) = self._recvmsg()
+            if rid == MsgType.ErrorResponse:
+                self.error = msg.error_code
+                return None
+            if rid != MsgType.StatResponse:
+                return None
+            return dict(zip(filenames, msg.sizes))
+        return StatRequest(filenames), reply
+
+    def get(self, filenames, progress=None):
         """
         Get a file from a directory on the server and save it to
-        the local host machine. 
+        the local host machine. progress is called with the name
+        of every file once it is saved.
         """
-        msg = GetRequest(filenames)
-        sendmsg(self.socket, msg)
-        (rid, msg) = recvmsg(self.socket)
-        if rid == MsgType.ErrorResponse:
-            return False
-        if rid != MsgType.GetResponse:
-            # protocol error, close conn.
-            print("Expected a GetResponse, got: {}".format(msg))
-            self._close()
-            return False
-        # Read file from server 
-        num_files = msg.num_files
-        cwd = os.getcwd()
-        return get_files(self.socket, cwd, num_files, self.compression, self.encryption)
+        if self.streams:
+            # the files of the running gets would get mixed up
+            # with these, give them a stream of their own.
+            return self.wait(self.start_get(filenames, progress))
+        return self._request(*self._get(filenames, progress))
 
-    def put(self, filenames):
+    def _get(self, filenames, progress=None):
+        def reply():
+            (rid, msg) = self._recvmsg()
+            if rid == MsgType.ErrorResponse:
+                return False
+            if rid != MsgType.GetResponse:
+                # protocol error, close conn.
+                print("Expected a GetResponse, got: {}".format(msg))
+                self._close()
+                return False
+            # Read file from server with the settings
+            # the server had when it got the request.
+            num_files = msg.num_files
+            cwd = os.getcwd()
+            return get_files(self.conn, cwd, num_files, self.compression, self.encryption, self.streaming, self.codec, self.chunk_size, 
+                self.codec_executor, progress, integrity=self.integrity)
+        return GetRequest(filenames), reply
+
+    def _request(self, msg, reply):
+        """
+        Sends the request msg and returns what reply makes 
+        of the reply to it.
+        """
+        self.conn.sendmsg(msg)
+        return reply()
+
+    def request_queue(self, window=REQUEST_WINDOW):
+        """
+        Returns a RequestQueue that sends the requests put 
+        in it back to back, with at most window of them 
+        waiting for their reply.
+        """
+        return RequestQueue(self, window)
+
+    def put(self, filenames, progress=None):
         """
         Put a file from the local host machine on the server in its 
-        current working directory. 
+        current working directory. progress is called with the 
+        name of every file once it is sent.
         """
         cwd = os.getcwd()
         # check all files exist 
@@ -135,23 +233,362 @@ class EffTeePeeClient():
             if not isfile(join(cwd, f)):
                 print("{} does not exist".format(join(cwd, f)))
                 return False
+        # we don't read while sending, so the running gets
+        # have to finish first or both sides could block.
+        self.wait()
         msg = PutRequest(len(filenames))
-        sendmsg(self.socket, msg)
-        ok = put_files(self.socket, cwd, filenames, self.compression, self.encryption)
+        self.conn.queue(msg)
+        ok = put_files(self.conn, cwd, filenames, self.compression, self.encryption, self.streaming, self.codec, self.adaptive, self.chunk_size, self.sendfile, self.codec_executor, progress, 
+            batch=self.batch, integrity=self.integrity)
         if not ok:
             return False
-        (rid, msg) = recvmsg(self.socket)
+        (rid, msg) = self._recvmsg()
         if rid != MsgType.PutResponse:
             return False
         return True
         
+    def resume_get(self, filename, progress=None):
+        """
+        Get the rest of a file of which a part is already 
+        saved on the local host machine. If the server's 
+        copy doesn't start with that part the whole file is
+        downloaded again.
+        """
+        path = join(os.getcwd(), filename)
+        if not isfile(path):
+            return self.get([filename], progress)
+        with open(path, "rb") as f:
+            offset = os.fstat(f.fileno()).st_size
+            fingerprint = resume_fingerprint(f, offset)
+        # the rest comes back on stream 0.
+        self.wait()
+        msg = ResumeGetRequest(filename, offset, fingerprint)
+        self.conn.sendmsg(msg)
+        (rid, msg) = self._recvmsg()
+        if rid == MsgType.ErrorResponse:
+            if msg.error_code in (ErrorCodes.ResumeMismatch, ErrorCodes.BadRange):
+                return self.get([filename], progress)
+            self.error = msg.error_code
+            return False
+        if rid != MsgType.GetResponse:
+            # protocol error, close conn.
+            print("Expected a GetResponse, got: {}".format(msg))
+            self._close()
+            return False
+        open_file = functools.partial(open_for_resume, offset=offset)
+        return get_files(self.conn, os.getcwd(), 1, self.compression, self.encryption, self.streaming, self.codec, 
+            self.chunk_size, self.codec_executor, progress, open_file, self.integrity)
+
+    def resume_put(self, filename, progress=None):
+        """
+        Put the rest of a file of which a part is already
+        on the server. If the server's part isn't the start
+        of the local file the whole file is uploaded again.
+        """
+        path = join(os.getcwd(), filename)
+        if not isfile(path):
+            print("{} does not exist".format(path))
+            return False
+        sizes = self.stat([filename])
+        if sizes is None:
+            return self.put([filename], progress)
+        offset = sizes[filename]
+        with open(path, "rb") as f:
+            if offset > os.fstat(f.fileno()).st_size:
+                return self.put([filename], progress)
+            fingerprint = resume_fingerprint(f, offset)
+        self.wait()
+        msg = ResumePutRequest(filename, offset, fingerprint)
+        self.conn.queue(msg)
+        put_files(self.conn, os.getcwd(), [filename], self.compression, self.encryption, self.streaming, self.codec, 
+            self.adaptive, self.chunk_size, self.sendfile, self.codec_executor, progress, (offset, None), 
+            integrity=self.integrity)
+        (rid, msg) = self._recvmsg()
+        if rid == MsgType.ErrorResponse:
+            # the server changed its copy since the stat.
+            if msg.error_code == ErrorCodes.ResumeMismatch:
+                return self.put([filename], progress)
+            self.error = msg.error_code
+            return False
+        return rid == MsgType.PutResponse
+
+    def delta_get(self, filename, progress=None):
+        """
+        Get a file of which an older version is saved on the
+        local host machine. Only the parts of it that aren't
+        in the local blocks are downloaded.
+        """
+        path = join(os.getcwd(), filename)
+        signatures = signature_msgs(path)
+        # the delta comes back on stream 0.
+        self.wait()
+        self.conn.queue(DeltaGetRequest(filename))
+        for sig in signatures:
+            self.conn.queue(sig)
+        self.conn.flush()
+        (rid, msg) = self._recvmsg()
+        if rid == MsgType.ErrorResponse:
+            self.error = msg.error_code
+            return False
+        if rid != MsgType.GetResponse:
+            # protocol error, close conn.
+            print("Expected a GetResponse, got: {}".format(msg))
+            self._close()
+            return False
+        patcher = DeltaPatcher(path, signatures[0].block_size)
+        ok = get_files(self.conn, os.getcwd(), 1, self.compression, self.encryption, self.streaming, self.codec, 
+            self.chunk_size, self.codec_executor, progress, lambda path: patcher, self.integrity)
+        return ok and patcher.done
+
+    def delta_put(self, filename, progress=None):
+        """
+        Put a file of which an older version is on the 
+        server. Only the parts of it that aren't in the 
+        server's blocks are uploaded.
+        """
+        path = join(os.getcwd(), filename)
+        if not isfile(path):
+            print("{} does not exist".format(path))
+            return False
+        self.wait()
+        self.conn.sendmsg(DeltaPutRequest(filename))
+        signatures = recv_signatures(self.conn)
+        if signatures is None:
+            # protocol error, close conn.
+            print("Expected Signatures from the server")
+            self._close()
+            return False
+        put_files(self.conn, os.getcwd(), [filename], self.compression, self.encryption, self.streaming, self.codec, 
+            self.adaptive, self.chunk_size, False, self.codec_executor, progress, 
+            open_file=functools.partial(open_delta, signatures=signatures), integrity=self.integrity)
+        (rid, msg) = self._recvmsg()
+        if rid == MsgType.ErrorResponse:
+            self.error = msg.error_code
+            return False
+        return rid == MsgType.PutResponse
+
+    def dedup_put(self, filename, progress=None):
+        """
+        Put a file through the server's chunk store. Only 
+        the chunks of it that the store doesn't have yet are
+        uploaded. Falls back to a plain put if the server 
+        has no store.
+        """
+        path = join(os.getcwd(), filename)
+        if not isfile(path):
+            print("{} does not exist".format(path))
+            return False
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            chunks = content_chunks(f)
+        hashes = chunk_hash_msgs(chunks, size)
+        self.wait()
+        self.conn.queue(DedupPutRequest(filename))
+        for msg in hashes:
+            self.conn.queue(msg)
+        self.conn.flush()
+        missing = list()
+        for start in range(0, max(1, len(chunks)), DEDUP_HASHES_PER_MSG):
+            (rid, msg) = self._recvmsg()
+            if rid == MsgType.ErrorResponse:
+                if msg.error_code == ErrorCodes.NoChunkStore:
+                    return self.put([filename], progress)
+                self.error = msg.error_code
+                return False
+            if rid != MsgType.MissingChunks:
+                # protocol error, close conn.
+                print("Expected MissingChunks, got: {}".format(msg))
+                self._close()
+                return False
+            group = chunks[start:start+DEDUP_HASHES_PER_MSG]
+            missing.extend((offset, length) for i, (digest, offset, length) in enumerate(group) if msg.is_missing(i))
+        put_files(self.conn, os.getcwd(), [filename], self.compression, self.encryption, self.streaming, self.codec, 
+            self.adaptive, self.chunk_size, False, self.codec_executor, progress, 
+            open_file=lambda path: ChunksReader(open(path, "rb"), missing), integrity=self.integrity)
+        (rid, msg) = self._recvmsg()
+        if rid == MsgType.ErrorResponse:
+            self.error = msg.error_code
+            return False
+        return rid == MsgType.PutResponse
+
+    def mirror_get(self, directory, progress=None):
+        """
+        Get the tree of files under a directory on the server
+        into the same path on the local host machine, making 
+        the directories on the way. Files are written as the
+        server finds them.
+        """
+        # the tree comes back on stream 0.
+        self.wait()
+        self.conn.sendmsg(MirrorGetRequest(directory))
+        (rid, msg) = self._recvmsg()
+        if rid == MsgType.ErrorResponse:
+            self.error = msg.error_code
+            return False
+        if rid != MsgType.GetResponse:
+            # protocol error, close conn.
+            print("Expected a GetResponse, got: {}".format(msg))
+            self._close()
+            return False
+        root = join(os.getcwd(), directory)
+        writer = TreeWriter(root)
+        ok = get_files(self.conn, root, None, self.compression, self.encryption, self.streaming, self.codec, 
+            self.chunk_size, self.codec_executor, progress, writer.open, self.integrity)
+        return ok and not writer.rejected
+
+    def mirror_put(self, directory, progress=None):
+        """
+        Put the tree of files under a local directory into 
+        the same path on the server. Files are sent as they
+        are found, without listing the tree first.
+        """
+        root = join(os.getcwd(), directory)
+        if not isdir(root):
+            print("{} is not a directory".format(root))
+            return False
+        self.wait()
+        self.conn.queue(MirrorPutRequest(directory))
+        skipped = list()
+        put_files(self.conn, root, walk_files(root, skipped), self.compression, self.encryption, self.streaming, self.codec, 
+            self.adaptive, self.chunk_size, self.sendfile, self.codec_executor, progress, batch=self.batch, 
+            integrity=self.integrity, skipped=skipped)
+        (rid, msg) = self._recvmsg()
+        if rid == MsgType.ErrorResponse:
+            self.error = msg.error_code
+            return False
+        return rid == MsgType.PutResponse and not skipped
+
+    def sync(self, directory, progress=None):
+        """
+        Put the files under a local directory that aren't in
+        the same path on the server or differ from the ones 
+        there. Only the local files whose size or mtime moved
+        are hashed again, and after the first sync the server 
+        only sends what changed on its side since.
+        """
+        root = join(os.getcwd(), directory)
+        if not isdir(root):
+            print("{} is not a directory".format(root))
+            return False
+        index = self.indexes.setdefault(root, FileIndex(root))
+        index.refresh()
+        root_path, epoch, generation, remote = self.manifests.pop(directory, ("", 0, 0, dict()))
+        self.wait()
+        # the server sends everything if directory leads to
+        # another tree than root_path since a cd.
+        self.conn.sendmsg(SyncRequest(directory, epoch, generation, root_path))
+        entries = 0
+        while True:
+            (rid, msg) = self._recvmsg()
+            if rid == MsgType.ErrorResponse:
+                self.error = msg.error_code
+                return False
+            if rid != MsgType.Manifest:
+                # protocol error, close conn.
+                print("Expected a Manifest, got: {}".format(msg))
+                self._close()
+                return False
+            if msg.full and not entries:
+                remote = dict()
+            for path, size, digest in msg.entries:
+                if size is None:
+                    remote.pop(path, None)
+                else:
+                    remote[path] = (size, digest)
+            entries += len(msg.entries)
+            if entries >= msg.count:
+                break
+        self.manifests[directory] = (msg.root, msg.epoch, msg.generation, remote)
+        changed = [path for path, entry in index.files().items() if remote.get(path) != entry]
+        if not changed:
+            return True
+        self.conn.queue(MirrorPutRequest(directory))
+        skipped = list()
+        put_files(self.conn, root, changed, self.compression, self.encryption, self.streaming, self.codec, 
+            self.adaptive, self.chunk_size, self.sendfile, self.codec_executor, progress, batch=self.batch, 
+            integrity=self.integrity, skipped=skipped)
+        (rid, msg) = self._recvmsg()
+        if rid == MsgType.ErrorResponse:
+            self.error = msg.error_code
+            return False
+        return rid == MsgType.PutResponse and not skipped
+
+    def start_get(self, filenames, progress=None):
+        """
+        Starts getting filenames on a stream of their own and
+        returns the stream id. The files come in while other
+        commands run, wait finishes the get. Needs V3 framing,
+        returns None without it.
+        """
+        if self.conn.framing < FramingVersion.V3:
+            return None
+        stream = self.next_stream
+        self.next_stream = self.next_stream % 0xFFFF + 1
+        # the settings of the get are the ones at the time 
+        # of the request, like on the server.
+        make_receiver = functools.partial(FilesReceiver, self.conn, os.getcwd(), compression=self.compression,
+            encryption=self.encryption, streaming=self.streaming, codec=self.codec, chunk_size=self.chunk_size, 
+            executor=self.codec_executor, progress=progress, integrity=self.integrity)
+        self.streams[stream] = BackgroundGet(stream, filenames, make_receiver)
+        msg = GetRequest(filenames)
+        msg.stream = stream
+        self.conn.sendmsg(msg)
+        return stream
+
+    def wait(self, stream=None):
+        """
+        Receives until the get on stream is done, or all the 
+        running gets if stream is None. Returns True if they
+        all went alright.
+        """
+        streams = list(self.streams) if stream is None else [stream]
+        while any(s in self.streams for s in streams):
+            (rid, msg) = self.conn.recvmsg()
+            if msg.stream == 0:
+                print("Expected a message for a running get, got: {}".format(msg))
+                continue
+            self._stream_msg(rid, msg)
+        return all(self.finished.pop(s).ok for s in streams)
+
+    def pop_finished(self):
+        """
+        Returns the gets started with start_get that finished
+        since the last call and weren't waited for.
+        """
+        finished = list(self.finished.values())
+        self.finished.clear()
+        return finished
+
+    def _recvmsg(self):
+        """
+        Returns the next (rid, msg) on stream 0, messages for
+        running gets that come in before it are handed to them.
+        """
+        while True:
+            (rid, msg) = self.conn.recvmsg()
+            if msg.stream == 0:
+                return (rid, msg)
+            self._stream_msg(rid, msg)
+
+    def _stream_msg(self, rid, msg):
+        get = self.streams.get(msg.stream)
+        if get is None:
+            print("Got a {} on unknown stream {}".format(msg, msg.stream))
+            return
+        ok = get.receive(rid, msg)
+        if ok is not None:
+            get.ok = ok
+            del self.streams[msg.stream]
+            self.finished[msg.stream] = get
+
     def quit(self):
         """
         Sends a quit request to the server for proper cleanup. 
         """
+        self.wait()
         msg = QuitRequest()
-        sendmsg(self.socket, msg)
-        (rid, msg) = recvmsg(self.socket)
+        self.conn.sendmsg(msg)
+        (rid, msg) = self._recvmsg()
         if rid != MsgType.QuitResponse:
             print("Did not receive quit response from server")
         self._close()
@@ -162,43 +599,300 @@ class EffTeePeeClient():
         Doesn't do anything at the moment. Returns
         true if everything went alright
         """
-        value = not self.binary
-        msg = ChangeSettingsRequest("binary", value)
-        sendmsg(self.socket, msg)
-        (rid, msg) = recvmsg(self.socket)
-        if rid != MsgType.ChangeSettingsResponse:
-            return False
-        self.binary = value
-        return True
+        return self._request(*self._change_setting("binary", not self.binary))
     
     def toggle_compression(self):
         """
         Toggle compression on the connection. Returns
         true if everything went alright.
         """
-        value = not self.compression
-        msg = ChangeSettingsRequest("compression", value)
-        sendmsg(self.socket, msg)
-        (rid, msg) = recvmsg(self.socket)
-        if rid != MsgType.ChangeSettingsResponse:
-            return False
-        self.compression = value
-        return True
+        return self._request(*self._change_setting("compression", not self.compression))
     
     def toggle_encryption(self):
         """
         Toggle encryption on the connection. Returns
         true if everything went alright.
         """
-        value = not self.encryption
-        msg = ChangeSettingsRequest("encryption", value)
-        sendmsg(self.socket, msg)
-        (rid, msg) = recvmsg(self.socket)
+        return self._request(*self._change_setting("encryption", not self.encryption))
+    
+    def toggle_streaming(self):
+        """
+        Toggle streaming compression on the connection. 
+        Servers that don't know about streaming will answer
+        with an error and the connection stays in per-chunk 
+        mode. Returns true if everything went alright.
+        """
+        return self._request(*self._change_setting("streaming", not self.streaming))
+    
+    def toggle_adaptive(self):
+        """
+        Toggle adaptive compression on the connection, 
+        chunks that don't compress are sent raw. Returns
+        true if everything went alright.
+        """
+        return self._request(*self._change_setting("adaptive", not self.adaptive))
+    
+    def toggle_sendfile(self):
+        """
+        Toggle sending whole files with sendfile when 
+        compression and encryption are both off. Returns
+        true if everything went alright.
+        """
+        return self._request(*self._change_setting("sendfile", not self.sendfile))
+    
+    def toggle_batch(self):
+        """
+        Toggle sending small files together in batches, on
+        gets and puts of many files. Returns true if 
+        everything went alright.
+        """
+        return self._request(*self._change_setting("batch", not self.batch))
+    
+    def toggle_integrity(self):
+        """
+        Toggle checking every file transferred against a 
+        digest of its data sent after it. Returns true if 
+        everything went alright.
+        """
+        return self._request(*self._change_setting("integrity", not self.integrity))
+    
+    def set_codec(self, codec):
+        """
+        Pick the compression codec used on the connection.
+        The codec must be one the server advertised in its
+        ServerHello. Returns true if everything went alright.
+        """
+        if codec not in self.server_codecs:
+            return False
+        return self._request(*self._change_setting("codec", codec))
+    
+    def _change_setting(self, setting, value):
+        # the attribute of a setting has its name, it is only
+        # changed once the server took the new value.
+        def reply():
+            (rid, msg) = self._recvmsg()
+            if rid != MsgType.ChangeSettingsResponse:
+                return False
+            setattr(self, setting, value)
+            return True
+        return ChangeSettingsRequest(setting, int(value)), reply
+    
+    def set_chunk_size(self, mib):
+        """
+        Set the file chunk size in MiB, 0 goes back to the 
+        default. Chunks above 64 KiB need the V2 framing.
+        Returns true if everything went alright.
+        """
+        if mib > MAX_CHUNK_SIZE_MIB or (mib > 0 and self.conn.framing < FramingVersion.V2):
+            return False
+        msg = ChangeSettingsRequest("chunksize", mib)
+        self.conn.sendmsg(msg)
+        (rid, msg) = self._recvmsg()
         if rid != MsgType.ChangeSettingsResponse:
             return False
-        self.encryption = value
+        self.chunk_size = chunk_size_for(mib)
         return True
     
+    def set_pipeline(self, workers):
+        """
+        Encode and decode file chunks on a pool of workers
+        threads while the connection is busy, 0 turns the
+        pipelining off. This is a local setting, the server
+        isn't asked.
+        """
+        if self.codec_executor:
+            self.codec_executor.shutdown()
+            self.codec_executor = None
+        if workers > 0:
+            self.codec_executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pipeline_workers = workers
+        return True
+
+    def set_lanes(self, lanes):
+        """
+        Set the number of connections parallel_get and 
+        parallel_put spread files over. This is a local 
+        setting, the server isn't asked.
+        """
+        if lanes < 1:
+            return False
+        self.lanes = lanes
+        return True
+
+    def open_lane(self):
+        """
+        Opens another authenticated connection to the server
+        with the same settings and working directory as this
+        one. Returns None if that didn't work out.
+        """
+        lane = EffTeePeeClient()
+        lane.connect(*self.address)
+        if not lane.handshake(self.username, self.password):
+            return None
+        ok = True
+        if self.compression != lane.compression:
+            ok = ok and lane.toggle_compression()
+        if self.encryption != lane.encryption:
+            ok = ok and lane.toggle_encryption()
+        if self.streaming:
+            ok = ok and lane.toggle_streaming()
+        if self.adaptive:
+            ok = ok and lane.toggle_adaptive()
+        if self.sendfile:
+            ok = ok and lane.toggle_sendfile()
+        if self.batch:
+            ok = ok and lane.toggle_batch()
+        if self.integrity != lane.integrity:
+            ok = ok and lane.toggle_integrity()
+        if self.codec != lane.codec:
+            ok = ok and lane.set_codec(self.codec)
+        if self.chunk_size != lane.chunk_size:
+            ok = ok and lane.set_chunk_size(self.chunk_size // (1024 * 1024))
+        for directory in self.cd_history:
+            ok = ok and lane.cd(directory)
+        if not ok:
+            lane.quit()
+            return None
+        lane.codec_executor = self.codec_executor
+        return lane
+
+    def parallel_get(self, filenames):
+        """
+        Get files like get, spread by size over self.lanes 
+        connections to the server. Returns True if all of 
+        them went alright.
+        """
+        sizes = self.stat(filenames)
+        if sizes is None:
+            return False
+        return self._run_lanes("get", sizes)
+
+    def parallel_put(self, filenames):
+        """
+        Put files like put, spread by size over self.lanes
+        connections to the server. Returns True if all of 
+        them went alright.
+        """
+        cwd = os.getcwd()
+        sizes = dict()
+        for f in filenames:
+            if not isfile(join(cwd, f)):
+                print("{} does not exist".format(join(cwd, f)))
+                return False
+            sizes[f] = os.path.getsize(join(cwd, f))
+        return self._run_lanes("put", sizes)
+
+    def get_range(self, filename, offset, length, open_file):
+        """
+        Get length bytes of filename from offset on, written to
+        what open_file returns for the local path. Returns True
+        if everything went alright.
+        """
+        # the range comes back on stream 0.
+        self.wait()
+        msg = RangeGetRequest(filename, offset, length)
+        self.conn.sendmsg(msg)
+        (rid, msg) = self._recvmsg()
+        if rid == MsgType.ErrorResponse:
+            self.error = msg.error_code
+            return False
+        if rid != MsgType.GetResponse:
+            # protocol error, close conn.
+            print("Expected a GetResponse, got: {}".format(msg))
+            self._close()
+            return False
+        return get_files(self.conn, os.getcwd(), 1, self.compression, self.encryption, self.streaming, self.codec, 
+            self.chunk_size, self.codec_executor, open_file=open_file, integrity=self.integrity)
+
+    def segmented_get(self, filename, segments):
+        """
+        Get one file in up to segments ranges at the same time,
+        each over a lane of its own, written into place in a 
+        preallocated local file. Returns True if every range
+        arrived whole.
+        """
+        sizes = self.stat([filename])
+        if sizes is None:
+            return False
+        size = sizes[filename]
+        ranges = split_ranges(size, segments)
+        writers = list()
+        fd = os.open(join(os.getcwd(), filename), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            preallocate(fd, size)
+            for offset, length in ranges:
+                writers.append(PositionalWriter(fd, offset))
+
+            def run(lane, i):
+                offset, length = ranges[i]
+                return lane.get_range(filename, offset, length, lambda path: writers[i])
+
+            ok = self._on_lanes(list(range(len(ranges))), run)
+            if os.fstat(fd).st_size != size:
+                ok = False
+        finally:
+            os.close(fd)
+        # a range that came up short means the file changed
+        # on the server or a lane went wrong.
+        for writer, (offset, length) in zip(writers, ranges):
+            if writer.written != length:
+                print("Got {} of {} bytes at offset {}".format(writer.written, length, offset))
+                ok = False
+        if not ok:
+            # a partial file, or one with a range that didn't
+            # match its digest, isn't left behind.
+            os.remove(join(os.getcwd(), filename))
+        return ok
+
+    def _run_lanes(self, method, sizes):
+        batches = balance_lanes(sizes, self.lanes)
+        progress = TransferProgress(sizes)
+        ok = self._on_lanes(batches, lambda lane, batch: getattr(lane, method)(batch, progress.file_done))
+        progress.finish()
+        return ok
+
+    def _on_lanes(self, jobs, fn):
+        """
+        Runs fn(lane, job) for all jobs at the same time, on 
+        this connection and a lane of their own for each of 
+        the others. Lanes the server turns away, past its 
+        limit of sessions per user, leave their jobs to the 
+        lanes that opened, which take the next job once they
+        are done. Returns True if all of them returned True.
+        """
+        def open_lane(i):
+            try:
+                return self.open_lane()
+            except (OSError, ConnectionClosedException):
+                return None
+
+        def run(lane):
+            results = list()
+            while True:
+                try:
+                    job = queue.popleft()
+                except IndexError:
+                    return results
+                try:
+                    results.append(fn(lane, job))
+                except (OSError, ConnectionClosedException):
+                    results.append(False)
+
+        queue = collections.deque(jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            lanes = [lane for lane in pool.map(open_lane, range(len(jobs) - 1)) if lane is not None]
+            if len(lanes) < len(jobs) - 1:
+                print("Opened {} of {} lanes".format(len(lanes) + 1, len(jobs)))
+            try:
+                results = list(pool.map(run, [self] + lanes))
+            finally:
+                for lane in lanes:
+                    try:
+                        lane.quit()
+                    except (OSError, ConnectionClosedException):
+                        pass
+        return all(ok for lane_results in results for ok in lane_results)
+
     def normal(self):
         """
         Resets the compression and encryption to Off. Returns 
@@ -220,8 +914,218 @@ class EffTeePeeClient():
             cmd_str += "E"
         if self.compression:
             cmd_str += "C"
+        if self.streaming:
+            cmd_str += "S"
+        if self.adaptive:
+            cmd_str += "A"
         return cmd_str
         
+class BackgroundGet():
+    """
+    A get running on a stream of its own, see start_get.
+    ok is None until it is done, then True if all the
+    files arrived.
+    """
+    def __init__(self, stream, filenames, make_receiver):
+        self.stream = stream
+        self.filenames = filenames
+        self.make_receiver = make_receiver
+        self.receiver = None
+        self.ok = None
+
+    def receive(self, rid, msg):
+        """
+        Handles the next message on the stream, returns None
+        while the get is running, then True or False.
+        """
+        if self.receiver is None:
+            if rid != MsgType.GetResponse:
+                return False
+            self.receiver = self.make_receiver(msg.num_files)
+            return None
+        return self.receiver.receive(rid, msg)
+
+    def close(self):
+        if self.receiver:
+            self.receiver.close()
+
+class RequestQueue():
+    """
+    RequestQueue sends the requests of a client back to back
+    instead of waiting for the reply to each one before the
+    next goes out, so a run of commands costs about one round
+    trip instead of one each. Every request returns a Future
+    for what the client method of the same name returns. The
+    server answers requests in order, flush sends them and 
+    reads the replies in that order. Puts send their files
+    along with the request and aren't queued.
+    """
+    def __init__(self, client, window=REQUEST_WINDOW):
+        self.client = client
+        self.window = max(1, window)
+        self.requests = collections.deque()
+        # the settings the queued toggles leave behind.
+        self.settings = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self._fail(self.requests, exc)
+
+    def cd(self, directory):
+        return self._add(*self.client._cd(directory))
+
+    def ls(self, path):
+        return self._add(*self.client._ls(path))
+
+    def stat(self, filenames):
+        return self._add(*self.client._stat(filenames))
+
+    def get(self, filenames, progress=None):
+        return self._add(*self.client._get(filenames, progress))
+
+    def toggle(self, setting):
+        """
+        Queues a toggle of one of the on/off settings, like
+        toggle_compression does for "compression".
+        """
+        value = not self.settings.get(setting, getattr(self.client, setting))
+        self.settings[setting] = value
+        return self._add(*self.client._change_setting(setting, value))
+
+    def set_codec(self, codec):
+        if codec not in self.client.server_codecs:
+            future = concurrent.futures.Future()
+            future.set_result(False)
+            return future
+        return self._add(*self.client._change_setting("codec", codec))
+
+    def _add(self, msg, reply):
+        future = concurrent.futures.Future()
+        self.requests.append((future, msg, reply))
+        return future
+
+    def flush(self):
+        """
+        Sends the queued requests and reads their replies, 
+        their futures are all done when it returns. Once one
+        fails on the connection the ones after it fail too.
+        """
+        # the files of running gets would get in the way.
+        self.client.wait()
+        unsent, self.requests = self.requests, collections.deque()
+        self.settings.clear()
+        sent = collections.deque()
+        while unsent or sent:
+            # topped up once half the window is answered, so
+            # requests go out a few to a syscall.
+            if len(sent) <= self.window // 2:
+                while unsent and len(sent) < self.window:
+                    future, msg, reply = unsent.popleft()
+                    self.client.conn.queue(msg)
+                    sent.append((future, reply))
+            future, reply = sent.popleft()
+            try:
+                self.client.conn.flush()
+                future.set_result(reply())
+            except Exception as e:
+                future.set_exception(e)
+                self._fail(sent, e)
+                self._fail(unsent, e)
+                return
+
+    def _fail(self, requests, exc):
+        for request in requests:
+            request[0].set_exception(exc)
+        requests.clear()
+
+def balance_lanes(sizes, lanes):
+    """
+    balance_lanes splits the files in the sizes dict into at
+    most lanes lists with about the same number of bytes each,
+    handing out the largest files first.
+    """
+    lanes = max(1, min(lanes, len(sizes)))
+    heap = [(0, i) for i in range(lanes)]
+    batches = [list() for i in range(lanes)]
+    for filename in sorted(sizes, key=sizes.get, reverse=True):
+        total, i = heapq.heappop(heap)
+        batches[i].append(filename)
+        heapq.heappush(heap, (total + sizes[filename], i))
+    return [batch for batch in batches if batch]
+
+def split_ranges(size, segments):
+    """
+    split_ranges cuts size bytes into at most segments 
+    (offset, length) ranges of about the same length and
+    no less than MIN_SEGMENT_SIZE, except for the last.
+    """
+    segments = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+    step = max(1, -(-size // segments))
+    ranges = [(offset, min(step, size - offset)) for offset in range(0, size, step)]
+    return ranges or [(0, 0)]
+
+def preallocate(fd, size):
+    """
+    preallocate sizes the file fd to size bytes, reserving 
+    the disk space where the platform and filesystem can.
+    """
+    os.ftruncate(fd, size)
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass
+
+def split_flags(args):
+    """
+    split_flags returns the set of --flags at the start of
+    args and the rest of args.
+    """
+    flags = set()
+    while args and args[0].startswith("--"):
+        flags.add(args.pop(0))
+    return flags, args
+
+class TransferProgress():
+    """
+    Adds up the files and bytes done by all the lanes of a
+    parallel transfer and prints the running totals.
+    """
+    # least seconds between two progress lines
+    interval = 0.2
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.total_bytes = sum(sizes.values())
+        self.files = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.printed = 0
+        self.lock = threading.Lock()
+
+    def file_done(self, filename):
+        with self.lock:
+            self.files += 1
+            self.bytes += self.sizes.get(filename, 0)
+            now = time.monotonic()
+            if now - self.printed >= self.interval:
+                self.printed = now
+                print(self._line(now), end="\r", flush=True)
+
+    def finish(self):
+        print(self._line(time.monotonic()))
+
+    def _line(self, now):
+        elapsed = max(now - self.start, 1e-6)
+        mib = 1024 * 1024
+        return "{}/{} files, {:.1f}/{:.1f} MiB, {:.1f} MiB/s".format(self.files, len(self.sizes),
+            self.bytes / mib, self.total_bytes / mib, self.bytes / mib / elapsed)
+
 def main():
     #if len(sys.argv) < 3:
         #print("Missing <ip> <port> to connect to.")
@@ -249,6 +1153,8 @@ def main():
             return 0
         print("Welcome {}, type 'help' to get a list of commands.".format(client.username))
         while not client.closed:
+            for get in client.pop_finished():
+                print("Background get {} of {}: {}".format(get.stream, get.filenames, "done" if get.ok else "failed"))
             command_str = input("[{}]> ".format(client.get_command_string()))
             command = None 
             args = None
@@ -281,6 +1187,53 @@ def main():
                 ok = client.toggle_compression()
                 if not ok:
                     print("Could not change setting.")
+            elif command == "stream":
+                ok = client.toggle_streaming()
+                if not ok:
+                    print("Could not change setting.")
+            elif command == "adaptive":
+                ok = client.toggle_adaptive()
+                if not ok:
+                    print("Could not change setting.")
+            elif command == "sendfile":
+                ok = client.toggle_sendfile()
+                if not ok:
+                    print("Could not change setting.")
+            elif command == "batch":
+                ok = client.toggle_batch()
+                if not ok:
+                    print("Could not change setting.")
+            elif command == "integrity":
+                ok = client.toggle_integrity()
+                if not ok:
+                    print("Could not change setting.")
+            elif command == "codec":
+                codec = codec_by_name(args or "")
+                if codec is None:
+                    print("Unknown codec {}. Type 'codecs' to list them.".format(args))
+                    continue
+                ok = client.set_codec(codec)
+                if not ok:
+                    print("Could not change setting.")
+            elif command == "codecs":
+                for codec in client.server_codecs:
+                    print("\t", compression_codecs[codec].name)
+            elif command == "chunksize":
+                if args is None or not args.isdigit():
+                    print("Need a chunk size in MiB.")
+                    continue
+                ok = client.set_chunk_size(int(args))
+                if not ok:
+                    print("Could not change setting.")
+            elif command == "pipeline":
+                if args is None or not args.isdigit():
+                    print("Need a number of threads.")
+                    continue
+                client.set_pipeline(int(args))
+            elif command == "lanes":
+                if args is None or not args.isdigit() or not client.set_lanes(int(args)):
+                    print("Need a number of connections, 1 or more.")
+                    continue
             elif command == "binary":
                 ok = client.toggle_binary()
                 if not ok:
@@ -293,37 +1246,91 @@ def main():
                 print("Binary: ", client.binary)
                 print("Compression: ", client.compression)
                 print("Encryption: ", client.encryption)
+                print("Streaming: ", client.streaming)
+                print("Codec: ", compression_codecs[client.codec].name)
+                print("Adaptive: ", client.adaptive)
+                print("Chunk size: ", client.chunk_size)
+                print("Sendfile: ", client.sendfile)
+                print("Batch: ", client.batch)
+                print("Integrity: ", client.integrity)
+                print("Pipeline: ", client.pipeline_workers)
+                print("Lanes: ", client.lanes)
+                print("Framing: ", int(client.conn.framing))
             elif command == "cd":
                 ok = client.cd(args)
                 if not ok:
                     print("Could not change directory.")
             elif command == "get":
-                filename = args.split(" ")
-                if len(filename) > 1:
+                flags, filename = split_flags(args.split(" "))
+                if len(filename) != 1:
                     print("Can only GET 1 file at a time. Use MGET instead.")
                     continue
-                ok = client.get(filename)
+                if "--resume" in flags:
+                    ok = client.resume_get(filename[0])
+                elif "--delta" in flags:
+                    ok = client.delta_get(filename[0])
+                elif "--mirror" in flags:
+                    ok = client.mirror_get(filename[0])
+                else:
+                    ok = client.get(filename)
                 if not ok:
                     print("Could not get {} from the server.".format(filename))
                 print("GET Success: {}".format(filename))
+            elif command == "bget":
+                filenames = args.split(" ")
+                stream = client.start_get(filenames)
+                if stream is None:
+                    print("The server doesn't support background gets.")
+                    continue
+                print("Started background get {}: {}".format(stream, filenames))
+            elif command == "wait":
+                ok = client.wait()
+                print("Background gets {}.".format("done" if ok else "failed"))
+            elif command == "sget":
+                ok = client.segmented_get(args, client.lanes)
+                if not ok:
+                    print("Could not get {} from the server.".format(args))
+                    continue
+                print("SGET Success: {}".format(args))
             elif command == "mget":
                 filenames = args.split(" ")
-                ok = client.get(filenames)
+                if client.lanes > 1:
+                    ok = client.parallel_get(filenames)
+                else:
+                    ok = client.get(filenames)
                 if not ok:
                     print("Could not get {} from the server.".format(filenames))
                 print("MGET Success: {}".format(filenames))
             elif command == "put":
-                filename = args.split(" ")
-                if len(filename) > 1:
+                flags, filename = split_flags(args.split(" "))
+                if len(filename) != 1:
                     print("Can only PUT 1 file at a time. Use MPUT instead.")
                     continue
-                ok = client.put(filename)
+                if "--resume" in flags:
+                    ok = client.resume_put(filename[0])
+                elif "--delta" in flags:
+                    ok = client.delta_put(filename[0])
+                elif "--dedup" in flags:
+                    ok = client.dedup_put(filename[0])
+                elif "--mirror" in flags:
+                    ok = client.mirror_put(filename[0])
+                else:
+                    ok = client.put(filename)
                 if not ok:
                     print("Could not get {} from the server.".format(filename))
                 print("PUT Success: {}".format(filename))
+            elif command == "sync":
+                ok = client.sync(args)
+                if not ok:
+                    print("Could not sync {} to the server.".format(args))
+                    continue
+                print("SYNC Success: {}".format(args))
             elif command == "mput":
                 filenames = args.split(" ")
-                ok = client.put(filenames)
+                if client.lanes > 1:
+                    ok = client.parallel_put(filenames)
+                else:
+                    ok = client.put(filenames)
                 if not ok:
                     print("Could not get {} from the server.".format(filenames))
                 print("MPUT Success: {}".format(filenames))
@@ -341,13 +1348,27 @@ name - (arguments) - description
 cd - (path) - Change directory on the server. 
 ls - (path) - Display files and folders in the current directory.
 dir - (path) - Display files and folders in the current directory.
-get - (file1) - Download a file from the server.
-put - (file1) - Upload a file to the server.
+get - ([--resume|--delta|--mirror] file1) - Download a file. --resume gets the rest of a partial file, --delta only changed blocks, --mirror a whole directory tree.
+put - ([--resume|--delta|--dedup|--mirror] file1) - Upload a file. --resume puts the rest of a partial file, --delta only changed blocks, --dedup only chunks new to the server, --mirror a whole directory tree.
 mget - (file1, file2, ...) - Download multiple files from the server.
 mput - (file1, file2, ...) - Upload multiple files to the server.
+sync - (directory) - Upload the files of a directory tree that are new or changed on the server.
+bget - (file1, file2, ...) - Download files in the background while other commands run.
+wait - () - Wait for the background gets to finish.
 binary - () - Toggle binary mode on the connection. (not implemented)
 compress - () - Toggle compression on the file transfers.
 encrypt - () - Toggle encryption on the file transfers.
+stream - () - Toggle one compression stream per file instead of per chunk.
+adaptive - () - Toggle sending chunks that don't compress raw.
+sendfile - () - Toggle zero-copy transfers when compression and encryption are off.
+batch - () - Toggle sending files of up to 64 KiB together in batches.
+integrity - () - Toggle checking every file transferred against a BLAKE2b digest.
+codec - (name) - Pick the compression codec, e.g. lzma, zlib-1, bz2, lzma2-0.
+codecs - () - List the compression codecs the server supports.
+chunksize - (MiB) - Set the file chunk size, 1-16 MiB, 0 for the default.
+pipeline - (threads) - Encode and decode chunks on this many threads, 0 for off.
+lanes - (connections) - Spread mget and mput over this many connections.
+sget - (file1) - Download a file in ranges over as many connections as lanes.
 normal - () - Reset to no encryption and no compression on file transfers.
 settings - () - Print the current connection settings.
 quit - () - Quit the program.
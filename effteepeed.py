@@ -1,31 +1,73 @@
 # EffTeePee Server
 
 import socketserver
+import asyncio
+import argparse
+import threading
+import concurrent.futures
+import multiprocessing
+import time
 import hashlib
 import sys
 import glob
 import os
-from os import listdir
-from os.path import isfile, join
+import socket
+import signal
+import functools
+import fcntl
+import collections
+import traceback
+import shutil
+from os.path import isfile, isdir, join
 
 from common import *
 
-class EffTeePeeServer(socketserver.ThreadingTCPServer):
+# ioctl that makes a file a copy on write clone of another
+# on filesystems like btrfs and xfs.
+FICLONE = 0x40049409
+
+class UserTableMixin():
     """
-    Code example from https://docs.python.org/3.5/library/socketserver.html
-    This is the EffTeePee server that will create a new
-    thread for each incoming connection. It will hold a 
-    mapping of users with their associated password hash
-    and root directory. 
+    Holds the mapping of users with their associated 
+    password hash and root directory for the threaded 
+    and the asyncio servers. 
     """
+    # with a ChunkStore, dedup puts keep their chunks in it
+    # and the files are linked from there.
+    chunk_store = None
+    # with a ChunkCache, gets of whole files replay the
+    # chunks encoded for an earlier get.
+    chunk_cache = None
+    # with an index_dir, the FileIndex of every user root
+    # synced is kept there, otherwise only in memory.
+    index_dir = None
+
+    def file_index(self, root, create=True):
+        """
+        Returns the FileIndex of the tree under root, loaded
+        or made the first time. With create False it is None
+        if that didn't happen yet.
+        """
+        root = os.path.realpath(root)
+        with self.indexes_lock:
+            index = self.indexes.get(root)
+            if index is None and create:
+                path = None
+                if self.index_dir:
+                    os.makedirs(self.index_dir, exist_ok=True)
+                    path = join(self.index_dir, hashlib.sha256(root.encode("utf-8")).hexdigest() + ".index")
+                index = self.indexes[root] = FileIndex(root, path)
+            return index
+
+    def print_stats(self):
+        """
+        Prints the hit and miss counters of the caches, 
+        main has kill -USR1 call it.
+        """
+        print(self.listing_cache, flush=True)
+        if self.chunk_cache:
+            print(self.chunk_cache, flush=True)
 
-    def __init__(self, hostport, handler, user_file=DEFAULT_USER_FILE):
-        super().__init__(hostport, handler)
-        # declare instance variables
-        self.users = dict()
-        self.parse_user_file(user_file)
-        return
-    
     def parse_user_file(self, user_file):
         with open(user_file) as f:
             for line in f:
@@ -58,31 +100,220 @@ class EffTeePeeServer(socketserver.ThreadingTCPServer):
                 return (True, user["directory"])
         return (False, "")    
 
+    def open_session(self, username):
+        """
+        Called when username has authenticated, returns 
+        False if the user can't have another session.
+        """
+        return True
+
+    def close_session(self, username):
+        """
+        Called when a session opened with open_session ends.
+        """
+        return
+
+
+class EffTeePeeServer(UserTableMixin, socketserver.ThreadingTCPServer):
+    """
+    Code example from https://docs.python.org/3.5/library/socketserver.html
+    This is the EffTeePee server that will create a new
+    thread for each incoming connection. It will hold a 
+    mapping of users with their associated password hash
+    and root directory. 
+    """
+    # with codec_workers set, transfers encode and decode 
+    # chunks on a pool of that many threads, or processes 
+    # with codec_processes, started by serve_forever.
+    codec_workers = 0
+    codec_processes = False
+    codec_executor = None
+
+    def __init__(self, hostport, handler, user_file=DEFAULT_USER_FILE):
+        super().__init__(hostport, handler)
+        # declare instance variables
+        self.users = dict()
+        self.parse_user_file(user_file)
+        self.listing_cache = ListingCache()
+        self.indexes = dict()
+        self.indexes_lock = threading.Lock()
+        return
+
+    def serve_forever(self, poll_interval=0.5):
+        if self.codec_workers and self.codec_executor is None:
+            # started here rather than in __init__ so every
+            # process forked by PreforkSupervisor has its own.
+            if self.codec_processes:
+                # handler threads are running by the time the 
+                # pool starts, so don't fork.
+                context = multiprocessing.get_context("spawn")
+                self.codec_executor = concurrent.futures.ProcessPoolExecutor(self.codec_workers, context)
+            else:
+                self.codec_executor = concurrent.futures.ThreadPoolExecutor(self.codec_workers)
+        super().serve_forever(poll_interval)
+
+    def server_close(self):
+        super().server_close()
+        if self.codec_executor:
+            self.codec_executor.shutdown(wait=False)
+
+
+class PooledEffTeePeeServer(EffTeePeeServer):
+    """
+    EffTeePee server that runs connections on a fixed pool
+    of worker threads instead of a new thread each. At most
+    max_sessions connections can be running or waiting for
+    a worker, a connection that waits longer than 
+    queue_timeout seconds is turned away, and each user can 
+    have max_user_sessions at a time. Turned away clients 
+    get a ServerBusy error instead of hanging.
+    """
+
+    def __init__(self, hostport, handler, user_file=DEFAULT_USER_FILE, workers=16,
+            max_sessions=64, max_user_sessions=4, backlog=64, queue_timeout=10):
+        # used by server_activate for listen()
+        self.request_queue_size = backlog
+        super().__init__(hostport, handler, user_file)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.max_sessions = max_sessions
+        self.max_user_sessions = max_user_sessions
+        self.queue_timeout = queue_timeout
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.user_sessions = dict()
+        return
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            admitted = self.sessions < self.max_sessions
+            if admitted:
+                self.sessions += 1
+        if not admitted:
+            print("Too many sessions, turning away {}".format(client_address))
+            self.refuse_request(request)
+            return
+        self.pool.submit(self.process_request_worker, request, client_address, time.monotonic())
+
+    def process_request_worker(self, request, client_address, queued_at):
+        try:
+            if time.monotonic() - queued_at > self.queue_timeout:
+                print("{} waited too long for a worker".format(client_address))
+                self.refuse_request(request)
+                return
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.lock:
+                self.sessions -= 1
+
+    def refuse_request(self, request):
+        """
+        Answers the ClientHello on request with a ServerBusy
+        error and closes the connection. Runs on the thread
+        that accepts connections, so nothing here blocks.
+        """
+        try:
+            # read the ClientHello if it has arrived so closing
+            # doesn't reset the connection before the client 
+            # reads the error. One that comes later resets it
+            # after the error and the FIN from shutdown_request,
+            # which the client reads first.
+            request.setblocking(False)
+            try:
+                request.recv(1024)
+            except BlockingIOError:
+                pass
+            sendmsg(request, ErrorResponse(ErrorCodes.ServerBusy))
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def open_session(self, username):
+        with self.lock:
+            count = self.user_sessions.get(username, 0)
+            if count >= self.max_user_sessions:
+                return False
+            self.user_sessions[username] = count + 1
+        return True
+
+    def close_session(self, username):
+        with self.lock:
+            self.user_sessions[username] -= 1
+            if not self.user_sessions[username]:
+                del self.user_sessions[username]
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
 
 class EffTeePeeHandler(socketserver.BaseRequestHandler):
     """
     Each connection will create a new EffTeePeeHandler. 
+    With V3 framing gets and puts run on the stream of 
+    their request, in turns with each other and with the
+    requests on other streams.
     """
+    max_framing = FramingVersion.V3
+
     def setup(self):
         # setup is automatically called by the server when creating a new connection.
         # connection variables
         self.binary = True 
         self.compression = False 
         self.encryption = False
+        self.streaming = False
+        self.codec = CodecType.LZMA
+        self.adaptive = False
+        self.chunk_size = DEFAULT_FILE_CHUNK_SIZE
+        self.sendfile = False
+        self.batch = False
+        self.integrity = False
+        self.conn = self.make_connection()
         self.username = None
         self.root_directory = None
         self.cwd = None
         self.quit = False
+        # paths of the files put since the last _put_done.
+        self.received = list()
+        # stream of the request being handled, replies go on it.
+        self.stream = 0
+        # running gets and puts on a multiplexed connection,
+        # by stream: put_files_steps generators and FilesReceivers.
+        self.transfers = dict()
+        self.deficits = dict()
+        self.receivers = dict()
+        # a request that came in on the stream of a running 
+        # get, handled once the get is sent.
+        self.held = None
+        # called once a put's files are read, returns the
+        # error to reply with if there is one.
+        self.put_checks = dict()
         self.handlers = dict()
         self.handlers[MsgType.ClientHello] = self._handshake
         self.handlers[MsgType.CDRequest] = self._handle_cd
         self.handlers[MsgType.LSRequest] = self._handle_ls
         self.handlers[MsgType.GetRequest] = self._handle_get
         self.handlers[MsgType.PutRequest] = self._handle_put
+        self.handlers[MsgType.StatRequest] = self._handle_stat
+        self.handlers[MsgType.RangeGetRequest] = self._handle_range_get
+        self.handlers[MsgType.ResumeGetRequest] = self._handle_resume_get
+        self.handlers[MsgType.ResumePutRequest] = self._handle_resume_put
+        self.handlers[MsgType.DeltaGetRequest] = self._handle_delta_get
+        self.handlers[MsgType.DeltaPutRequest] = self._handle_delta_put
+        self.handlers[MsgType.DedupPutRequest] = self._handle_dedup_put
+        self.handlers[MsgType.MirrorGetRequest] = self._handle_mirror_get
+        self.handlers[MsgType.MirrorPutRequest] = self._handle_mirror_put
+        self.handlers[MsgType.SyncRequest] = self._handle_sync
         self.handlers[MsgType.QuitRequest] = self._handle_quit
         self.handlers[MsgType.ChangeSettingsRequest] = self._handle_change_setting
         return
 
+    def make_connection(self):
+        return Connection(self.request)
+
     def handle(self):
         """
         Called by the EffTeePee server when 
@@ -93,33 +324,105 @@ class EffTeePeeHandler(socketserver.BaseRequestHandler):
         except ConnectionClosedException:
             print("Connection closed unexpectedly")
             self._close()
+        finally:
+            self._abort_streams()
+        if self.username:
+            self.server.close_session(self.username)
         print("{} connection has closed.".format(self.username))
         return
     
     def _handle_commands(self):
         # enter into a for loop and try
         # to read the request id and send it the
-        # appropriate handler.
+        # appropriate handler. Running gets take turns
+        # sending whenever no message is waiting, and 
+        # messages on a put's stream go to its receiver.
+        # Pipelining clients send the next request before
+        # the get before it is done, it waits for the get
+        # and nothing more is read in the meantime.
         while not self.quit:
-            rid, msg = recvmsg(self.request)
-            if rid not in self.handlers:
-                print("No handler for message type: {}".format(str(MsgType(rid))))
-                self._close()
+            if self.held and self.held[1].stream not in self.transfers:
+                rid, msg = self.held
+                self.held = None
+                self._dispatch(rid, msg)
                 continue
-            handler = self.handlers[rid]
-            if not self.username and rid != MsgType.ClientHello:
-                # We haven't authenticated and we didn't get a ClientHello
-                # which is a protocol error so abort.
-                print("Client did not try to authenticate")
-                self._close()
+            if self.transfers and (self.held or not self.conn.readable()):
+                self._send_transfers()
                 continue
-            debug_print("Got a {} message: {}".format(str(MsgType(rid)),msg))
-            handler(msg)
+            rid, msg = self.conn.recvmsg()
+            if msg.stream in self.receivers:
+                self._receive_put(rid, msg)
+            elif msg.stream in self.transfers:
+                self.held = (rid, msg)
+            else:
+                self._dispatch(rid, msg)
         return
+
+    def _send_transfers(self):
+        """
+        Gives every running get a turn of about chunk_size
+        bytes. Unused or overdrawn bytes carry over to the
+        next turn (deficit round robin), so a stream sending
+        small compressed chunks gets its fair share too.
+        """
+        for stream in list(self.transfers):
+            deficit = self.deficits.get(stream, 0) + self.chunk_size
+            try:
+                while deficit > 0:
+                    deficit -= next(self.transfers[stream])
+            except StopIteration:
+                del self.transfers[stream]
+                self.deficits.pop(stream, None)
+                continue
+            self.deficits[stream] = deficit
+
+    def _receive_put(self, rid, msg):
+        self.stream = msg.stream
+        ok = self.receivers[msg.stream].receive(rid, msg)
+        if ok is not None:
+            del self.receivers[msg.stream]
+            check = self.put_checks.pop(msg.stream, None)
+            self._put_done(ok, check() if check else None)
+
+    def _abort_streams(self):
+        for steps in self.transfers.values():
+            steps.close()
+        for receiver in self.receivers.values():
+            receiver.close()
+        self.transfers.clear()
+        self.receivers.clear()
+        self.put_checks.clear()
+        self.held = None
+
+    def multiplexed(self):
+        return self.conn.framing >= FramingVersion.V3
+
+    def _dispatch(self, rid, msg):
+        """
+        Sends msg to the handler for its type and returns
+        whatever the handler returned.
+        """
+        if rid not in self.handlers:
+            print("No handler for message type: {}".format(str(MsgType(rid))))
+            self._close()
+            return
+        handler = self.handlers[rid]
+        if not self.username and rid != MsgType.ClientHello:
+            # We haven't authenticated and we didn't get a ClientHello
+            # which is a protocol error so abort.
+            print("Client did not try to authenticate")
+            self._close()
+            return
+        debug_print("Got a {} message: {}".format(str(MsgType(rid)),msg))
+        self.stream = msg.stream
+        return handler(msg)
     
     def sendmsg(self, msg):
+        # replies are queued and go out together when the
+        # connection next waits for a request.
         debug_print("Sent a {} message: {}".format(str(msg.id()), str(msg)))
-        sendmsg(self.request, msg)
+        msg.stream = self.stream
+        self.conn.queue(msg)
     
     def _close(self):
         """
@@ -127,11 +430,17 @@ class EffTeePeeHandler(socketserver.BaseRequestHandler):
         Close the connection and set quit to True
         so our _handle_commands will stop processing.
         """
-        self.request.close()
+        self.conn.close()
         self.quit = True 
         return
 
     def _handshake(self, msg):
+        if self.username:
+            # a second session on the connection would never
+            # be closed, only the first one is.
+            print("{} sent a second ClientHello".format(self.username))
+            self._close()
+            return
         # check authentication
         username = msg.username
         password = msg.password
@@ -142,13 +451,24 @@ class EffTeePeeHandler(socketserver.BaseRequestHandler):
             self.sendmsg(msg)
             self._close()
             return
+        if not self.server.open_session(username):
+            print("{} has too many sessions.".format(username))
+            self.sendmsg(ErrorResponse(ErrorCodes.ServerBusy))
+            self._close()
+            return
         print("{} authenticated.".format(username))
         self.username = username
         self.root_directory = directory
         self.cwd = directory
-        # send back ServerHello
-        msg = ServerHello(self.binary, self.compression, self.encryption)
+        # send back ServerHello, everything after it
+        # uses the framing we agreed on.
+        framing = negotiate_framing(msg.framing, self.max_framing)
+        # files are checked against digests whenever the 
+        # client can, it may still turn that off.
+        self.integrity = msg.integrity
+        msg = ServerHello(self.binary, self.compression, self.encryption, list(compression_codecs), framing, self.integrity)
         self.sendmsg(msg)
+        self.conn.framing = framing
         return
 
     def _handle_quit(self, msg):
@@ -175,13 +495,7 @@ class EffTeePeeHandler(socketserver.BaseRequestHandler):
                 parts = filename.split(os.path.sep)
                 files[i] = parts[-1]
         else:
-            # Regular os.listdir()
-            listings = listdir(path)
-            for l in listings:
-                if isfile(join(path,l)):
-                    files.append(l)
-                else:
-                    folders.append(l)
+            folders, files = self.server.listing_cache.listing(path)
 
         msg = LSResponse(folders, files)
         self.sendmsg(msg)
@@ -192,13 +506,33 @@ class EffTeePeeHandler(socketserver.BaseRequestHandler):
         s = msg.setting
         v = msg.value
         if s == "encryption":
-            self.encryption = v
+            self.encryption = bool(v)
         elif s == "compression":
-            self.compression = v
+            self.compression = bool(v)
         elif s == "binary":
-            self.binary = v
+            self.binary = bool(v)
+        elif s == "streaming":
+            self.streaming = bool(v)
+        elif s == "adaptive":
+            self.adaptive = bool(v)
+        elif s == "sendfile":
+            self.sendfile = bool(v)
+        elif s == "batch":
+            self.batch = bool(v)
+        elif s == "integrity":
+            self.integrity = bool(v)
+        elif s == "codec":
+            if v not in compression_codecs:
+                self.sendmsg(ErrorResponse(ErrorCodes.UnsupportedCodec))
+                return
+            self.codec = CodecType(v)
+        elif s == "chunksize":
+            if v > MAX_CHUNK_SIZE_MIB or (v > 0 and self.conn.framing < FramingVersion.V2):
+                self.sendmsg(ErrorResponse(ErrorCodes.BadChunkSize))
+                return
+            self.chunk_size = chunk_size_for(v)
         else:
-            sendmsg(self.request, ErrorResponse(ErrorCodes.UnknownSetting))
+            self.sendmsg(ErrorResponse(ErrorCodes.UnknownSetting))
             return
         self.sendmsg(ChangeSettingsResponse())
     
@@ -242,24 +576,842 @@ class EffTeePeeHandler(socketserver.BaseRequestHandler):
         # return files to client
         resmsg = GetResponse(len(filenames))
         self.sendmsg(resmsg)
-        return put_files(self.request, self.cwd, filenames, self.compression, self.encryption)
+        return self._send_files(filenames)
+
+    def _handle_range_get(self, msg):
+        error = self._range_error(msg)
+        if error:
+            self.sendmsg(ErrorResponse(error))
+            return
+        self.sendmsg(GetResponse(1))
+        return self._send_files([msg.filename], (msg.offset, msg.length))
+
+    def _range_error(self, msg):
+        """
+        Returns the error code for a RangeGetRequest that 
+        can't be served, None if it can. A range that runs
+        past the end of the file is cut short.
+        """
+        fp = join(self.cwd, msg.filename)
+        if not isfile(fp):
+            return ErrorCodes.NotExists
+        if msg.offset > os.path.getsize(fp):
+            return ErrorCodes.BadRange
+        return None
+
+    def _handle_resume_get(self, msg):
+        error = self._resume_error(msg)
+        if error:
+            self.sendmsg(ErrorResponse(error))
+            return
+        self.sendmsg(GetResponse(1))
+        return self._send_files([msg.filename], (msg.offset, None))
+
+    def _resume_error(self, msg):
+        """
+        Returns the error code for a resume request if the
+        part of the file it has doesn't match the one here,
+        None if the transfer can go on from its offset.
+        """
+        fp = join(self.cwd, msg.filename)
+        if not isfile(fp):
+            return ErrorCodes.NotExists
+        with open(fp, "rb") as f:
+            if msg.offset > os.fstat(f.fileno()).st_size:
+                return ErrorCodes.BadRange
+            if resume_fingerprint(f, msg.offset) != msg.fingerprint:
+                return ErrorCodes.ResumeMismatch
+        return None
+
+    def _handle_delta_get(self, msg):
+        # the client's signatures follow the request.
+        signatures = recv_signatures(self.conn)
+        if signatures is None:
+            # protocol error, close conn.
+            print("Expected Signatures after a DeltaGetRequest")
+            self._close()
+            return
+        if not isfile(join(self.cwd, msg.filename)):
+            self.sendmsg(ErrorResponse(ErrorCodes.NotExists))
+            return
+        self.sendmsg(GetResponse(1))
+        return self._send_files([msg.filename], open_file=functools.partial(open_delta, signatures=signatures))
+
+    def _handle_mirror_get(self, msg):
+        root = join(self.cwd, msg.filename)
+        if not isdir(root):
+            self.sendmsg(ErrorResponse(ErrorCodes.NotExists))
+            return
+        # the number of files isn't known until the walk is 
+        # done, they go out as they are found.
+        self.sendmsg(GetResponse(0))
+        # entries that can't be read are left out, the client
+        # isn't waiting for a count.
+        return self._send_files(walk_files(root), cwd=root, skipped=list())
+
+    def _send_files(self, filenames, file_range=None, open_file=None, cwd=None, skipped=None):
+        cwd = cwd or self.cwd
+        if self.multiplexed():
+            # sent by _handle_commands, in turns with the 
+            # other streams.
+            self.transfers[self.stream] = put_files_steps(self.conn, cwd, filenames, self.compression, self.encryption, 
+                self.streaming, self.codec, self.adaptive, self.chunk_size, self.sendfile, self.server.codec_executor, 
+                stream=self.stream, file_range=file_range, open_file=open_file, cache=self.server.chunk_cache, batch=self.batch, 
+                integrity=self.integrity, skipped=skipped)
+            return True
+        return put_files(self.conn, cwd, filenames, self.compression, self.encryption, self.streaming, self.codec, self.adaptive, 
+            self.chunk_size, self.sendfile, self.server.codec_executor, file_range=file_range, open_file=open_file, 
+            cache=self.server.chunk_cache, batch=self.batch, integrity=self.integrity, skipped=skipped)
+
+    def _handle_stat(self, msg):
+        sizes = list()
+        for f in msg.filenames:
+            fp = join(self.cwd, f)
+            if not isfile(fp):
+                self.sendmsg(ErrorResponse(ErrorCodes.NotExists))
+                return
+            sizes.append(os.path.getsize(fp))
+        self.sendmsg(StatResponse(sizes))
 
     def _handle_put(self, msg):
-        num_files = msg.num_files
-        cwd = self.cwd
-        ok = get_files(self.request, cwd, num_files, self.compression, self.encryption)
+        self._receive_files(msg.num_files)
+
+    def _handle_resume_put(self, msg):
+        # the rest of the file follows the request either 
+        # way, if it can't be resumed it is read and dropped.
+        error = self._resume_error(msg)
+        if error:
+            open_file = open_for_discard
+        else:
+            open_file = functools.partial(open_for_resume, offset=msg.offset)
+        self._receive_files(1, open_file, lambda: error)
+
+    def _handle_delta_put(self, msg):
+        fp = join(self.cwd, msg.filename)
+        signatures = signature_msgs(fp)
+        for sig in signatures:
+            self.sendmsg(sig)
+        # the delta is written to the patcher whatever name
+        # its File message has.
+        patcher = DeltaPatcher(fp, signatures[0].block_size)
+        self._receive_files(1, lambda path: patcher, functools.partial(delta_error, patcher))
+
+    def _handle_dedup_put(self, msg):
+        # the chunk list follows the request.
+        hashes = recv_chunk_hashes(self.conn)
+        if hashes is None:
+            # protocol error, close conn.
+            print("Expected ChunkHashes after a DedupPutRequest")
+            self._close()
+            return
+        store = self.server.chunk_store
+        if store is None:
+            self.sendmsg(ErrorResponse(ErrorCodes.NoChunkStore))
+            return
+        replies = self._missing_chunks(hashes)
+        for reply in replies:
+            self.sendmsg(reply)
+        writer, check = self._dedup_writer(msg, hashes, replies)
+        self._receive_files(1, lambda path: writer, check)
+
+    def _handle_mirror_put(self, msg):
+        root = join(self.cwd, msg.filename)
+        writer = TreeWriter(root)
+        self._receive_files(None, writer.open, functools.partial(self._mirror_error, writer), root)
+
+    def _mirror_error(self, writer):
+        if writer.rejected:
+            return ErrorCodes.PutFilesFailed
+        return None
+
+    def _handle_sync(self, msg):
+        replies = self._manifest(msg)
+        if replies is None:
+            self.sendmsg(ErrorResponse(ErrorCodes.NotExists))
+            return
+        for reply in replies:
+            self.sendmsg(reply)
+
+    def _manifest(self, msg):
+        """
+        Returns the Manifest replies to a SyncRequest, None if
+        its path is outside the user's root. A tree that isn't
+        there yet has no files.
+        """
+        index = self.server.file_index(self.root_directory)
+        prefix = os.path.relpath(os.path.realpath(join(self.cwd, msg.path)), index.root)
+        if prefix == ".." or prefix.startswith(".." + os.sep):
+            return None
+        prefix = "" if prefix == "." else prefix.replace(os.sep, "/") + "/"
+        # the disk is only walked the first time, _put_done
+        # keeps the index current after that.
+        index.refresh_once(prefix)
+        if msg.root != prefix.rstrip("/"):
+            # the client's generation is of another tree, one
+            # cd away from this one.
+            return manifest_msgs(index, prefix, 0, 0)
+        return manifest_msgs(index, prefix, msg.epoch, msg.generation)
+
+    def _received_file(self, cwd, filename):
+        self.received.append(join(cwd, filename))
+
+    def _update_index(self, filenames):
+        index = self.server.file_index(self.root_directory, create=False)
+        if index is not None:
+            index.update(filenames)
+
+    def _missing_chunks(self, hashes):
+        """
+        Returns the MissingChunks replies to the ChunkHashes
+        messages hashes.
+        """
+        store = self.server.chunk_store
+        return [MissingChunks([not store.has(digest) for digest, length in msg.chunks]) for msg in hashes]
+
+    def _dedup_writer(self, msg, hashes, replies):
+        """
+        Returns the StoreWriter for the chunks of a dedup put
+        that replies asked for, and a check for when they 
+        are in that links the file into place and returns 
+        the error to reply with if that failed.
+        """
+        store = self.server.chunk_store
+        missing = list()
+        for group, reply in zip(hashes, replies):
+            missing.extend(chunk for i, chunk in enumerate(group.chunks) if reply.is_missing(i))
+        writer = StoreWriter(store, missing)
+        chunks = [chunk for group in hashes for chunk in group.chunks]
+        fp = join(self.cwd, msg.filename)
+
+        def check():
+            if not writer.done() or not store.link([digest for digest, length in chunks], fp):
+                return ErrorCodes.PutFilesFailed
+            return None
+        return writer, check
+
+    def _receive_files(self, num_files, open_file=None, check=None, cwd=None):
+        cwd = cwd or self.cwd
+        if self.multiplexed():
+            # fed by _handle_commands as the messages on
+            # this stream come in.
+            self.receivers[self.stream] = FilesReceiver(self.conn, cwd, num_files, self.compression, self.encryption, 
+                self.streaming, self.codec, self.chunk_size, self.server.codec_executor, 
+                functools.partial(self._received_file, cwd), open_file, self.integrity)
+            self.put_checks[self.stream] = check
+            return
+        ok = get_files(self.conn, cwd, num_files, self.compression, self.encryption, self.streaming, self.codec, 
+            self.chunk_size, self.server.codec_executor, functools.partial(self._received_file, cwd), open_file, self.integrity)
+        self._put_done(ok, check() if check else None)
+
+    def _put_done(self, ok, error=None):
+        # the directory's mtime would tell too, but it
+        # may not have ticked over since it was listed.
+        self.server.listing_cache.invalidate(self.cwd)
+        # files of puts still running on other streams are 
+        # complete too once they are in received.
+        received, self.received = self.received, list()
+        self._update_index(received)
+        if error:
+            self.sendmsg(ErrorResponse(error))
+            return
         if not ok:
+            # one reply per request, or a pipelining client
+            # takes the PutResponse for the next one's.
             self.sendmsg(ErrorResponse(ErrorCodes.PutFilesFailed))
+            return
         self.sendmsg(PutResponse())
 
+class AsyncEffTeePeeHandler(EffTeePeeHandler):
+    """
+    Runs the EffTeePeeHandler commands for one connection
+    as a coroutine on the asyncio server. Handshake, settings
+    and quit only queue replies so they run unchanged on the
+    event loop. cd and ls are run as-is on the executor since
+    they stat the disk, and get and put move file data with
+    the async transfer functions. Streams aren't supported,
+    so the framing stops at V2.
+    """
+    max_framing = FramingVersion.V2
+
+    def __init__(self, server, reader, writer):
+        # BaseRequestHandler.__init__ would run handle() right
+        # away, the server awaits run() instead.
+        self.server = server
+        self.request = writer.get_extra_info("socket")
+        self.client_address = writer.get_extra_info("peername")
+        self.reader = reader
+        self.writer = writer
+        self.index_updates = list()
+        self.setup()
+
+    def make_connection(self):
+        return AsyncConnection(self.reader, self.writer, executor=self.server.executor)
+
+    async def run(self):
+        try:
+            while not self.quit:
+                # like Connection, replies go out once the next
+                # request isn't in yet, those to pipelined ones
+                # together.
+                if not await self.conn.buffered():
+                    await self.conn.flush()
+                rid, msg = await self.conn.recvmsg()
+                result = self._dispatch(rid, msg)
+                if asyncio.iscoroutine(result):
+                    await result
+        except (ConnectionClosedException, ConnectionError):
+            print("Connection closed unexpectedly")
+            self._close()
+        if self.username:
+            self.server.close_session(self.username)
+        print("{} connection has closed.".format(self.username))
+
+    async def _handle_cd(self, msg):
+        await self.conn.run(super()._handle_cd, msg)
+
+    async def _handle_ls(self, msg):
+        await self.conn.run(super()._handle_ls, msg)
+
+    async def _handle_stat(self, msg):
+        await self.conn.run(super()._handle_stat, msg)
+
+    async def _handle_get(self, msg):
+        filenames = msg.filenames
+        for f in filenames:
+            fp = join(self.cwd, f)
+            if not await self.conn.run(isfile, fp):
+                self.sendmsg(ErrorResponse(ErrorCodes.NotExists))
+                return
+        self.sendmsg(GetResponse(len(filenames)))
+        return await put_files_async(self.conn, self.cwd, filenames, self.compression, self.encryption, self.streaming, self.codec, self.adaptive, self.chunk_size, self.sendfile, 
+            cache=self.server.chunk_cache, batch=self.batch, integrity=self.integrity)
+
+    async def _handle_range_get(self, msg):
+        error = await self.conn.run(self._range_error, msg)
+        if error:
+            self.sendmsg(ErrorResponse(error))
+            return
+        self.sendmsg(GetResponse(1))
+        return await put_files_async(self.conn, self.cwd, [msg.filename], self.compression, self.encryption, self.streaming, 
+            self.codec, self.adaptive, self.chunk_size, self.sendfile, (msg.offset, msg.length), 
+            integrity=self.integrity)
+
+    async def _handle_resume_get(self, msg):
+        error = await self.conn.run(self._resume_error, msg)
+        if error:
+            self.sendmsg(ErrorResponse(error))
+            return
+        self.sendmsg(GetResponse(1))
+        return await put_files_async(self.conn, self.cwd, [msg.filename], self.compression, self.encryption, self.streaming, 
+            self.codec, self.adaptive, self.chunk_size, self.sendfile, (msg.offset, None), 
+            integrity=self.integrity)
+
+    async def _handle_resume_put(self, msg):
+        error = await self.conn.run(self._resume_error, msg)
+        if error:
+            open_file = open_for_discard
+        else:
+            open_file = functools.partial(open_for_resume, offset=msg.offset)
+        ok = await get_files_async(self.conn, self.cwd, 1, self.compression, self.encryption, self.streaming, self.codec, open_file, 
+            functools.partial(self._received_file, self.cwd), self.integrity)
+        self._put_done(ok, error)
+
+    async def _handle_delta_get(self, msg):
+        signatures = await recv_signatures_async(self.conn)
+        if signatures is None:
+            # protocol error, close conn.
+            print("Expected Signatures after a DeltaGetRequest")
+            self._close()
+            return
+        if not await self.conn.run(isfile, join(self.cwd, msg.filename)):
+            self.sendmsg(ErrorResponse(ErrorCodes.NotExists))
+            return
+        self.sendmsg(GetResponse(1))
+        return await put_files_async(self.conn, self.cwd, [msg.filename], self.compression, self.encryption, self.streaming, 
+            self.codec, self.adaptive, self.chunk_size, self.sendfile, open_file=functools.partial(open_delta, signatures=signatures), 
+            integrity=self.integrity)
+
+    async def _handle_delta_put(self, msg):
+        fp = join(self.cwd, msg.filename)
+        signatures = await self.conn.run(signature_msgs, fp)
+        for sig in signatures:
+            self.sendmsg(sig)
+        # the client waits for them before sending the delta.
+        await self.conn.flush()
+        patcher = DeltaPatcher(fp, signatures[0].block_size)
+        ok = await get_files_async(self.conn, self.cwd, 1, self.compression, self.encryption, self.streaming, self.codec, 
+            lambda path: patcher, functools.partial(self._received_file, self.cwd), self.integrity)
+        self._put_done(ok, delta_error(patcher))
+
+    async def _handle_dedup_put(self, msg):
+        hashes = await recv_chunk_hashes_async(self.conn)
+        if hashes is None:
+            # protocol error, close conn.
+            print("Expected ChunkHashes after a DedupPutRequest")
+            self._close()
+            return
+        if self.server.chunk_store is None:
+            self.sendmsg(ErrorResponse(ErrorCodes.NoChunkStore))
+            return
+        replies = await self.conn.run(self._missing_chunks, hashes)
+        for reply in replies:
+            self.sendmsg(reply)
+        await self.conn.flush()
+        writer, check = self._dedup_writer(msg, hashes, replies)
+        ok = await get_files_async(self.conn, self.cwd, 1, self.compression, self.encryption, self.streaming, self.codec, 
+            lambda path: writer, functools.partial(self._received_file, self.cwd), self.integrity)
+        self._put_done(ok, await self.conn.run(check))
+
+    async def _handle_mirror_get(self, msg):
+        root = join(self.cwd, msg.filename)
+        if not await self.conn.run(isdir, root):
+            self.sendmsg(ErrorResponse(ErrorCodes.NotExists))
+            return
+        self.sendmsg(GetResponse(0))
+        return await put_files_async(self.conn, root, walk_files(root), self.compression, self.encryption, self.streaming, 
+            self.codec, self.adaptive, self.chunk_size, self.sendfile, cache=self.server.chunk_cache, batch=self.batch, 
+            integrity=self.integrity, skipped=list())
+
+    async def _handle_mirror_put(self, msg):
+        root = join(self.cwd, msg.filename)
+        writer = TreeWriter(root)
+        ok = await get_files_async(self.conn, root, None, self.compression, self.encryption, self.streaming, self.codec, 
+            writer.open, functools.partial(self._received_file, root), self.integrity)
+        self._put_done(ok, self._mirror_error(writer))
+
+    async def _handle_sync(self, msg):
+        # the files of earlier puts on this connection have to
+        # be in the manifest.
+        updates, self.index_updates = self.index_updates, list()
+        await asyncio.gather(*updates, return_exceptions=True)
+        replies = await self.conn.run(self._manifest, msg)
+        if replies is None:
+            self.sendmsg(ErrorResponse(ErrorCodes.NotExists))
+            return
+        for reply in replies:
+            self.sendmsg(reply)
+
+    def _update_index(self, filenames):
+        # hashing the files would hold up the event loop.
+        if filenames:
+            self.index_updates = [f for f in self.index_updates if not f.done()]
+            self.index_updates.append(asyncio.get_running_loop().run_in_executor(self.conn.executor, 
+                super()._update_index, filenames))
+
+    async def _handle_put(self, msg):
+        ok = await get_files_async(self.conn, self.cwd, msg.num_files, self.compression, self.encryption, self.streaming, self.codec, 
+            progress=functools.partial(self._received_file, self.cwd), integrity=self.integrity)
+        self._put_done(ok)
+
+class ListingCache():
+    """
+    ListingCache keeps the folders and files of the 
+    directories that were listed, shared by all handlers
+    of a server. A listing is used again for as long as the
+    directory's mtime stays the same. Listings of a directory
+    changed in the last RACY_SECONDS aren't kept, another
+    change in the same tick of the clock wouldn't show in
+    its mtime. The least recently listed of more than 
+    max_entries directories are dropped.
+    """
+    RACY_SECONDS = 1
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        # path -> (mtime_ns, folders, files)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def listing(self, path):
+        """
+        Returns the (folders, files) in path. Entries are
+        sorted by their type from the directory itself, 
+        only symlinks need a stat.
+        """
+        path = os.path.realpath(path)
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == mtime:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return list(entry[1]), list(entry[2])
+            self.misses += 1
+        folders = list()
+        files = list()
+        with os.scandir(path) as it:
+            for e in it:
+                if e.is_file():
+                    files.append(e.name)
+                else:
+                    folders.append(e.name)
+        if time.time_ns() - mtime > self.RACY_SECONDS * 1000000000:
+            with self.lock:
+                self.entries[path] = (mtime, folders, files)
+                self.entries.move_to_end(path)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return list(folders), list(files)
+
+    def invalidate(self, path):
+        with self.lock:
+            if self.entries.pop(os.path.realpath(path), None) is not None:
+                self.invalidations += 1
+
+    def __str__(self):
+        return "Listing cache hits: {}, misses: {}, invalidations: {}, directories: {}".format(
+            self.hits, self.misses, self.invalidations, len(self.entries))
+
+class ChunkStore():
+    """
+    ChunkStore keeps the content defined chunks of dedup 
+    puts under root by their sha256, and the files put 
+    together from them by the sha256 of their chunk list.
+    The users' files are clones or hard links of those, so
+    the same upload only takes up space once. Files in the
+    store are read only, a put over a linked file replaces
+    it. Everything is written under a temporary name and 
+    renamed into place, so worker processes can share it.
+
+    Their link count is the number of users' files linked 
+    to them, collect removes the ones no file is linked to
+    any more. link runs it every collect_interval seconds.
+    """
+    # a file is only collected once it has gone this many
+    # seconds without being linked.
+    collect_age = 3600
+    collect_interval = 3600
+
+    def __init__(self, root):
+        self.root = root
+        self.next_collect = 0
+        os.makedirs(join(root, "chunks"), exist_ok=True)
+        os.makedirs(join(root, "files"), exist_ok=True)
+
+    def chunk_path(self, digest):
+        name = digest.hex()
+        return join(self.root, "chunks", name[:2], name)
+
+    def has(self, digest):
+        return isfile(self.chunk_path(digest))
+
+    def add(self, digest, data):
+        """
+        Adds the chunk data under digest. Returns False if
+        digest isn't its sha256.
+        """
+        if hashlib.sha256(data).digest() != digest:
+            return False
+        path = self.chunk_path(digest)
+        if not isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = temp_path(path)
+            with open(temp, "xb") as f:
+                f.write(data)
+            os.chmod(temp, 0o444)
+            os.replace(temp, path)
+        return True
+
+    def link(self, digests, filename):
+        """
+        Puts the file made of the chunks digests in place 
+        of filename. Returns False if a chunk is missing.
+        """
+        if time.monotonic() >= self.next_collect:
+            self.next_collect = time.monotonic() + self.collect_interval
+            self.collect()
+        path = join(self.root, "files", hashlib.sha256(b"".join(digests)).hexdigest())
+        temp = temp_path(filename)
+        for attempt in range(2):
+            if not isfile(path) and not self._assemble(digests, path):
+                return False
+            try:
+                clone_file(path, temp)
+                break
+            except FileNotFoundError:
+                # collected by another process in between,
+                # put it together again.
+                continue
+        else:
+            return False
+        os.replace(temp, filename)
+        return True
+
+    def _assemble(self, digests, path):
+        temp = temp_path(path)
+        try:
+            with open(temp, "xb") as out:
+                for digest in digests:
+                    with open(self.chunk_path(digest), "rb") as f:
+                        shutil.copyfileobj(f, out)
+        except FileNotFoundError:
+            os.remove(temp)
+            return False
+        os.chmod(temp, 0o444)
+        os.replace(temp, path)
+        return True
+
+    def collect(self):
+        """
+        Removes the files in the store no user's file has 
+        been linked to for collect_age seconds, and returns
+        how many. Clones don't count as links, the file is
+        put together again if the same upload comes back.
+        """
+        removed = 0
+        now = time.time()
+        with os.scandir(join(self.root, "files")) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    # linking changes ctime, so a file that was
+                    # just put together or linked is left alone.
+                    if st.st_nlink == 1 and now - st.st_ctime > self.collect_age:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
+
+def clone_file(src, dst):
+    """
+    clone_file makes dst a copy on write clone of src where
+    the filesystem can, a hard link where it can't, and a 
+    plain copy if neither works.
+    """
+    try:
+        with open(src, "rb") as f, open(dst, "xb") as out:
+            fcntl.ioctl(out.fileno(), FICLONE, f.fileno())
+        return
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+class StoreWriter():
+    """
+    StoreWriter is written the data of the (sha256, length)
+    chunks one after the other like a file, and adds every
+    chunk to store once it is complete. done tells if all
+    of them arrived and matched their sha256.
+    """
+    def __init__(self, store, chunks):
+        self.store = store
+        self.chunks = collections.deque(chunks)
+        self.buffer = bytearray()
+        self.failed = False
+
+    def write(self, data):
+        if not self.failed:
+            self.buffer.extend(data)
+            while self.chunks and len(self.buffer) >= self.chunks[0][1]:
+                digest, length = self.chunks.popleft()
+                if not self.store.add(digest, bytes(self.buffer[:length])):
+                    self.failed = True
+                    break
+                del self.buffer[:length]
+        return len(data)
+
+    def close(self):
+        pass
+
+    def done(self):
+        return not self.failed and not self.chunks and not self.buffer
+
+class AsyncEffTeePeeServer(UserTableMixin):
+    """
+    The EffTeePee server on an asyncio event loop, one 
+    coroutine per connection instead of one thread. Only 
+    stdlib asyncio streams and run_in_executor are used, so
+    it also runs on a uvloop event loop. Disk and codec work
+    goes to executor, the loop's default one if None.
+    """
+    def __init__(self, hostport, handler=AsyncEffTeePeeHandler, user_file=DEFAULT_USER_FILE, executor=None):
+        self.hostport = hostport
+        self.handler = handler
+        self.executor = executor
+        self.users = dict()
+        self.parse_user_file(user_file)
+        self.listing_cache = ListingCache()
+        self.indexes = dict()
+        self.indexes_lock = threading.Lock()
+        # bound here rather than in serve so PreforkSupervisor
+        # can hand the listening socket to its workers.
+        self.socket = socket.create_server(hostport)
+        self.server_address = self.socket.getsockname()
+
+    async def serve(self):
+        server = await asyncio.start_server(self._accept, sock=self.socket)
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def _accept(self, reader, writer):
+        handler = self.handler(self, reader, writer)
+        await handler.run()
+
+class PreforkSupervisor():
+    """
+    Runs server in processes forked worker processes. The 
+    server is created before forking so the workers share 
+    its listening socket and user table, and the socket stays
+    open while the supervisor replaces a worker that died, so
+    connections queued in the meantime aren't dropped.
+    """
+    # a worker that dies sooner than this after starting is 
+    # restarted after a pause instead of straight away.
+    restart_delay = 1.0
+
+    def __init__(self, server, processes):
+        self.server = server
+        self.processes = processes
+        self.workers = dict()
+        self.stopping = False
+
+    def serve_forever(self):
+        # workers that lose the race for a new connection
+        # go back to waiting instead of blocking in accept.
+        self.server.socket.setblocking(False)
+        # SIGUSR1 is passed on, the workers handle it the
+        # way the supervisor would have.
+        self.usr1 = signal.signal(signal.SIGUSR1, self.forward)
+        for i in range(self.processes):
+            self.spawn()
+        try:
+            while True:
+                pid, status = os.wait()
+                started = self.workers.pop(pid, None)
+                if started is None:
+                    continue
+                print("Worker {} exited with status {}, restarting".format(pid, status))
+                if time.monotonic() - started < self.restart_delay:
+                    time.sleep(self.restart_delay)
+                self.spawn()
+        finally:
+            self.stop()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGUSR1, self.usr1)
+                self.server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = time.monotonic()
+        return pid
+
+    def forward(self, signum, frame):
+        if not callable(self.usr1):
+            return
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(self):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.workers.clear()
+        self.server.socket.close()
+
+
 def main():
-    #if len(sys.argv) < 3:
-        #print("Missing <ip> <port> to listen on.")
-        #return 1
-    #ip, port = sys.argv[1], int(sys.argv[2])
-    ip, port = '0.0.0.0', 12345
-    socketserver.ThreadingTCPServer.allow_reuse_address = True
-    server = EffTeePeeServer((ip, port), EffTeePeeHandler)
+    parser = argparse.ArgumentParser(description="EffTeePee server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--user-file", default=DEFAULT_USER_FILE)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+        help="serve connections from an asyncio event loop instead of a thread each")
+    parser.add_argument("--workers", type=int, default=0,
+        help="serve connections on a pool of this many threads instead of a thread each")
+    parser.add_argument("--max-sessions", type=int, default=64,
+        help="with --workers, most connections running or waiting for a worker")
+    parser.add_argument("--max-user-sessions", type=int, default=4,
+        help="with --workers, most sessions per user")
+    parser.add_argument("--backlog", type=int, default=64,
+        help="with --workers, listen backlog for connections not accepted yet")
+    parser.add_argument("--queue-timeout", type=float, default=10,
+        help="with --workers, seconds a connection may wait for a worker")
+    parser.add_argument("--codec-workers", type=int, default=0,
+        help="encode and decode file chunks of a transfer on a pool of this many threads")
+    parser.add_argument("--codec-processes", action="store_true",
+        help="with --codec-workers, use a pool of processes instead of threads")
+    parser.add_argument("--processes", type=int, default=0,
+        help="serve from this many forked worker processes sharing the listening socket")
+    parser.add_argument("--store", default=None,
+        help="keep the chunks of dedup puts in this directory and link the files from there")
+    parser.add_argument("--index-dir", default=None,
+        help="keep the file indexes for syncs in this directory instead of only in memory, not with --processes")
+    parser.add_argument("--cache-memory", type=int, default=0,
+        help="keep up to this many MiB of encoded chunks in memory for gets of the same files")
+    parser.add_argument("--cache-dir", default=None,
+        help="keep encoded chunks for gets of the same files in this directory too")
+    parser.add_argument("--cache-disk", type=int, default=1024,
+        help="with --cache-dir, most MiB of encoded chunks kept there")
+    args = parser.parse_args()
+    if args.index_dir and args.processes:
+        # every worker would keep its own generations of 
+        # the same epoch and append to the same log.
+        parser.error("--index-dir can't be used with --processes")
+    ip, port = args.host, args.port
+    if args.use_async:
+        server = AsyncEffTeePeeServer((ip, port), AsyncEffTeePeeHandler, args.user_file)
+    else:
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        if args.workers:
+            server = PooledEffTeePeeServer((ip, port), EffTeePeeHandler, args.user_file, args.workers,
+                args.max_sessions, args.max_user_sessions, args.backlog, args.queue_timeout)
+        else:
+            server = EffTeePeeServer((ip, port), EffTeePeeHandler, args.user_file)
+        server.codec_workers = args.codec_workers
+        server.codec_processes = args.codec_processes
+    if args.store:
+        server.chunk_store = ChunkStore(args.store)
+    if args.index_dir:
+        server.index_dir = args.index_dir
+    if args.cache_memory or args.cache_dir:
+        server.chunk_cache = ChunkCache(args.cache_memory * 1024 * 1024, args.cache_dir, args.cache_disk * 1024 * 1024)
+    # kill -USR1 prints the hit and miss counters.
+    signal.signal(signal.SIGUSR1, lambda signum, frame: server.print_stats())
+    if args.processes:
+        print("Starting EffTeePee server on {}:{} with {} processes".format(ip, port, args.processes))
+        try:
+            PreforkSupervisor(server, args.processes).serve_forever()
+        except KeyboardInterrupt:
+            print("Shutting down EffTeePee server.")
+        return
+    if args.use_async:
+        print("Starting asyncio EffTeePee server on {}:{}".format(ip, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Shutting down EffTeePee server.")
+        return
     print("Starting EffTeePee server on {}:{}".format(ip, port))
     try:
         server.serve_forever()